@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Normalized app data tables written instead of app data list columns of connection rows ('tables' app data layout of
+the CONNECTIONS and EXPORT modes of query_handler.py).
+
+Every app data record of a connection is one row of the table of its family (dns, ssh, http, ssl, files) keyed by
+connection.uid, files records have one row per file. Attribute values are dictionary encoded - each column has its
+own dictionary of distinct values and the tables contain integer IDs (-1 = missing value):
+
+  <output_path>-app-<family>.csv     connection.uid + attribute value IDs (columns of pandas_funcs.APP_TABLE_COLUMNS)
+  <output_path>-app-dictionary.csv   column, id, value
+
+Connection rows keep only <app>_count columns, app data are joined (load_app_table) only by stages which need them.
+
+Usage: $ python3 app_tables.py -op <output_path> -f http [-o http_records.csv]
+"""
+
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from pandas_funcs import APP_TABLE_COLUMNS
+
+
+DICTIONARY_COLUMNS = ['column', 'id', 'value']
+MISSING_ID = -1
+
+
+def app_table_file(output_path, app_data_name):
+    return output_path + '-app-' + app_data_name + '.csv'
+
+
+def dictionary_file(output_path):
+    return output_path + '-app-dictionary.csv'
+
+
+class AppDataTables:
+    """
+    Appends app data records to the normalized tables (thread-safe, records of all writer threads share the
+    dictionaries).
+
+    :ivar output_path: path prefix of the table files
+    :ivar app_families: app data names whose tables are written
+    :ivar dictionaries: { column -> { value -> ID } }
+    """
+
+    def __init__(self, output_path, app_families):
+        self.output_path = output_path
+        self.app_families = list(app_families)
+        self.dictionaries = {}
+        self._lock = threading.Lock()
+
+        # tables of a previous run are replaced:
+        for app_data_name in self.app_families:
+            pd.DataFrame(columns=APP_TABLE_COLUMNS[app_data_name]).to_csv(
+                app_table_file(output_path, app_data_name), index=False, header=True)
+
+    def encode(self, column, values):
+        """
+        :return: int64 array of IDs of the values (new values are added to the dictionary of the column)
+        """
+        dictionary = self.dictionaries.setdefault(column, {})
+        codes, uniques = pd.factorize(pd.Series(values, dtype=object).astype(str).where(pd.notna(values)))
+        # the last item is the ID of missing values (code -1):
+        unique_ids = np.full(len(uniques) + 1, MISSING_ID, dtype=np.int64)
+        for i, value in enumerate(uniques):
+            unique_ids[i] = dictionary.setdefault(value, len(dictionary))
+        return unique_ids[codes]
+
+    def append(self, records):
+        """
+        :param records: dictionary { app data name -> DataFrame of records } (see pandas_funcs.flatten_app_records)
+        """
+        with self._lock:
+            for app_data_name, df in records.items():
+                if app_data_name not in self.app_families or df.empty:
+                    continue
+                encoded = pd.DataFrame({'connection.uid': df['connection.uid']})
+                for column in APP_TABLE_COLUMNS[app_data_name][1:]:
+                    encoded[column] = self.encode(column, df[column].to_numpy())
+                encoded.to_csv(app_table_file(self.output_path, app_data_name), mode='a', index=False, header=False)
+
+    def write_dictionary(self):
+        with self._lock:
+            rows = [(column, value_id, value) for column, dictionary in self.dictionaries.items()
+                    for value, value_id in dictionary.items()]
+        pd.DataFrame(rows, columns=DICTIONARY_COLUMNS).to_csv(dictionary_file(self.output_path), index=False,
+                                                              header=True)
+
+
+def load_dictionary(output_path):
+    """
+    :return: { column -> numpy array of values indexed by ID }
+    """
+    dictionary = pd.read_csv(dictionary_file(output_path), dtype={'value': str}, keep_default_na=False)
+    values = {}
+    for column, group in dictionary.groupby('column', sort=False):
+        column_values = np.empty(group['id'].max() + 1, dtype=object)
+        column_values[group['id'].to_numpy()] = group['value'].to_numpy()
+        values[column] = column_values
+    return values
+
+
+def load_app_table(output_path, app_data_name, decode=True, dictionary=None):
+    """
+    :param decode: replace value IDs by values (missing values are None)
+    :param dictionary: output of load_dictionary (loaded if not given)
+    :return: DataFrame of app data records of the family
+    """
+    df = pd.read_csv(app_table_file(output_path, app_data_name), dtype={'connection.uid': str})
+    if not decode:
+        return df
+
+    dictionary = dictionary if dictionary is not None else load_dictionary(output_path)
+    for column in APP_TABLE_COLUMNS[app_data_name][1:]:
+        ids = df[column].to_numpy()
+        column_values = dictionary.get(column, np.empty(0, dtype=object))
+        decoded = np.full(len(ids), None, dtype=object)
+        present = ids != MISSING_ID
+        decoded[present] = column_values[ids[present]]
+        df[column] = decoded
+    return df
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-op', '--output_path', help='Output path of the run (<output_directory>/<output_file>)',
+                        type=str, required=True)
+    parser.add_argument('-f', '--app_family', help='App data family', choices=APP_TABLE_COLUMNS.keys(),
+                        required=True)
+    parser.add_argument('-o', '--output_csv', help='Output CSV file with decoded values (default: print summary)',
+                        type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    app_table = load_app_table(args.output_path, args.app_family)
+    if args.output_csv:
+        app_table.to_csv(args.output_csv, index=False, header=True)
+        print('Successfully wrote to file ' + args.output_csv + '.')
+    else:
+        print('{} records of {} connections.'.format(len(app_table), app_table['connection.uid'].nunique()))
+        for column in APP_TABLE_COLUMNS[args.app_family][1:]:
+            print('{:25} {} distinct values'.format(column, app_table[column].nunique()))
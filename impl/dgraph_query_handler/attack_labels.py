@@ -0,0 +1,145 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Attacker and attack labels of connections (the labelling step of the preprocessing notebooks) computed on whole
+columns instead of row by row:
+
+  * attacker_label - 'Yes' if the originator or the responder of the connection is in one of the attacker networks
+    (CIDR ranges - the Red Team ranges of Cyber Czech, 172.16.0.1/32 in CIC-IDS2017), 'No' otherwise,
+  * attack_label - labels of the alerts (e.g. Snort) whose time range contains the connection and whose originator and
+    responder are the hosts of the connection, joined by ',' in the order of alert start times ('Not_Specified' for
+    a connection of an attacker without an alert, 'Normal' for the other connections).
+
+Addresses are converted to integers once per distinct address, membership in the networks is a binary search in the
+sorted and merged address ranges. Alerts are joined to the attacker connections by a merge on (originator,
+responder) followed by the time range filter. IPv6 addresses and networks are not tagged (as in the notebooks).
+
+Alerts file: CSV with columns start, end, label, originated_ip, responded_ip (times in UTC).
+
+Usage: $ python3 attack_labels.py -i FINAL_neighbourhood.csv -o labelled_neighbourhood.csv -n 172.16.0.1/32
+         [-a alerts.csv]
+"""
+
+import argparse
+import ipaddress
+import numpy as np
+import pandas as pd
+import responses
+
+
+ALERT_COLUMNS = ['start', 'end', 'label', 'originated_ip', 'responded_ip']
+
+
+def ipv4_to_int(ips):
+    """
+    :param ips: Series of IP address strings
+    :return: int64 array of IPv4 addresses (-1 for IPv6 addresses and missing or invalid values)
+    """
+    codes, unique_ips = pd.factorize(pd.Series(ips).astype(str))
+    values = np.empty(len(unique_ips), dtype=np.int64)
+    for i, ip in enumerate(unique_ips):
+        try:
+            values[i] = int(ipaddress.IPv4Address(ip))
+        except ValueError:
+            values[i] = -1
+    return np.where(codes >= 0, values[codes], -1) if len(values) else np.full(len(codes), -1, dtype=np.int64)
+
+
+def merge_networks(cidrs):
+    """
+    :param cidrs: IPv4 networks in CIDR notation (IPv6 networks are skipped)
+    :return: (starts, ends) - sorted disjoint address ranges (ends are inclusive)
+    """
+    networks = [ipaddress.ip_network(cidr, strict=False) for cidr in cidrs]
+    ranges = sorted((int(network.network_address), int(network.broadcast_address)) for network in networks
+                    if network.version == 4)
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    merged = np.array(merged, dtype=np.int64).reshape(-1, 2)
+    return merged[:, 0], merged[:, 1]
+
+
+def in_networks(ips, networks):
+    """
+    :param networks: (starts, ends) of merge_networks
+    :return: bool array - the address is in one of the networks
+    """
+    starts, ends = networks
+    values = ipv4_to_int(ips)
+    candidate = np.searchsorted(starts, values, 'right') - 1
+    inside = candidate >= 0
+    inside[inside] = values[inside] <= ends[candidate[inside]]
+    return inside & (values >= 0)
+
+
+def attacker_labels(df, networks):
+    """
+    :return: Series of attacker labels ('Yes' / 'No') of connections of df
+    """
+    attacker = in_networks(df['originated_ip'], networks) | in_networks(df['responded_ip'], networks)
+    return pd.Series(np.where(attacker, 'Yes', 'No'), index=df.index)
+
+
+def read_alerts(alerts_csv):
+    alerts = pd.read_csv(alerts_csv, usecols=ALERT_COLUMNS, dtype={'label': str, 'originated_ip': str,
+                                                                 'responded_ip': str})
+    alerts['start'] = pd.to_datetime(alerts['start'], utc=True).astype(np.int64)
+    alerts['end'] = pd.to_datetime(alerts['end'], utc=True).astype(np.int64)
+    return alerts
+
+
+def attack_labels(df, attacker, alerts):
+    """
+    :param attacker: bool array - connections of attackers (attacker_labels == 'Yes')
+    :param alerts: DataFrame of alerts (ALERT_COLUMNS, start and end in nanoseconds since epoch)
+    :return: Series of attack labels of connections of df
+    """
+    labels = pd.Series(np.where(attacker, 'Not_Specified', 'Normal'), index=df.index, dtype=object)
+    rows = np.flatnonzero(attacker)
+    if not len(rows) or not len(alerts):
+        return labels
+
+    connections = pd.DataFrame({'row': rows, 'originated_ip': df['originated_ip'].to_numpy()[rows],
+                                'responded_ip': df['responded_ip'].to_numpy()[rows],
+                                'ts_ns': responses.convert_ts_to_epoch_ns(df['connection.ts'].iloc[rows].tolist())})
+    matches = connections.merge(alerts.sort_values('start', kind='stable'), on=['originated_ip', 'responded_ip'])
+    matches = matches[(matches['start'] <= matches['ts_ns']) & (matches['ts_ns'] <= matches['end'])]
+    # labels of a connection in the order of alert start times, every label once:
+    joined = matches.drop_duplicates(['row', 'label']).groupby('row', sort=False)['label'].agg(','.join)
+    labels.iloc[joined.index.to_numpy()] = joined.to_numpy()
+    return labels
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='Neighbourhood or CONNECTIONS mode CSV file', type=str,
+                        required=True)
+    parser.add_argument('-o', '--output_csv', help='Output CSV file (input with label columns)', type=str,
+                        required=True)
+    parser.add_argument('-n', '--networks', help='Attacker networks (CIDR)', nargs='+', required=True)
+    parser.add_argument('-a', '--alerts_csv', help='Alerts (start, end, label, originated_ip, responded_ip), '
+                        'attack_label is computed if set', type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    df = pd.read_csv(args.input_csv, low_memory=False)
+    df['attacker_label'] = attacker_labels(df, merge_networks(args.networks))
+    if args.alerts_csv:
+        df['attack_label'] = attack_labels(df, (df['attacker_label'] == 'Yes').to_numpy(),
+                                           read_alerts(args.alerts_csv))
+    print(df['attacker_label'].value_counts())
+    df.to_csv(args.output_csv, index=False, header=True)
+    print('Successfully wrote to file ' + args.output_csv + '.')
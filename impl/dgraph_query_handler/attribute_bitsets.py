@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Bitset encoding of list-valued app data attributes (feature_columns.SIMILAR_ATTRIBUTES) for the similar attribute
+counts of the neighbourhood (<prefix>_similar_<attribute>_count - neighbours sharing at least one value of the
+attribute with the connection, the connection itself not counted).
+
+Every distinct value of an attribute gets a bit position (the most frequent values first) and values of a
+connection are stored as a fixed-width bitmask - a row of uint64 words. "Neighbour shares a value" is then a bitwise
+AND of two rows. Counts of all windows are computed at once: (connection, neighbour) pairs of the window slices are
+expanded in chunks and the ANDs of all pairs of a chunk are one vectorized operation. Connections without values of
+the attribute (most connections for ssh, ssl, files, ...) are skipped before the expansion.
+
+Attributes with more than max_bits distinct values (file_md5, ssh_host_key, ...) share bit positions among the rare
+values (position = frequency rank modulo max_bits), so their counts may include neighbours with a different rare
+value sharing the position.
+
+Values are read from the list columns of CONNECTIONS mode output (e.g. "['A', 'AAAA']") or from normalized app data
+tables (see app_tables.py).
+"""
+
+import ast
+import numpy as np
+import pandas as pd
+import app_tables
+import feature_columns
+from pandas_funcs import APP_TABLE_COLUMNS
+
+
+WORD_BITS = 64
+
+
+def parse_list_column(values):
+    """
+    :param values: list column values as read from CSV ("['A']", '[]', NaN)
+    :return: (row indices, values) - one item for every value of every row
+    """
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    # every distinct list string is parsed once:
+    parsed = [ast.literal_eval(unique) if isinstance(unique, str) and unique.startswith('[') else []
+              for unique in uniques]
+    lengths = np.array([len(items) for items in parsed] + [0], dtype=np.int64)
+    row_lengths = lengths[codes]
+    rows = np.repeat(np.arange(len(codes)), row_lengths)
+    flat = np.array([str(item) for code in codes[row_lengths > 0] for item in parsed[code]], dtype=object)
+    return rows, flat
+
+
+class AttributeBitsets:
+    """
+    :ivar n_rows: number of connections
+    :ivar max_bits: maximum width of a bitmask
+    :ivar positions: { attribute -> { value -> bit position } }
+    :ivar masks: { attribute -> uint64 matrix (connections x words) }
+    """
+
+    def __init__(self, n_rows, max_bits=256):
+        self.n_rows = n_rows
+        self.max_bits = max_bits
+        self.positions = {}
+        self.masks = {}
+
+    @property
+    def attributes(self):
+        return list(self.masks)
+
+    def add_attribute(self, attribute, rows, values):
+        """
+        :param rows: row index of every value
+        :param values: values of the attribute (missing values are ignored)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        values = pd.Series(values, dtype=object)
+        present = values.notna().to_numpy()
+        codes, uniques = pd.factorize(values[present].astype(str))
+        rows = rows[present]
+
+        # the most frequent values get their own positions, the rarest share them if there are too many values:
+        ranks = np.empty(len(uniques), dtype=np.int64)
+        ranks[np.argsort(-np.bincount(codes, minlength=len(uniques)), kind='stable')] = np.arange(len(uniques))
+        bit_positions = ranks % self.max_bits
+        self.positions[attribute] = dict(zip(uniques, bit_positions.tolist()))
+
+        n_words = max(1, -(-min(len(uniques), self.max_bits) // WORD_BITS))
+        masks = np.zeros((self.n_rows, n_words), dtype=np.uint64)
+        bits = bit_positions[codes]
+        np.bitwise_or.at(masks, (rows, bits // WORD_BITS), np.left_shift(np.uint64(1), (bits % WORD_BITS).astype(
+            np.uint64)))
+        self.masks[attribute] = masks
+
+    @classmethod
+    def from_frame(cls, df, attributes=None, max_bits=256):
+        """
+        :param df: DataFrame of connections with list columns of the attributes (CONNECTIONS mode output)
+        """
+        attributes = attributes or [attribute for attribute in feature_columns.SIMILAR_ATTRIBUTES if attribute in df]
+        bitsets = cls(len(df), max_bits)
+        for attribute in attributes:
+            bitsets.add_attribute(attribute, *parse_list_column(df[attribute].to_numpy()))
+        return bitsets
+
+    @classmethod
+    def from_app_tables(cls, output_path, uids, attributes=None, max_bits=256):
+        """
+        :param output_path: output path of the run which wrote the app data tables
+        :param uids: connection.uid of the connections (rows of the bitsets)
+        """
+        attributes = attributes or feature_columns.SIMILAR_ATTRIBUTES
+        row_of_uid = pd.Index(uids)
+        bitsets = cls(len(uids), max_bits)
+        for app_data_name, columns in APP_TABLE_COLUMNS.items():
+            table_attributes = [attribute for attribute in columns[1:] if attribute in attributes]
+            if not table_attributes:
+                continue
+            # value IDs are already distinct values, they are not decoded:
+            table = app_tables.load_app_table(output_path, app_data_name, decode=False)
+            rows = row_of_uid.get_indexer(table['connection.uid'])
+            known = rows >= 0
+            for attribute in table_attributes:
+                ids = table[attribute].to_numpy()
+                bitsets.add_attribute(attribute, rows[known], np.where(ids[known] == app_tables.MISSING_ID, None,
+                                                                       ids[known]))
+        return bitsets
+
+    def shared_counts(self, attribute, query_ids, neighbour_ids, lo, hi, chunk_words=1 << 22):
+        """
+        :param query_ids: connections (rows) whose neighbourhoods are counted
+        :param neighbour_ids: connections of the sorted index the window slices refer to
+        :param lo, hi: window slice neighbour_ids[lo[q]:hi[q]] of every query connection
+        :param chunk_words: maximum number of mask words of the (connection, neighbour) pairs expanded at once - the
+                            number of pairs of a chunk is chunk_words / words of the attribute, so a gathered chunk
+                            of masks takes at most chunk_words * 8 bytes whatever the width of the attribute
+        :return: number of neighbours sharing a value of the attribute with the query connection (connection itself
+                 not counted)
+        """
+        masks = self.masks[attribute]
+        chunk_pairs = max(1, chunk_words // masks.shape[1])
+        counts = np.zeros(len(query_ids), dtype=np.int64)
+        nonempty = masks.any(axis=1)
+        queries = np.flatnonzero(nonempty[query_ids] & (hi > lo))
+        if not len(queries):
+            return counts
+
+        sizes = (hi - lo)[queries]
+        ends = np.cumsum(sizes)
+        start = 0
+        while start < len(queries):
+            # queries of one chunk (at least one query, even if its window alone is larger than the chunk):
+            first_pair = ends[start] - sizes[start]
+            end = max(start + 1, int(np.searchsorted(ends, first_pair + chunk_pairs, 'right')))
+            chunk_sizes = sizes[start:end]
+            pair_query = np.repeat(np.arange(start, end), chunk_sizes)
+            pair_offset = np.arange(len(pair_query)) - np.repeat(ends[start:end] - chunk_sizes - first_pair,
+                                                                  chunk_sizes)
+            query = queries[pair_query]
+            neighbour = neighbour_ids[lo[query] + pair_offset]
+            query_connection = query_ids[query]
+
+            shared = (masks[neighbour] & masks[query_connection]).any(axis=1) & (neighbour != query_connection)
+            counts[queries[start:end]] = np.bincount(pair_query - start, weights=shared, minlength=end - start)
+            start = end
+        return counts
@@ -0,0 +1,278 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Benchmark of the CPU-bound offline stages on datasets of CONNECTIONS mode output (the data/cicids2017/*.zip archives),
+no Dgraph instance is needed:
+
+  load            reading originated connections of the archive (workflow.read_dataset)
+  windows         neighbourhood features of all window sizes (multiscale_windows.py)
+  similar_counts  the same with similar attribute counts (attribute_bitsets.py) - the difference to windows is the
+                  cost of the counts
+  cidr_tagging    attacker labels of connections by attacker networks (attack_labels.py)
+  label_join      attack labels joined from alerts - the archives have no alerts, one alert (+-4 s) is generated for
+                  every host pair and minute of attacker connections
+  clustering      preprocessing fit and transform and a mini-batch k-prototypes fit of the neighbourhood features
+
+Every stage is run repeats times, its wall time (median and minimum), peak resident memory (sampled by a thread, and
+its increase over the memory at the start of the stage) and rows per second are written with the environment (versions,
+CPU count) to a JSON results file. Stages of a dataset run in one process one after another, datasets one after
+another, so the measurements do not interfere.
+
+Comparison of two results files flags stages whose minimum wall time or memory increase grew by more than the
+threshold (and by more than the absolute minimums, which filter out noise of very short stages), the exit status is
+1 if a regression was found.
+
+Usage: $ python3 benchmark.py -i ../../data/cicids2017/*.zip -o benchmark_results.json [-w 10 60 300 -r 3 -k 9]
+       $ python3 benchmark.py -cmp baseline.json benchmark_results.json [-th 0.2 -ms 0.05 -mm 10]
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import platform
+import resource
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import sklearn
+import responses
+import feature_columns
+import workflow
+import attack_labels
+from multiscale_windows import MultiScaleWindows, MULTISCALE_INPUT_COLS
+from attribute_bitsets import AttributeBitsets
+from preprocessing import Preprocessor
+from minibatch_kprototypes import MiniBatchKPrototypes
+
+
+STAGES = ['load', 'windows', 'similar_counts', 'cidr_tagging', 'label_join', 'clustering']
+RESULT_COLUMNS = ['dataset', 'stage', 'rows', 'repeats', 'wall_seconds', 'wall_seconds_min', 'rows_per_second',
+                  'peak_rss_mb', 'rss_increase_mb']
+
+# attacker of the CIC-IDS2017 attacks in the notebooks:
+DEFAULT_NETWORKS = ['172.16.0.1/32']
+ALERT_MARGIN_NS = 4 * responses.NANOSECONDS_IN_SECOND
+MB = 1 << 20
+
+
+def current_rss():
+    """
+    :return: resident set size of the process in bytes (the peak so far if /proc is not available)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PeakMemorySampler:
+    """
+    Context manager sampling the resident set size in a thread (ru_maxrss is the peak of the whole process, not of
+    a stage).
+
+    :ivar start_rss: resident set size at the start
+    :ivar peak_rss: largest sampled resident set size
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_rss = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, current_rss())
+
+    def __enter__(self):
+        self.start_rss = self.peak_rss = current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+
+def measure(dataset, stage, func, repeats):
+    """
+    Run func (returning (number of rows, result)) repeats times.
+
+    :return: (record of RESULT_COLUMNS, result of the last run)
+    """
+    seconds = []
+    peak_rss = 0
+    rss_increase = 0
+    for _ in range(repeats):
+        with PeakMemorySampler() as sampler:
+            start = time.perf_counter()
+            rows, result = func()
+            seconds.append(time.perf_counter() - start)
+        peak_rss = max(peak_rss, sampler.peak_rss)
+        rss_increase = max(rss_increase, sampler.peak_rss - sampler.start_rss)
+    wall_seconds = float(np.median(seconds))
+    record = {'dataset': dataset, 'stage': stage, 'rows': rows, 'repeats': repeats, 'wall_seconds': wall_seconds,
+              'wall_seconds_min': min(seconds), 'rows_per_second': rows / wall_seconds if wall_seconds > 0 else None,
+              'peak_rss_mb': peak_rss / MB, 'rss_increase_mb': rss_increase / MB}
+    print('{:30} {:14} {:8} rows {:9.3f} s {:12.0f} rows/s {:8.1f} MB peak'.format(
+        dataset, stage, rows, wall_seconds, record['rows_per_second'] or 0, record['peak_rss_mb']))
+    return record, result
+
+
+def generate_alerts(connections, attacker):
+    """
+    :return: one alert per host pair and minute of the attacker connections (start - 4 s, end + 4 s)
+    """
+    ts_ns = responses.convert_ts_to_epoch_ns(connections['connection.ts'].tolist())
+    attacks = pd.DataFrame({'originated_ip': connections['originated_ip'].to_numpy()[attacker],
+                            'responded_ip': connections['responded_ip'].to_numpy()[attacker],
+                            'ts_ns': ts_ns[attacker]})
+    attacks['minute'] = attacks['ts_ns'] // (60 * responses.NANOSECONDS_IN_SECOND)
+    alerts = attacks.groupby(['originated_ip', 'responded_ip', 'minute'], sort=False)['ts_ns'].agg(['min', 'max'])
+    alerts = alerts.reset_index()
+    return pd.DataFrame({'start': alerts['min'] - ALERT_MARGIN_NS, 'end': alerts['max'] + ALERT_MARGIN_NS,
+                         'label': 'Attack', 'originated_ip': alerts['originated_ip'],
+                         'responded_ip': alerts['responded_ip']})
+
+
+def fit_clusters(neighbourhood, n_clusters, seed):
+    numeric, categorical = workflow.feature_columns_of(neighbourhood.columns)
+    preprocessor = Preprocessor(numeric, categorical).fit(lambda: [neighbourhood])
+    X_num, X_cat = preprocessor.transform(neighbourhood)
+    return MiniBatchKPrototypes(n_clusters=n_clusters, random_state=seed, compute_labels=False).fit(X_num, X_cat)
+
+
+def run_dataset(dataset, stages, window_seconds, repeats, networks, n_clusters, seed=0):
+    """
+    Run the stages of the benchmark over the dataset (a stage needs outputs of the previous stages - load, windows and
+    cidr_tagging are run even if not selected, but not recorded).
+
+    :return: list of records of the selected stages
+    """
+    name = workflow.dataset_name(dataset)
+    records = []
+
+    def run(stage, func):
+        record, result = measure(name, stage, func, repeats if stage in stages else 1)
+        if stage in stages:
+            records.append(record)
+        return result
+
+    columns = MULTISCALE_INPUT_COLS + feature_columns.SIMILAR_ATTRIBUTES
+    connections = run('load', lambda: (lambda df: (len(df), df))(workflow.read_dataset(dataset, columns)))
+    features = run('windows', lambda: (len(connections), MultiScaleWindows(connections).compute_features(
+        window_seconds)))
+    if 'similar_counts' in stages:
+        run('similar_counts', lambda: (len(connections), MultiScaleWindows(
+            connections, AttributeBitsets.from_frame(connections)).compute_features(window_seconds)))
+
+    network_ranges = attack_labels.merge_networks(networks)
+    labels = run('cidr_tagging', lambda: (len(connections), attack_labels.attacker_labels(connections,
+                                                                                          network_ranges)))
+    attacker = (labels == 'Yes').to_numpy()
+    if 'label_join' in stages:
+        alerts = generate_alerts(connections, attacker)
+        run('label_join', lambda: (len(connections), attack_labels.attack_labels(connections, attacker, alerts)))
+    if 'clustering' in stages:
+        neighbourhood = pd.concat([connections[MULTISCALE_INPUT_COLS], features], axis=1)
+        run('clustering', lambda: (len(neighbourhood), fit_clusters(neighbourhood, n_clusters, seed)))
+    return records
+
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'scikit-learn': sklearn.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare_results(baseline, results, threshold=0.2, min_seconds=0.05, min_memory_mb=10.0):
+    """
+    :param baseline: results (JSON of the results file) of the baseline
+    :return: DataFrame of stages of both results with relative changes and flags of regressions
+    """
+    columns = ['dataset', 'stage', 'wall_seconds_min', 'rss_increase_mb', 'rows_per_second']
+    merged = pd.DataFrame(baseline['results'])[columns].merge(
+        pd.DataFrame(results['results'])[columns], on=['dataset', 'stage'], how='outer',
+        suffixes=('_baseline', ''), indicator='presence')
+    merged['time_change'] = merged['wall_seconds_min'] / merged['wall_seconds_min_baseline'] - 1
+    merged['memory_change'] = (merged['rss_increase_mb'] - merged['rss_increase_mb_baseline']) / \
+        merged['rss_increase_mb_baseline'].clip(lower=1.0)
+    merged['time_regression'] = (merged['time_change'] > threshold) & \
+        (merged['wall_seconds_min'] - merged['wall_seconds_min_baseline'] > min_seconds)
+    merged['memory_regression'] = (merged['memory_change'] > threshold) & \
+        (merged['rss_increase_mb'] - merged['rss_increase_mb_baseline'] > min_memory_mb)
+    return merged
+
+
+def print_comparison(comparison):
+    for row in comparison.itertuples(index=False):
+        if row.presence != 'both':
+            print('{:30} {:14} only in the {}'.format(row.dataset, row.stage, 'baseline' if row.presence == 'left_only'
+                                                      else 'results'))
+            continue
+        flags = [flag for flag, regression in [('TIME', row.time_regression), ('MEMORY', row.memory_regression)]
+                 if regression]
+        print('{:30} {:14} {:9.3f} -> {:9.3f} s ({:+7.1%}) {:8.1f} -> {:8.1f} MB ({:+7.1%}) {}'.format(
+            row.dataset, row.stage, row.wall_seconds_min_baseline, row.wall_seconds_min, row.time_change,
+            row.rss_increase_mb_baseline, row.rss_increase_mb, row.memory_change, ' '.join(flags)))
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--datasets', help='Datasets - zip archives or directories of CONNECTIONS mode output '
+                        'files (globs are expanded)', nargs='+', default=None)
+    parser.add_argument('-o', '--output_json', help='Results file', type=str, default='benchmark_results.json')
+    parser.add_argument('-s', '--stages', help='Stages to benchmark', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('-w', '--windows', help='Half-widths of time windows in seconds', nargs='+', type=int,
+                        default=[10, 60, 300])
+    parser.add_argument('-r', '--repeats', help='Number of runs of every stage', type=int, default=3)
+    parser.add_argument('-n', '--networks', help='Attacker networks (CIDR) of cidr_tagging', nargs='+',
+                        default=DEFAULT_NETWORKS)
+    parser.add_argument('-k', '--n_clusters', help='Number of clusters of clustering', type=int, default=9)
+    parser.add_argument('-cmp', '--compare', help='Compare results file to baseline results file', nargs=2,
+                        metavar=('BASELINE', 'RESULTS'), default=None)
+    parser.add_argument('-th', '--threshold', help='Relative increase of time or memory flagged as regression',
+                        type=float, default=0.2)
+    parser.add_argument('-ms', '--min_seconds', help='Minimum absolute increase of time flagged as regression',
+                        type=float, default=0.05)
+    parser.add_argument('-mm', '--min_memory_mb', help='Minimum absolute increase of memory (MB) flagged as '
+                        'regression', type=float, default=10.0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    if args.compare:
+        with open(args.compare[0]) as baseline_file, open(args.compare[1]) as results_file:
+            comparison = compare_results(json.load(baseline_file), json.load(results_file), args.threshold,
+                                         args.min_seconds, args.min_memory_mb)
+        print_comparison(comparison)
+        regressions = int((comparison['time_regression'] | comparison['memory_regression']).sum())
+        print('{} regressions found.'.format(regressions))
+        sys.exit(1 if regressions else 0)
+
+    if not args.datasets:
+        sys.exit('Datasets (-i) or a comparison (-cmp) are required.')
+    datasets = [path for pattern in args.datasets for path in (sorted(glob.glob(pattern)) or [pattern])]
+    results = []
+    for dataset in datasets:
+        results.extend(run_dataset(dataset, args.stages, args.windows, args.repeats, args.networks, args.n_clusters))
+    with open(args.output_json, 'w') as output_file:
+        json.dump({'environment': environment(), 'params': {'windows': args.windows, 'repeats': args.repeats,
+                                                            'networks': args.networks, 'n_clusters': args.n_clusters},
+                   'results': results}, output_file, indent=2)
+    print('Successfully wrote results of {} stages to file {}.'.format(len(results), args.output_json))
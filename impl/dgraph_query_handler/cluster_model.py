@@ -0,0 +1,245 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Fitted clustering model together with the preprocessing state needed to apply it to new connections.
+
+Prototypes of a fitted model (kmodes KPrototypes / minibatch_kprototypes.MiniBatchKPrototypes / sklearn KMeans)
+are stored with the order of numerical and categorical columns, values used for missing numerical features and the
+categories of categorical features, so new neighbourhood feature rows are transformed exactly as the training data.
+
+The model file is a numpy .npz archive (no pickle):
+
+  centers      numerical part of prototypes (clusters x numerical columns)
+  modes        categorical part of prototypes as category codes (clusters x categorical columns)
+  fill_values  values of missing numerical features
+  thresholds   per-cluster anomaly score thresholds (empty if not computed)
+  meta         UTF-8 JSON - numerical and categorical columns, categories, gamma, model type
+  preprocessor.*  fitted preprocessing.Preprocessor (optional) - the model was fitted on its output, new rows are
+               transformed by it (columns of the model are then its output features)
+
+Anomaly score of a row is its k-prototypes distance to the nearest prototype - squared euclidean distance of
+numerical features + gamma * number of mismatching categorical attributes (gamma = 0 and no categorical attributes
+for k-means).
+
+Usage: $ python3 cluster_model.py -fs feature_store -ng CONN_NUMERICAL_COLS CONN_APP_STATS -cc protocol service
+         -k 9 -o model.npz [-b 10000 -i 10 -q 0.99]
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import orjson as json
+from scipy import sparse
+import minibatch_kprototypes
+from preprocessing import Preprocessor
+
+
+class ClusterModel:
+    """
+    :ivar numeric_columns: numerical input columns (in the order of centers)
+    :ivar categorical_columns: categorical input columns (in the order of modes)
+    :ivar categories: dictionary { categorical column -> list of categories (code = index in the list) }
+    :ivar centers: numerical part of prototypes
+    :ivar modes: categorical part of prototypes (category codes)
+    :ivar gamma: weight of categorical mismatches
+    :ivar fill_values: values of missing numerical features
+    :ivar thresholds: per-cluster anomaly score thresholds or None
+    :ivar model_type: type of the fitted model
+    :ivar preprocessor: preprocessing.Preprocessor applied to new rows or None
+    """
+
+    def __init__(self, numeric_columns, categorical_columns, categories, centers, modes, gamma, fill_values=None,
+                 thresholds=None, model_type='kprototypes', preprocessor=None):
+        self.numeric_columns = list(numeric_columns)
+        self.categorical_columns = list(categorical_columns)
+        self.categories = {column: list(categories[column]) for column in self.categorical_columns}
+        self.centers = np.asarray(centers, dtype=np.float64).reshape(-1, len(self.numeric_columns))
+        self.modes = np.asarray(modes, dtype=np.int64).reshape(len(self.centers), len(self.categorical_columns))
+        self.gamma = float(gamma)
+        self.fill_values = np.zeros(len(self.numeric_columns)) if fill_values is None \
+            else np.asarray(fill_values, dtype=np.float64)
+        self.thresholds = None if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+        self.model_type = model_type
+        self.preprocessor = preprocessor
+
+    @property
+    def n_clusters(self):
+        return len(self.centers)
+
+    @classmethod
+    def from_kprototypes(cls, model, numeric_columns, categorical_columns, categories=None, fill_values=None):
+        """
+        :param model: fitted MiniBatchKPrototypes (modes are category codes, categories are required) or kmodes
+                      KPrototypes (cluster_centroids_ contain numerical attributes followed by categorical values)
+        :param numeric_columns: numerical columns in the order of the training matrix
+        :param categorical_columns: categorical columns in the order of the training matrix
+        :param categories: { categorical column -> list of categories } of the codes (MiniBatchKPrototypes)
+        """
+        if hasattr(model, 'cluster_modes_'):
+            return cls(numeric_columns, categorical_columns, categories, model.cluster_centers_, model.cluster_modes_,
+                       model.gamma, fill_values)
+
+        centroids = np.asarray(model.cluster_centroids_)
+        n_numeric = len(numeric_columns)
+        categories = {column: [] for column in categorical_columns} if categories is None \
+            else {column: list(categories[column]) for column in categorical_columns}
+        modes = np.zeros((len(centroids), len(categorical_columns)), dtype=np.int64)
+        for j, column in enumerate(categorical_columns):
+            for cluster, value in enumerate(centroids[:, n_numeric + j]):
+                # only categories of modes matter for scoring, other categories always mismatch
+                if value not in categories[column]:
+                    categories[column].append(value)
+                modes[cluster, j] = categories[column].index(value)
+        return cls(numeric_columns, categorical_columns, categories, centroids[:, :n_numeric].astype(np.float64),
+                   modes, model.gamma, fill_values)
+
+    @classmethod
+    def from_kmeans(cls, model, numeric_columns, fill_values=None):
+        return cls(numeric_columns, [], {}, model.cluster_centers_, np.zeros((len(model.cluster_centers_), 0)), 0.0,
+                   fill_values, model_type='kmeans')
+
+    @classmethod
+    def from_preprocessed(cls, model, preprocessor):
+        """
+        :param model: model fitted on the output of the preprocessor (k-prototypes on codes, k-means on standardized
+                      numerical columns with the one-hot matrix or on the PCA projection)
+        :param preprocessor: fitted preprocessing.Preprocessor
+        """
+        numeric_columns, categorical_columns = preprocessor.feature_names()
+        if preprocessor.n_components or preprocessor.categorical_output == 'onehot':
+            cluster_model = cls.from_kmeans(model, numeric_columns + categorical_columns)
+        else:
+            cluster_model = cls.from_kprototypes(model, numeric_columns, categorical_columns, preprocessor.categories)
+        cluster_model.preprocessor = preprocessor
+        return cluster_model
+
+    def input_columns(self):
+        """
+        :return: columns of neighbourhood feature rows used by transform
+        """
+        if self.preprocessor is not None:
+            return self.preprocessor.numeric_columns + self.preprocessor.categorical_columns
+        return self.numeric_columns + self.categorical_columns
+
+    def transform(self, df):
+        """
+        :param df: DataFrame of neighbourhood feature rows
+        :return: (float numerical matrix, int matrix of category codes - unknown categories are -1)
+        """
+        if self.preprocessor is not None:
+            X_num, X_cat = self.preprocessor.transform(df)
+            if sparse.issparse(X_cat):
+                return sparse.hstack([X_num, X_cat], format='csr'), np.zeros((len(df), 0), dtype=np.int64)
+            return X_num, X_cat
+
+        X_num = df.reindex(columns=self.numeric_columns).to_numpy(dtype=np.float64, na_value=np.nan)
+        missing = np.isnan(X_num)
+        if missing.any():
+            X_num[missing] = np.broadcast_to(self.fill_values, X_num.shape)[missing]
+
+        X_cat = np.empty((len(df), len(self.categorical_columns)), dtype=np.int64)
+        for j, column in enumerate(self.categorical_columns):
+            values = df[column].astype(str).where(df[column].notna()) if column in df.columns \
+                else pd.Series(np.nan, index=df.index)
+            X_cat[:, j] = pd.Categorical(values, categories=self.categories[column]).codes
+        return X_num, X_cat
+
+    def score(self, X_num, X_cat, batch_size=65536):
+        """
+        Assign rows to the nearest prototypes batch by batch.
+
+        :return: (cluster labels, anomaly scores - distances to the prototypes of the clusters)
+        """
+        n_rows = X_num.shape[0]
+        labels = np.empty(n_rows, dtype=np.int32)
+        scores = np.empty(n_rows, dtype=np.float64)
+        for start, end in minibatch_kprototypes.iterate_batches(n_rows, batch_size):
+            # one-hot encoded rows (sparse) are dense only batch by batch
+            X_batch = X_num[start:end].toarray() if sparse.issparse(X_num) else X_num[start:end]
+            labels[start:end], scores[start:end] = minibatch_kprototypes.assign_labels(
+                X_batch, X_cat[start:end], self.centers, self.modes, self.gamma)
+        return labels, scores
+
+    def score_frame(self, df, batch_size=65536):
+        """
+        :return: DataFrame with columns cluster, anomaly_score (and anomaly if thresholds are computed)
+        """
+        labels, scores = self.score(*self.transform(df), batch_size=batch_size)
+        result = pd.DataFrame({'cluster': labels, 'anomaly_score': scores}, index=df.index)
+        if self.thresholds is not None:
+            result['anomaly'] = scores > self.thresholds[labels]
+        return result
+
+    def fit_thresholds(self, X_num, X_cat, quantile=0.99, batch_size=65536):
+        """
+        Set the anomaly threshold of each cluster to the quantile of scores of its (training) rows.
+        """
+        labels, scores = self.score(X_num, X_cat, batch_size)
+        self.thresholds = np.array([np.quantile(scores[labels == cluster], quantile)
+                                    if np.any(labels == cluster) else np.inf for cluster in range(self.n_clusters)])
+        return self
+
+    def save(self, file_name):
+        meta = {'numeric_columns': self.numeric_columns, 'categorical_columns': self.categorical_columns,
+                'categories': self.categories, 'gamma': self.gamma, 'model_type': self.model_type}
+        preprocessor = self.preprocessor.to_arrays('preprocessor.') if self.preprocessor is not None else {}
+        with open(file_name, 'wb') as file:
+            np.savez(file, centers=self.centers, modes=self.modes, fill_values=self.fill_values,
+                     thresholds=self.thresholds if self.thresholds is not None else np.empty(0),
+                     meta=np.frombuffer(json.dumps(meta), dtype=np.uint8), **preprocessor)
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name, allow_pickle=False) as archive:
+            meta = json.loads(archive['meta'].tobytes())
+            preprocessor = Preprocessor.from_arrays({key: archive[key] for key in archive.files}, 'preprocessor.') \
+                if 'preprocessor.meta' in archive.files else None
+            return cls(meta['numeric_columns'], meta['categorical_columns'], meta['categories'], archive['centers'],
+                       archive['modes'], meta['gamma'], archive['fill_values'],
+                       archive['thresholds'] if len(archive['thresholds']) else None, meta['model_type'], preprocessor)
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-fs', '--feature_store', help='Feature store directory (see feature_store.py)', type=str,
+                        required=True)
+    parser.add_argument('-ng', '--numerical_groups', help='Column groups of numerical features', nargs='+',
+                        required=True)
+    parser.add_argument('-cc', '--categorical_columns', help='Categorical columns', nargs='*', default=[])
+    parser.add_argument('-k', '--n_clusters', help='Number of clusters', type=int, required=True)
+    parser.add_argument('-o', '--output_file', help='Model file (.npz)', type=str, required=True)
+    parser.add_argument('-b', '--batch_size', help='Mini-batch size', type=int, default=10000)
+    parser.add_argument('-i', '--max_iter', help='Maximum number of iterations (passes over data)', type=int,
+                        default=10)
+    parser.add_argument('-q', '--quantile', help='Quantile of training scores used as anomaly threshold', type=float,
+                        default=None)
+    parser.add_argument('-s', '--seed', help='Random seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import feature_store
+
+    args = define_arguments()
+    store = feature_store.FeatureStore(args.feature_store)
+    numerical_columns = [column for column in store.group_columns(*args.numerical_groups)
+                         if column in store.schema['numeric_columns']]
+    numerical = store.numeric(numerical_columns)
+    categorical = np.column_stack([store.codes(column) for column in args.categorical_columns]) \
+        if args.categorical_columns else np.zeros((len(store), 0), dtype=np.int32)
+
+    kprototypes = minibatch_kprototypes.MiniBatchKPrototypes(n_clusters=args.n_clusters, batch_size=args.batch_size,
+                                                             max_iter=args.max_iter, random_state=args.seed,
+                                                             compute_labels=False).fit(numerical, categorical)
+    model = ClusterModel.from_kprototypes(kprototypes, numerical_columns, args.categorical_columns, store.dictionary)
+    if args.quantile is not None:
+        model.fit_thresholds(numerical, categorical, args.quantile)
+    model.save(args.output_file)
+    print('Successfully wrote model with {} clusters to file {}.'.format(model.n_clusters, args.output_file))
@@ -0,0 +1,273 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Cluster profiles and evaluation against labels of many clustering models at once.
+
+The model notebooks interpret clusters by df.groupby('cluster_cat').agg({column: 'mean' or lambda x:
+x.value_counts().index[0]}) - a Python function per cluster and column - and evaluate labels against clusters by
+hand. Here the rows are encoded once (float matrix of numerical columns, int codes of categorical columns and of the
+label columns) and clusters of all models are numbered consecutively (model offset + cluster), so every statistic of
+all models is one vectorized operation:
+
+  * profiles - number of connections, means of numerical columns (a sparse cluster indicator matrix times the
+    numerical matrix) and modes of categorical columns (bincount of cluster * categories + code, argmax - ties are
+    resolved to the first category in sorted order, missing values are not counted as by value_counts),
+  * contingency tables of clusters and values of attack_label / attacker_label,
+  * metrics of a model - purity, adjusted Rand index, and per label value the precision, recall and F1 score of the
+    majority mapping (every cluster predicts the most frequent label value of its connections).
+
+Labels of a model are given by a fitted model file (cluster_model.py, rows are scored), a .npy array of labels in the
+order of the input rows (dbscan_sweep.py labels, -1 = noise is a cluster of its own) or a CSV file with a cluster
+column (score.py, workflow.py) joined by connection.uid.
+
+Output directory: profiles.csv, contingency.csv, metrics.csv (one row per model and label column), classes.csv (one
+row per model, label column and label value).
+
+Usage: $ python3 cluster_profiles.py -i FINAL_neighbourhood_labelled.csv -m model-k*.npz -o cluster_profiles
+         [-nc connection.duration orig_orig_total -cc protocol service -lc attack_label attacker_label]
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import feature_columns
+from cluster_model import ClusterModel
+
+
+LABEL_COLUMNS = ['attack_label', 'attacker_label']
+PROFILES_FILE = 'profiles.csv'
+CONTINGENCY_FILE = 'contingency.csv'
+METRICS_FILE = 'metrics.csv'
+CLASSES_FILE = 'classes.csv'
+
+
+def comb2(values):
+    return values * (values - 1) / 2.0
+
+
+class ClusterProfiler:
+    """
+    :ivar numeric_columns: columns profiled by means
+    :ivar categorical_columns: columns profiled by modes
+    :ivar label_columns: label columns the clusters are evaluated against
+    :ivar categories: { categorical or label column -> sorted values (code = index) }
+    """
+
+    def __init__(self, df, numeric_columns=None, categorical_columns=None, label_columns=None):
+        """
+        :param df: DataFrame of connections (numerical and categorical columns are by default all columns of
+                   numerical / other dtypes except identifiers and labels)
+        """
+        self.n_rows = len(df)
+        self.label_columns = [column for column in (LABEL_COLUMNS if label_columns is None else label_columns)
+                              if column in df.columns]
+        excluded = set(feature_columns.CONN_IDS_COLS + self.label_columns)
+        if numeric_columns is None:
+            numeric_columns = [column for column in df.select_dtypes('number').columns if column not in excluded]
+        if categorical_columns is None:
+            numeric = set(df.select_dtypes('number').columns)
+            categorical_columns = [column for column in df.columns if column not in excluded and column not in numeric]
+        self.numeric_columns = list(numeric_columns)
+        self.categorical_columns = list(categorical_columns)
+
+        X_num = df[self.numeric_columns].to_numpy(dtype=np.float64, na_value=np.nan)
+        self.valid = (~np.isnan(X_num)).astype(np.float64)
+        self.X_num = np.nan_to_num(X_num, nan=0.0)
+
+        self.categories = {}
+        self.codes = {}
+        for column in self.categorical_columns:
+            self.codes[column], self.categories[column] = pd.factorize(df[column], sort=True)
+        for column in self.label_columns:
+            # a missing label is a label value of its own:
+            self.codes[column], self.categories[column] = pd.factorize(df[column].fillna('none').astype(str),
+                                                                       sort=True)
+
+    def number_clusters(self, assignments):
+        """
+        :param assignments: { model -> labels of rows }
+        :return: (global cluster ids of all models concatenated (models x rows), DataFrame of clusters - model,
+                 cluster, offset of the model's first cluster)
+        """
+        ids = []
+        clusters = []
+        offset = 0
+        for model, labels in assignments.items():
+            values, inverse = np.unique(np.asarray(labels), return_inverse=True)
+            ids.append(inverse + offset)
+            clusters.append(pd.DataFrame({'model': model, 'cluster': values, 'offset': offset}))
+            offset += len(values)
+        return np.concatenate(ids), pd.concat(clusters, ignore_index=True)
+
+    def tally(self, ids, codes, n_clusters, n_categories):
+        """
+        :return: counts of clusters x categories (rows with missing code -1 are not counted)
+        """
+        all_codes = np.tile(codes, len(ids) // max(1, self.n_rows))
+        counted = all_codes >= 0
+        return np.bincount(ids[counted] * n_categories + all_codes[counted],
+                           minlength=n_clusters * n_categories).reshape(n_clusters, n_categories)
+
+    def profiles(self, assignments, ids=None, clusters=None):
+        """
+        :return: DataFrame - model, cluster, count and the mean / mode of every profiled column
+        """
+        if ids is None:
+            ids, clusters = self.number_clusters(assignments)
+        n_clusters = len(clusters)
+        rows = np.tile(np.arange(self.n_rows), len(assignments))
+        indicator = sparse.csr_matrix((np.ones(len(ids)), (ids, rows)), shape=(n_clusters, self.n_rows))
+
+        profiles = clusters[['model', 'cluster']].copy()
+        profiles['count'] = np.bincount(ids, minlength=n_clusters)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (indicator @ self.X_num) / (indicator @ self.valid)
+        profiles = pd.concat([profiles, pd.DataFrame(means, columns=self.numeric_columns)], axis=1)
+        for column in self.categorical_columns:
+            counts = self.tally(ids, self.codes[column], n_clusters, len(self.categories[column]))
+            modes = np.asarray(self.categories[column], dtype=object)[counts.argmax(axis=1)] \
+                if len(self.categories[column]) else np.full(n_clusters, None)
+            profiles[column] = np.where(counts.sum(axis=1) > 0, modes, None)
+        return profiles
+
+    def evaluate(self, assignments, ids=None, clusters=None):
+        """
+        :return: (contingency DataFrame - model, cluster, label column, label value, count; metrics DataFrame -
+                 model, label column, number of clusters, purity, adjusted Rand index; classes DataFrame - model,
+                 label column, label value, support, predicted, precision, recall, f1)
+        """
+        if ids is None:
+            ids, clusters = self.number_clusters(assignments)
+        n_clusters = len(clusters)
+        model_of_cluster = pd.factorize(clusters['model'])[0]
+        models = list(assignments)
+        starts = np.searchsorted(model_of_cluster, np.arange(len(models)))
+
+        contingency_frames, metrics_frames, classes_frames = [], [], []
+        for column in self.label_columns:
+            values = np.asarray(self.categories[column], dtype=object)
+            n_values = len(values)
+            counts = self.tally(ids, self.codes[column], n_clusters, n_values)
+            support = np.bincount(self.codes[column], minlength=n_values)
+
+            nonzero = np.nonzero(counts)
+            contingency_frames.append(pd.DataFrame({
+                'model': clusters['model'].to_numpy()[nonzero[0]],
+                'cluster': clusters['cluster'].to_numpy()[nonzero[0]],
+                'label_column': column, 'label': values[nonzero[1]], 'count': counts[nonzero]}))
+
+            # purity and adjusted Rand index from the contingency table of every model:
+            majority = counts.argmax(axis=1)
+            purity = np.add.reduceat(counts.max(axis=1), starts) / self.n_rows
+            index = np.add.reduceat(comb2(counts).sum(axis=1), starts)
+            cluster_pairs = np.add.reduceat(comb2(counts.sum(axis=1)), starts)
+            label_pairs = comb2(support).sum()
+            expected = cluster_pairs * label_pairs / comb2(self.n_rows)
+            maximum = (cluster_pairs + label_pairs) / 2
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ari = np.where(maximum != expected, (index - expected) / (maximum - expected), 1.0)
+            metrics_frames.append(pd.DataFrame({'model': models, 'label_column': column,
+                                                'n_clusters': np.bincount(model_of_cluster, minlength=len(models)),
+                                                'purity': purity, 'adjusted_rand_index': ari}))
+
+            # majority mapping - every cluster predicts its most frequent label value:
+            keys = model_of_cluster * n_values + majority
+            predicted = np.bincount(keys, weights=counts.sum(axis=1), minlength=len(models) * n_values)
+            true_positive = np.bincount(keys, weights=counts[np.arange(n_clusters), majority],
+                                        minlength=len(models) * n_values)
+            classes = pd.DataFrame({'model': np.repeat(models, n_values), 'label_column': column,
+                                    'label': np.tile(values, len(models)), 'support': np.tile(support, len(models)),
+                                    'predicted': predicted.astype(np.int64)})
+            with np.errstate(invalid='ignore', divide='ignore'):
+                classes['precision'] = np.where(predicted > 0, true_positive / predicted, 0.0)
+                classes['recall'] = true_positive / np.tile(support, len(models))
+                classes['f1'] = np.where(classes['precision'] + classes['recall'] > 0, 2 * classes['precision'] *
+                                         classes['recall'] / (classes['precision'] + classes['recall']), 0.0)
+            classes_frames.append(classes)
+        return pd.concat(contingency_frames, ignore_index=True), pd.concat(metrics_frames, ignore_index=True), \
+            pd.concat(classes_frames, ignore_index=True)
+
+
+def model_names(model_files):
+    """
+    :return: name of every model file - the shortest suffix of its path without extension which no other model file
+             shares (e.g. <key>/scores for model/<key>/scores.csv files of workflow.py)
+    :raises: ValueError if two model files have the same path without extension
+    """
+    paths = [os.path.splitext(os.path.abspath(model_file))[0].split(os.sep) for model_file in model_files]
+    names = []
+    for model_file, path in zip(model_files, paths):
+        for length in range(1, len(path) + 1):
+            if sum(other[-length:] == path[-length:] for other in paths) == 1:
+                names.append('/'.join(path[-length:]))
+                break
+        else:
+            raise ValueError('{} is given more than once (models are named by their paths without extension)'.format(
+                model_file))
+    return names
+
+
+def load_assignments(model_files, df):
+    """
+    :param model_files: cluster_model.py models (.npz), label arrays (.npy) or CSV files with a cluster column
+    :return: { model name (see model_names) -> labels of rows of df }
+    """
+    assignments = {}
+    for model_file, name in zip(model_files, model_names(model_files)):
+        if model_file.endswith('.npz'):
+            assignments[name] = ClusterModel.load(model_file).score_frame(df)['cluster'].to_numpy()
+        elif model_file.endswith('.npy'):
+            assignments[name] = np.load(model_file)
+        else:
+            scores = pd.read_csv(model_file, usecols=['connection.uid', 'cluster']).drop_duplicates('connection.uid')
+            assignments[name] = df[['connection.uid']].merge(scores, how='left', on='connection.uid')['cluster'] \
+                .fillna(-1).astype(np.int64).to_numpy()
+        if len(assignments[name]) != len(df):
+            raise ValueError('{} has {} labels, the input has {} rows'.format(model_file, len(assignments[name]),
+                                                                              len(df)))
+    return assignments
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='Neighbourhood CSV file with label columns', type=str, required=True)
+    parser.add_argument('-m', '--models', help='Models (.npz), label arrays (.npy) or scores CSV files (globs are '
+                        'expanded)', nargs='+', required=True)
+    parser.add_argument('-o', '--output_directory', help='Output directory', type=str, default='cluster_profiles')
+    parser.add_argument('-nc', '--numerical_columns', help='Columns profiled by means (default: numerical columns)',
+                        nargs='+', default=None)
+    parser.add_argument('-cc', '--categorical_columns', help='Columns profiled by modes (default: other columns)',
+                        nargs='+', default=None)
+    parser.add_argument('-lc', '--label_columns', help='Label columns', nargs='+', default=LABEL_COLUMNS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    df = pd.read_csv(args.input_csv, low_memory=False)
+    model_files = [path for pattern in args.models for path in (sorted(glob.glob(pattern)) or [pattern])]
+    assignments = load_assignments(model_files, df)
+    profiler = ClusterProfiler(df, args.numerical_columns, args.categorical_columns, args.label_columns)
+    cluster_ids, cluster_table = profiler.number_clusters(assignments)
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    profiler.profiles(assignments, cluster_ids, cluster_table).to_csv(
+        os.path.join(args.output_directory, PROFILES_FILE), index=False, header=True)
+    if profiler.label_columns:
+        contingency, metrics, classes = profiler.evaluate(assignments, cluster_ids, cluster_table)
+        contingency.to_csv(os.path.join(args.output_directory, CONTINGENCY_FILE), index=False, header=True)
+        metrics.to_csv(os.path.join(args.output_directory, METRICS_FILE), index=False, header=True)
+        classes.to_csv(os.path.join(args.output_directory, CLASSES_FILE), index=False, header=True)
+        print(metrics.to_string(index=False))
+    print('Successfully wrote profiles of {} clusters of {} models to directory {}.'.format(
+        len(cluster_table), len(assignments), args.output_directory))
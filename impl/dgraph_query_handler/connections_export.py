@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Single-scan export of all connections ('EXPORT mode' of query_handler.py) and per-host views derived from it.
+
+The CONNECTIONS mode fetches every connection twice (as originated by its originator and as responded by its
+responder, each time with its connection.produced app data) by a separate query of every host. The export scans
+type(Connection) once ordered by uid - a page starts after the last uid of the previous page, so no offset has to be
+skipped by Dgraph - and resolves both hosts of a connection by the reverse edges in the same query. Connections are
+written once to the table <output_path>-connections.csv with the columns of CONNECTIONS mode output files.
+
+Files output-o-<IP>.csv and output-r-<IP>.csv are then derived locally from the table. As in the CONNECTIONS mode
+output, the host of the file is in the originated_ip column and its peer in the responded_ip column also in the
+output-r-<IP>.csv files.
+
+Usage: $ python3 connections_export.py -i output-connections.csv -od <output_directory> -of output
+         [--ips_csv host_ips.csv -cs 200000]
+"""
+
+import argparse
+import concurrent.futures
+import pandas as pd
+
+
+EXPORT_TABLE_SUFFIX = '-connections.csv'
+
+# export starts after the smallest uid:
+FIRST_UID = '0x0'
+
+
+def convert_and_append_page(file_name, convert_func, page):
+    convert_func(page).to_csv(file_name, mode='a', index=False, header=False)
+
+
+def export_connections(fetch_page_func, convert_func, file_name, columns, page_size):
+    """
+    Scan all connections page by page and write them to one CSV table. Flattening and writing of a page overlap with
+    fetching of the next page.
+
+    :param fetch_page_func: function (after uid, first) -> responses.ConnectionsPage
+    :param convert_func: function (responses.ConnectionsPage) -> DataFrame with the columns
+    :param file_name: output CSV table
+    :param columns: columns of the table
+    :param page_size: number of connections in one page
+    :return: number of exported connections
+    """
+    pd.DataFrame(columns=columns).to_csv(file_name, index=False, header=True)
+
+    exported = 0
+    after = FIRST_UID
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        while True:
+            page = fetch_page_func(after, page_size)
+            if pending is not None:
+                pending.result()
+                pending = None
+            if len(page):
+                pending = executor.submit(convert_and_append_page, file_name, convert_func, page)
+                exported += len(page)
+                after = page.uids[-1]
+                print('Exported {} connections (last uid {}).'.format(exported, after))
+            if len(page) < page_size:
+                break
+        if pending is not None:
+            pending.result()
+    return exported
+
+
+def derive_host_views(table_file, output_path, host_ips=None, chunk_size=200000, writer=None):
+    """
+    Split the connections table to CONNECTIONS mode files output-o-<IP>.csv (originated connections of the host) and
+    output-r-<IP>.csv (responded connections of the host). Values are copied as text, so the files are the same as
+    files written by the CONNECTIONS mode.
+
+    :param host_ips: IP addresses of hosts whose files are written (all hosts if None)
+    :param writer: partitioned_output.PartitionedWriter - connections are written to blocks of the partitioned
+                   dataset instead of files
+    :return: list of written files (of (host IP, direction) of written blocks with a writer)
+    """
+    host_ips = set(host_ips) if host_ips is not None else None
+    written = []
+    written_set = set()
+    for chunk in pd.read_csv(table_file, chunksize=chunk_size, dtype=str, keep_default_na=False):
+        responded_view = chunk.rename(columns={'originated_ip': 'responded_ip', 'responded_ip': 'originated_ip'})
+        for direction, view in [('o', chunk), ('r', responded_view[chunk.columns])]:
+            for host_ip, rows in view.groupby('originated_ip', sort=False):
+                # connections without a resolved host (missing reverse edge) have no file:
+                if not host_ip or (host_ips is not None and host_ip not in host_ips):
+                    continue
+                if writer is not None:
+                    writer.write_host(host_ip, direction, rows)
+                    written.append((host_ip, direction))
+                    continue
+                file_name = output_path + '-' + direction + '-' + str(host_ip) + '.csv'
+                new_file = file_name not in written_set
+                rows.to_csv(file_name, mode='w' if new_file else 'a', index=False, header=new_file)
+                if new_file:
+                    written_set.add(file_name)
+                    written.append(file_name)
+    return written
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='Connections table written by the EXPORT mode', type=str,
+                        required=True)
+    parser.add_argument('-of', '--output_file', help='Output CSV file name prefix', type=str, default='output')
+    parser.add_argument('-od', '--output_directory', help='Output directory path', type=str, default='.')
+    parser.add_argument('--ips_csv', help='Path to CSV file with host IPs (default: all hosts)', type=str,
+                        default=None)
+    parser.add_argument('-cs', '--chunk_size', help='Number of rows read from CSV at once', type=int, default=200000)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    ips = None
+    if args.ips_csv:
+        with open(args.ips_csv, 'r') as ips_file:
+            ips = [host_ip.strip() for host_ip in ips_file if host_ip.strip()]
+
+    files = derive_host_views(args.input_csv, args.output_directory + '/' + args.output_file, ips, args.chunk_size)
+    print('Successfully wrote {} files.'.format(len(files)))
@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+DBSCAN parameter sweep over a cached epsilon-neighbour graph.
+
+Running DBSCAN for every eps/min_samples combination repeats the expensive part - the radius neighbour search - for
+every grid point. Here the spatial index (KD-tree or ball tree) is built once and the sparse radius neighbour graph
+(distances of all pairs closer than the largest eps of the sweep) is computed once. The graph of a smaller eps is
+the same graph with distances above eps dropped, so every grid point is clustered from the cached graph by DBSCAN
+with a precomputed sparse metric (the result is the same as running DBSCAN on the data).
+
+The graph and the result of every grid point are stored in the sweep directory, so an interrupted sweep can be
+resumed (the graph is reused if it was computed for the same data and at least the same eps, results of grid points
+are removed if the data changed):
+
+  <sweep directory>/
+      graph.npz                           radius neighbour graph (scipy CSR matrix of distances)
+      graph.json                          eps, number of rows and fingerprint of the data of the graph
+      labels_eps-<eps>_ms-<ms>.npy        labels of a grid point (-1 = noise)
+      sweep.csv                           eps, min_samples, number of clusters, number of noise points, time
+
+Usage: $ python3 dbscan_sweep.py -fs feature_store -ng CONN_NUMERICAL_COLS CONN_APP_STATS -o dbscan_sweep
+         -e 1.0 1.5 2.0 -ms 1000 4000 [-pc 150 -a kd_tree -j -1]
+"""
+
+import os
+import glob
+import time
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import orjson as json
+from scipy import sparse
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+
+GRAPH_FILE = 'graph.npz'
+GRAPH_META_FILE = 'graph.json'
+SWEEP_FILE = 'sweep.csv'
+
+
+def data_fingerprint(X):
+    """
+    :return: hash of the shape and of a strided sample of rows (identifies the data the graph was computed for)
+    """
+    step = max(1, X.shape[0] // 1000)
+    digest = hashlib.sha1(str(X.shape).encode())
+    digest.update(np.ascontiguousarray(X[::step], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def build_radius_graph(X, max_eps, algorithm='kd_tree', leaf_size=40, n_jobs=None):
+    """
+    Build the spatial index and compute the radius neighbour graph.
+
+    :param X: data matrix (rows x features)
+    :param max_eps: the largest eps of the sweep
+    :param algorithm: 'kd_tree' or 'ball_tree'
+    :return: CSR matrix with distances of all pairs of different rows closer than max_eps, entries of each row are
+             sorted by distance
+    """
+    index = NearestNeighbors(radius=max_eps, algorithm=algorithm, leaf_size=leaf_size, n_jobs=n_jobs).fit(X)
+    graph = index.radius_neighbors_graph(mode='distance', sort_results=True)
+    return graph.tocsr()
+
+
+def threshold_graph(graph, eps):
+    """
+    :return: graph with entries of distance <= eps (explicit zero distances of duplicate rows are kept)
+    """
+    keep = graph.data <= eps
+    rows = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+    indptr = np.zeros(graph.shape[0] + 1, dtype=graph.indptr.dtype)
+    np.cumsum(np.bincount(rows[keep], minlength=graph.shape[0]), out=indptr[1:])
+    return sparse.csr_matrix((graph.data[keep], graph.indices[keep], indptr), shape=graph.shape)
+
+
+def remove_results(directory):
+    """
+    Remove labels of grid points and the sweep results (computed for other data).
+    """
+    result_files = glob.glob(os.path.join(directory, 'labels_eps-*_ms-*.npy'))
+    if os.path.exists(os.path.join(directory, SWEEP_FILE)):
+        result_files.append(os.path.join(directory, SWEEP_FILE))
+    for result_file in result_files:
+        os.remove(result_file)
+    if result_files:
+        print('Removed {} results of a sweep over other data from {}.'.format(len(result_files), directory))
+
+
+def load_or_build_graph(X, max_eps, directory, algorithm='kd_tree', leaf_size=40, n_jobs=None):
+    """
+    :return: radius neighbour graph for eps <= max_eps, loaded from the directory if it was computed for the same
+             data and at least the same eps, computed (and stored) otherwise. Results of grid points in the directory
+             are removed if they were not computed for the same data (unknown data included).
+    """
+    fingerprint = data_fingerprint(X)
+    graph_file = os.path.join(directory, GRAPH_FILE)
+    meta_file = os.path.join(directory, GRAPH_META_FILE)
+
+    meta = None
+    if os.path.exists(meta_file):
+        with open(meta_file, 'rb') as file:
+            meta = json.loads(file.read())
+    if meta is None or meta['fingerprint'] != fingerprint:
+        remove_results(directory)
+    elif os.path.exists(graph_file) and meta['max_eps'] >= max_eps:
+        print('Reusing radius neighbour graph (eps {}) from {}.'.format(meta['max_eps'], graph_file))
+        return sparse.load_npz(graph_file)
+
+    start = time.perf_counter()
+    graph = build_radius_graph(X, max_eps, algorithm, leaf_size, n_jobs)
+    print('Radius neighbour graph (eps {}, {} edges) computed in {:.2f} s.'.format(max_eps, graph.nnz,
+                                                                                  time.perf_counter() - start))
+    sparse.save_npz(graph_file, graph, compressed=False)
+    with open(meta_file, 'wb') as file:
+        file.write(json.dumps({'max_eps': max_eps, 'n_rows': X.shape[0], 'fingerprint': fingerprint}))
+    return graph
+
+
+def labels_file_name(directory, eps, min_samples):
+    return os.path.join(directory, 'labels_eps-{}_ms-{}.npy'.format(eps, min_samples))
+
+
+def run_sweep(X, eps_values, min_samples_values, directory, algorithm='kd_tree', leaf_size=40, n_jobs=None):
+    """
+    Cluster the data for every combination of eps and min_samples (grid points finished by a previous run of the
+    same sweep are skipped).
+
+    :return: DataFrame with columns eps, min_samples, n_clusters, n_noise, seconds
+    """
+    os.makedirs(directory, exist_ok=True)
+    graph = load_or_build_graph(X, max(eps_values), directory, algorithm, leaf_size, n_jobs)
+
+    sweep_file = os.path.join(directory, SWEEP_FILE)
+    columns = ['eps', 'min_samples', 'n_clusters', 'n_noise', 'seconds']
+    rows = pd.read_csv(sweep_file).to_dict('records') if os.path.exists(sweep_file) else []
+
+    for eps in sorted(eps_values, reverse=True):
+        eps_graph = None
+        for min_samples in min_samples_values:
+            labels_file = labels_file_name(directory, eps, min_samples)
+            if os.path.exists(labels_file):
+                print('eps {}, min_samples {}: already computed.'.format(eps, min_samples))
+                continue
+
+            if eps_graph is None:
+                eps_graph = threshold_graph(graph, eps)
+
+            start = time.perf_counter()
+            dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed', n_jobs=n_jobs)
+            labels = dbscan.fit(eps_graph).labels_
+            seconds = time.perf_counter() - start
+            np.save(labels_file, labels)
+
+            row = {'eps': eps, 'min_samples': min_samples, 'n_clusters': int(labels.max()) + 1,
+                   'n_noise': int(np.count_nonzero(labels == -1)), 'seconds': seconds}
+            rows.append(row)
+            pd.DataFrame(rows, columns=columns).to_csv(sweep_file, index=False, header=True)
+            print('eps {}, min_samples {}: {} clusters, {} noise points ({:.2f} s).'.format(
+                eps, min_samples, row['n_clusters'], row['n_noise'], seconds))
+
+    return pd.DataFrame(rows, columns=columns).sort_values(['eps', 'min_samples']).reset_index(drop=True)
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-fs', '--feature_store', help='Feature store directory (see feature_store.py)', type=str,
+                        required=True)
+    parser.add_argument('-ng', '--numerical_groups', help='Column groups of features', nargs='+', required=True)
+    parser.add_argument('-o', '--output_directory', help='Sweep directory (graph, labels, results)', type=str,
+                        required=True)
+    parser.add_argument('-e', '--eps', help='eps values', type=float, nargs='+', required=True)
+    parser.add_argument('-ms', '--min_samples', help='min_samples values', type=int, nargs='+', required=True)
+    parser.add_argument('-pc', '--pca_components', help='Cluster first principal components', type=int, default=None)
+    parser.add_argument('-a', '--algorithm', help='Spatial index', choices=['kd_tree', 'ball_tree'], default='kd_tree')
+    parser.add_argument('-j', '--n_jobs', help='Number of parallel jobs of the neighbour search', type=int,
+                        default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import feature_store
+
+    args = define_arguments()
+    store = feature_store.FeatureStore(args.feature_store)
+    data = np.asarray(store.numeric_groups(*args.numerical_groups), dtype=np.float64)
+    if args.pca_components:
+        from sklearn.decomposition import PCA
+        data = PCA(n_components=args.pca_components, random_state=2018).fit_transform(data)
+
+    result = run_sweep(data, args.eps, args.min_samples, args.output_directory, args.algorithm, n_jobs=args.n_jobs)
+    print(result)
@@ -2,39 +2,166 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+import time
+import random
+import threading
+import concurrent.futures
+import grpc
 import pydgraph  # official communication module for Dgraph database
 
 
+# gRPC message compression algorithms usable in DgraphClient.connect (Dgraph is a grpc-go server, which registers
+# only the gzip compressor - requests compressed by other algorithms are rejected):
+GRPC_COMPRESSION = {
+    'none': grpc.Compression.NoCompression,
+    'gzip': grpc.Compression.Gzip
+}
+
+# gRPC status codes of errors which may disappear when the query is repeated (alpha restarting, overloaded, ...):
+TRANSIENT_STATUS_CODES = {
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.ABORTED
+}
+
+
+class DgraphQueryError(RuntimeError):
+    """
+    Query failed permanently (e.g. invalid query), repeating it does not help.
+    """
+
+
+class DgraphUnavailableError(DgraphQueryError):
+    """
+    Query failed by a transient error on all attempts.
+    """
+
+
+def is_transient_error(error):
+    """
+    :return: True if the error of a query may disappear when the query is repeated
+    """
+    if isinstance(error, (pydgraph.errors.AbortedError, pydgraph.errors.RetriableError,
+                          pydgraph.errors.ConnectionError)):
+        return True
+    code = getattr(error, 'code', None)
+    return callable(code) and code() in TRANSIENT_STATUS_CODES
+
+
 class DgraphClient:
     """
     The main Dgraph client class allowing to connect to the database and perform queries.
 
-    :ivar client_stub: PyDgraph client to store connection details
-    :ivar dgraph: initialized PyDgraph client object
+    Queries are balanced over all connected alphas (round robin). Transient errors are retried with bounded
+    exponential backoff (on the next alpha), permanent errors are raised immediately. Read-only queries slower than
+    hedge_after seconds are hedged - the same query is sent to the next alpha and the first answer is used.
+
+    :ivar client_stubs: PyDgraph client stubs of all endpoints
+    :ivar dgraph: initialized PyDgraph client object of each endpoint
+    :ivar addresses: addresses of endpoints (<ip>:<port>)
     """
 
-    def __init__(self):
-        self.client_stub = None
-        self.dgraph = None
+    def __init__(self, retries: int = 3, backoff: float = 0.5, max_backoff: float = 10.0, hedge_after: float = None,
+                 timeout: float = None, stub_factory=pydgraph.DgraphClientStub, sleep_func=time.sleep):
+        """
+        :param retries: number of repeated attempts of a query failed by a transient error
+        :param backoff: delay before the first repeated attempt in seconds (doubled for every next attempt)
+        :param max_backoff: maximum delay between attempts in seconds
+        :param hedge_after: send the query also to the next endpoint if there is no answer after this number of
+                            seconds (None = no hedging)
+        :param timeout: gRPC deadline of one attempt in seconds (None = no deadline)
+        :param stub_factory: function (address, options) -> client stub (pydgraph.DgraphClientStub, or a fake one)
+        :param sleep_func: function (seconds) -> None
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.stub_factory = stub_factory
+        self.sleep_func = sleep_func
 
-    def connect(self, ip: str, port: int):
+        self.client_stubs = []
+        self.dgraph = []
+        self.addresses = []
+        self._next = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def connect(self, ip: str, port: int, compression: str = 'none', endpoints: list = None):
         """
         Establish connection to Dgraph database server.
 
         :param ip: IP address of the Dgraph server.
         :param port: Port of the Dgraph server.
+        :param compression: gRPC message compression (one of GRPC_COMPRESSION keys). Dgraph answers gzip compressed
+                            requests with gzip compressed responses, which cuts bytes on the wire for large query
+                            results.
+        :param endpoints: addresses (<ip>:<port>) of all alphas to balance queries over, ip and port are used if not
+                          given.
         :raises: ConnectionError if connection was not established.
         """
-        # destroy previous Dgraph connection:
-        if self.client_stub:
-            self.client_stub.close()
+        # destroy previous Dgraph connections:
+        self.close()
+
+        self.addresses = list(endpoints) if endpoints else ['{0}:{1}'.format(ip, port)]
+        for address in self.addresses:
+            # initialize Dgraph server connection (set GRPC with maximum values):
+            client_stub = self.stub_factory(address, options=[
+                ('grpc.max_send_message_length', 1024 * 1024 * 1024),
+                ('grpc.max_receive_message_length', 1024 * 1024 * 1024),
+                ('grpc.default_compression_algorithm', GRPC_COMPRESSION[compression])
+            ])
+            self.client_stubs.append(client_stub)
+            self.dgraph.append(pydgraph.DgraphClient(client_stub))
 
-        # initialize Dgraph server connection (set GRPC with maximum values):
-        self.client_stub = pydgraph.DgraphClientStub('{0}:{1}'.format(ip, port), options=[
-            ('grpc.max_send_message_length', 1024 * 1024 * 1024),
-            ('grpc.max_receive_message_length', 1024 * 1024 * 1024)
-        ])
-        self.dgraph = pydgraph.DgraphClient(self.client_stub)
+    def close(self):
+        for client_stub in self.client_stubs:
+            client_stub.close()
+        self.client_stubs = []
+        self.dgraph = []
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def _next_endpoint(self):
+        with self._lock:
+            endpoint = self._next % len(self.dgraph)
+            self._next += 1
+        return endpoint
+
+    def _query_endpoint(self, endpoint: int, query: str, variables: dict = None) -> str:
+        txn = self.dgraph[endpoint].txn(read_only=True)
+        try:
+            return txn.query(query, variables, timeout=self.timeout).json
+        finally:
+            txn.discard()
+
+    def _get_executor(self):
+        # the executor is not usable in a process forked after its creation (NEIGHBOURHOOD mode workers):
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='dgraph-hedge')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _hedged_query(self, query: str, variables: dict = None) -> str:
+        executor = self._get_executor()
+        futures = [executor.submit(self._query_endpoint, self._next_endpoint(), query, variables)]
+        done, _ = concurrent.futures.wait(futures, timeout=self.hedge_after)
+        if not done:
+            futures.append(executor.submit(self._query_endpoint, self._next_endpoint(), query, variables))
+
+        # the first successful answer is used, an error is raised only if all attempts failed:
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                return future.result()
+            except Exception as e:
+                error = error or e
+        raise error
 
     def query(self, query: str, variables: dict = None) -> str:
         """
@@ -43,31 +170,37 @@ class DgraphClient:
         :param query: query string to perform
         :param variables: dictionary with variable values
         :return: obtained response as a JSON string
-        :raises: RuntimeError if database is not connected or the transaction fails
+        :raises: RuntimeError if database is not connected, DgraphQueryError if the query fails permanently,
+                 DgraphUnavailableError if all attempts fail by transient errors
         """
         # check if the database connection is initialized:
         if not self.dgraph:
             raise RuntimeError('Dgraph database is not connected.')
 
-        try:
-            txn = self.dgraph.txn(read_only=True)
-            result = txn.query(query, variables)
-        except Exception as e:
-            raise RuntimeError('Dgraph query failed: ' + str(e))
-        finally:
-            txn.discard()
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                if self.hedge_after is not None and len(self.dgraph) > 1:
+                    return self._hedged_query(query, variables)
+                return self._query_endpoint(self._next_endpoint(), query, variables)
+            except Exception as e:
+                if not is_transient_error(e):
+                    raise DgraphQueryError('Dgraph query failed: ' + str(e)) from e
+                if attempt == self.retries:
+                    raise DgraphUnavailableError('Dgraph query failed after {} attempts: {}'.format(
+                        attempt + 1, str(e))) from e
 
-        return result.json
+                # full jitter, so that retries of parallel workers do not hit the alphas at the same time:
+                wait = random.uniform(0, delay)
+                print('Transient Dgraph error ({}), retrying in {:.2f} s.'.format(str(e).splitlines()[0], wait))
+                self.sleep_func(wait)
+                delay = min(2 * delay, self.max_backoff)
 
 
 def handle_query(client, query_body: str, query_header: str = '', variables: dict = None):
     """
     General function to process a Dgraph query. Result is provided as a JSON response or
-    extended by graph data according to desired query type.
+    extended by graph data according to desired query type. Errors are raised (transient errors are retried by
+    the client).
     """
-    try:
-        query_result = client.query(query_header + query_body, variables)
-        return query_result
-    except Exception as e:
-        print('Exception thrown: ' + str(e))
-    return None
+    return client.query(query_header + query_body, variables)
@@ -5,14 +5,10 @@
 def handle_query(client, query_body: str, query_header: str = '', variables: dict = None):
     """
     General function to process a Dgraph query. Result is provided as a JSON response or
-    extended by graph data according to desired query type.
+    extended by graph data according to desired query type. Errors are raised (transient errors are retried by
+    the client), so that a failed page is never mistaken for the end of pagination.
     """
-    try:
-        query_result = client.query(query_header + query_body, variables)
-        return query_result
-    except Exception as e:
-        print('Exception thrown: ' + str(e))
-    return None
+    return client.query(query_header + query_body, variables)
 
 
 def query_get_host_ips(client):
@@ -24,12 +20,69 @@ def query_get_host_ips(client):
     return handle_query(client, query_body=query_body)
 
 
-def generate_connections_simple_query(direction):
+def query_host_connection_counts(client):
+    query_body = """{
+      queryHostCounts(func: type(Host)) {
+        host.ip
+        originated_count : count(host.originated)
+        responded_count : count(host.responded)
+      }
+    }"""
+    return handle_query(client, query_body=query_body)
+
+
+# projection profiles of host connections queries (how much of connection.produced app data is fetched):
+#   core             - only connection.* predicates
+#   core+app_counts  - core + types of produced app data (enough for <app>_count columns)
+#   core+app         - core + app data attributes used by the flattening (pandas_funcs.convert_json_to_csv_conns)
+#   full             - core + all predicates of produced app data and files
+PROJECTION_PROFILES = ['core', 'core+app_counts', 'core+app', 'full']
+
+APP_DATA_PREDICATES = {
+    'dns': ['dns.qtype', 'dns.rcode'],
+    'ssh': ['ssh.auth_attempts', 'ssh.host_key'],
+    'http': ['http.method', 'http.status_code', 'http.user_agent'],
+    'ssl': ['ssl.version', 'ssl.cipher', 'ssl.curve', 'ssl.validation_status'],
+    'files': ['files.source', 'files.fuid { file.md5 }']
+}
+
+
+def generate_produced_projection(profile='full', app_families=None):
+    """
+    Generate connection.produced part of the host connections query.
+
+    :param profile: one of PROJECTION_PROFILES
+    :param app_families: app data names (keys of APP_DATA_PREDICATES) fetched in the 'core+app' profile, all by default
+    """
+    if profile == 'core':
+        return ''
+    if profile == 'core+app_counts':
+        return 'connection.produced { type: dgraph.type }'
+    if profile == 'core+app':
+        app_families = app_families or list(APP_DATA_PREDICATES)
+        predicates = [predicate for app_family in app_families for predicate in APP_DATA_PREDICATES[app_family]]
+        return 'connection.produced {{ type: dgraph.type {} }}'.format(' '.join(predicates))
+    return """connection.produced {
+            expand(_all_)
+            type: dgraph.type
+            
+            files.fuid {
+              expand(File)
+            }
+          }"""
+
+
+def generate_connections_simple_query(direction, time_range=False, profile='full', app_families=None):
     reverse_direction = 'responded' if direction == 'originated' else 'originated'
+    # time range (one time shard of a host): connections in [$ts_start, $ts_end) ordered by time
+    edge_arguments = '(offset: $offset, first: $first, orderasc: connection.ts) ' \
+                     '@filter(ge(connection.ts, $ts_start) AND lt(connection.ts, $ts_end))' if time_range \
+        else '(offset: $offset, first: $first)'
+    produced_projection = generate_produced_projection(profile, app_families)
     return f"""{{
       queryHost{direction.capitalize()}(func: eq(host.ip, $ip)) {{ 
         originated_ip : host.ip 
-        host.{direction} (offset: $offset, first: $first) {{
+        host.{direction} {edge_arguments} {{
           uid
           connection.uid
           connection.conn_state
@@ -46,14 +99,7 @@ def generate_connections_simple_query(direction):
           connection.service
           connection.ts
           
-          connection.produced {{
-            expand(_all_)
-            type: dgraph.type
-            
-            files.fuid {{
-              expand(File)
-            }}
-          }}
+          {produced_projection}
 
           ~host.{reverse_direction} {{
             responded_ip : host.ip
@@ -63,22 +109,136 @@ def generate_connections_simple_query(direction):
     }}"""
 
 
-def query_host_originated_connections_simple(client, ip: str, offset: str, first: str):
+def query_host_originated_connections_simple(client, ip: str, offset: str, first: str, profile: str = 'full',
+                                             app_families: list = None):
     query_header = 'query queryHostOriginated($ip: string, $offset: string, $first: string)'
-    query_body = generate_connections_simple_query('originated')
+    query_body = generate_connections_simple_query('originated', profile=profile, app_families=app_families)
     variables_dict = {'$ip': ip, '$offset': offset, '$first': first}
 
     return handle_query(client, query_body=query_body, query_header=query_header, variables=variables_dict)
 
 
-def query_host_responded_connections_simple(client, ip: str, offset: str, first: str):
+def query_host_originated_connections_in_time_range(client, ip: str, offset: str, first: str, ts_start: str,
+                                                    ts_end: str, profile: str = 'full', app_families: list = None):
+    query_header = 'query queryHostOriginated($ip: string, $offset: string, $first: string, $ts_start: string, ' \
+                   '$ts_end: string)'
+    query_body = generate_connections_simple_query('originated', time_range=True, profile=profile,
+                                                   app_families=app_families)
+    variables_dict = {'$ip': ip, '$offset': offset, '$first': first, '$ts_start': ts_start, '$ts_end': ts_end}
+
+    return handle_query(client, query_body=query_body, query_header=query_header, variables=variables_dict)
+
+
+def query_host_originated_ts_at_offset(client, ip: str, offset: str):
+    query_header = 'query queryHostTsAtOffset($ip: string, $offset: string)'
+    query_body = """{
+      queryHostTsAtOffset(func: eq(host.ip, $ip)) {
+        host.originated (orderasc: connection.ts, offset: $offset, first: 1) {
+          connection.ts
+        }
+      }
+    }"""
+    variables_dict = {'$ip': ip, '$offset': offset}
+
+    return handle_query(client, query_body=query_body, query_header=query_header, variables=variables_dict)
+
+
+def query_host_responded_connections_simple(client, ip: str, offset: str, first: str, profile: str = 'full',
+                                            app_families: list = None):
     query_header = 'query queryHostResponded($ip: string, $offset: string, $first: string)'
-    query_body = generate_connections_simple_query('responded')
+    query_body = generate_connections_simple_query('responded', profile=profile, app_families=app_families)
     variables_dict = {'$ip': ip, '$offset': offset, '$first': first}
 
     return handle_query(client, query_body=query_body, query_header=query_header, variables=variables_dict)
 
 
+def generate_connections_since_query(profile='full', app_families=None):
+    produced_projection = generate_produced_projection(profile, app_families)
+    return f"""{{
+      queryConnectionsSince(func: gt(connection.ts, $ts_start), orderasc: connection.ts, offset: $offset,
+                            first: $first) {{
+        uid
+        connection.uid
+        connection.conn_state
+        connection.duration
+        connection.orig_bytes
+        connection.orig_ip_bytes
+        connection.orig_p
+        connection.orig_pkts
+        connection.proto
+        connection.resp_bytes
+        connection.resp_ip_bytes
+        connection.resp_p
+        connection.resp_pkts
+        connection.service
+        connection.ts
+        
+        {produced_projection}
+
+        ~host.originated {{
+          originated_ip : host.ip
+        }}
+        ~host.responded {{
+          responded_ip : host.ip
+        }}
+      }}
+    }}"""
+
+
+def query_connections_since(client, ts_start: str, offset: str, first: str, profile: str = 'full',
+                            app_families: list = None):
+    """
+    Connections of all hosts with connection.ts newer than ts_start ordered by time (STREAMING mode polling).
+    """
+    query_header = 'query queryConnectionsSince($ts_start: string, $offset: string, $first: string)'
+    query_body = generate_connections_since_query(profile, app_families)
+    variables_dict = {'$ts_start': ts_start, '$offset': offset, '$first': first}
+
+    return handle_query(client, query_body=query_body, query_header=query_header, variables=variables_dict)
+
+
+# connection predicates fetched by the export query (in the order of CONNECTIONS mode output columns):
+CONNECTION_PREDICATES = ['connection.uid', 'connection.conn_state', 'connection.duration', 'connection.orig_bytes',
+                         'connection.orig_ip_bytes', 'connection.orig_p', 'connection.orig_pkts', 'connection.proto',
+                         'connection.resp_bytes', 'connection.resp_ip_bytes', 'connection.resp_p',
+                         'connection.resp_pkts', 'connection.service', 'connection.ts']
+
+
+def generate_connections_export_query(profile='full', app_families=None):
+    """
+    Generate a query for one page of all connections ordered by uid (uid cursor pagination - the page starts after
+    $after). Both hosts of a connection are resolved by the reverse edges, so every connection is fetched once.
+    """
+    produced_projection = generate_produced_projection(profile, app_families)
+    predicates = '\n        '.join(CONNECTION_PREDICATES)
+    return f"""{{
+      queryConnectionsExport(func: type(Connection), first: $first, after: $after) {{
+        uid
+        {predicates}
+        
+        {produced_projection}
+
+        ~host.originated {{
+          originated_ip : host.ip
+        }}
+        ~host.responded {{
+          responded_ip : host.ip
+        }}
+      }}
+    }}"""
+
+
+def query_connections_export(client, after: str, first: str, profile: str = 'full', app_families: list = None):
+    """
+    Page of all connections with uid greater than after (EXPORT mode scan).
+    """
+    query_header = 'query queryConnectionsExport($after: string, $first: string)'
+    query_body = generate_connections_export_query(profile, app_families)
+    variables_dict = {'$after': after, '$first': first}
+
+    return handle_query(client, query_body=query_body, query_header=query_header, variables=variables_dict)
+
+
 def generate_neighbourhood_query(first_direction, second_direction):
     reverse_direction = 'responded' if first_direction == 'originated' else 'originated'
     return f"""{{
@@ -247,10 +407,10 @@ def generate_conn_state_filter(orig_conn_state):
     :param orig_conn_state:
     :return:
     """
-    if orig_conn_state == 'RST0' or orig_conn_state == 'RSTR' or orig_conn_state == 'RSTOS0' \
+    if orig_conn_state == 'RSTO' or orig_conn_state == 'RSTR' or orig_conn_state == 'RSTOS0' \
             or orig_conn_state == 'RSTRH':
-        f'AND (eq(connection.conn_state, "RST0") OR eq(connection.conn_state, "RSTR") ' \
-        f'OR eq(connection.conn_state, "RSTOS0") OR eq(connection.conn_state, "RSTRH"))'
+        return f'AND (eq(connection.conn_state, "RSTO") OR eq(connection.conn_state, "RSTR") ' \
+               f'OR eq(connection.conn_state, "RSTOS0") OR eq(connection.conn_state, "RSTRH"))'
     elif orig_conn_state == 'SH' or orig_conn_state == 'SHR':
         return f'AND (eq(connection.conn_state, "SH") OR eq(connection.conn_state, "SHR"))'
     return f'AND eq(connection.conn_state, "{orig_conn_state}")'
@@ -309,7 +469,10 @@ def generate_ip_bytes_filter(bytes_str, orig_bytes):
     return f'AND ge(connection.{bytes_str}, {orig_bytes - 50}) AND le(connection.{bytes_str}, {orig_bytes + 50})'
 
 
-def generate_neighbourhood_similar_count_query(first_direction, second_direction, orig_attributes):
+def generate_similar_filters(orig_attributes):
+    """
+    :return: list of filters ('AND <condition>') of connections similar to the connection with orig_attributes
+    """
     # TODO: DEFINE SIMILARITY HERE!
 
     # categorical attributes filters
@@ -328,6 +491,12 @@ def generate_neighbourhood_similar_count_query(first_direction, second_direction
 
     # numerical in interval (duration, resp_bytes) if low num smaller window, if larger, larger window
 
+    return [protocol_filter, service_filter, conn_state_filter, duration_filter, orig_pkts_filter, resp_pkts_filter,
+            orig_bytes_filter, resp_bytes_filter, orig_ip_bytes_filter, resp_ip_bytes_filter]
+
+
+def generate_neighbourhood_similar_count_query(first_direction, second_direction, orig_attributes):
+    similar_filters = '\n                                            '.join(generate_similar_filters(orig_attributes))
     reverse_direction = 'responded' if first_direction == 'originated' else 'originated'
     return f"""{{
           querySimilarNeighbourhoodCount(func: uid($uid)) @cascade @normalize {{
@@ -335,16 +504,7 @@ def generate_neighbourhood_similar_count_query(first_direction, second_direction
             ~host.{first_direction} {{
               #{first_direction}_ip : host.ip
               host.{second_direction} @filter(between(connection.ts, $ts_start, $ts_end) 
-                                            {protocol_filter}
-                                            {service_filter}
-                                            {conn_state_filter}
-                                            {duration_filter}
-                                            {orig_pkts_filter}
-                                            {resp_pkts_filter}
-                                            {orig_bytes_filter}
-                                            {resp_bytes_filter}
-                                            {orig_ip_bytes_filter} 
-                                            {resp_ip_bytes_filter}) @normalize {{
+                                            {similar_filters}) @normalize {{
                 uids as math(1)
 
                 #~host.{reverse_direction} {{
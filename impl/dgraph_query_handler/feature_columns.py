@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Column names of the final neighbourhood dataset (FINAL_neighbourhood_*.csv) as constant lists, the same lists as
+defined in the model notebooks (model_kmeans.ipynb, model_kprototypes.ipynb, model_dbscan.ipynb).
+
+Neighbourhood blocks are prefixed by <orig/resp neighbourhood>_<originated/responded connections>_.
+"""
+
+
+NEIGHBOURHOOD_PREFIXES = ['orig_orig_', 'orig_resp_', 'resp_orig_', 'resp_resp_']
+
+# columns that contain values of the current main connection
+CONN_IDS_COLS = ['connection.uid', 'originated_ip', 'responded_ip']
+
+CONN_NUMERICAL_COLS = ['originated_ip_num',
+                       'responded_ip_num',
+                       'connection.time',
+                       'connection.duration',
+                       # originator details
+                       'connection.orig_bytes',
+                       'connection.orig_pkts',
+                       'connection.orig_ip_bytes',
+                       # responder details
+                       'connection.resp_bytes',
+                       'connection.resp_pkts',
+                       'connection.resp_ip_bytes']
+
+CONN_CATEGORICAL_COLS = ['connection.proto',
+                         'connection.service',
+                         'connection.conn_state']
+
+# categories of the main connection derived in preprocessing (used by k-prototypes instead of CONN_CATEGORICAL_COLS)
+CONN_DERIVED_CATEGORICAL_COLS = ['orig_p_cat', 'resp_p_cat', 'protocol', 'service', 'conn_state']
+
+CONN_APP_STATS = ['dns_count', 'ssh_count', 'http_count', 'ssl_count', 'files_count']
+
+# graph features of the connection computed from the CONNECTIONS mode output (host_graph.py):
+GRAPH_COLS = ['graph_orig_fan_out', 'graph_orig_unique_resp', 'graph_resp_fan_in', 'graph_resp_unique_orig',
+              'graph_orig_two_hop_reach', 'graph_resp_two_hop_reach']
+
+# labels and time in different format:
+BACKUP_COLS = ['attacker_label', 'attack_label', 'connection.ts']
+
+SIMILAR_ATTRIBUTES = ['dns_qtype', 'dns_rcode', 'ssh_auth_attempts', 'ssh_host_key', 'http_method', 'http_status_code',
+                      'http_user_agent', 'ssl_version', 'ssl_cipher', 'ssl_curve', 'ssl_validation_status',
+                      'files_source', 'file_md5']
+
+
+def neighbourhood_numerical_cols(prefix):
+    return [prefix + 'total',
+            prefix + 'connection.time_mean',
+            prefix + 'connection.duration_mean',
+            prefix + 'connection.orig_pkts_mean',
+            prefix + 'connection.orig_bytes_mean',
+            prefix + 'connection.resp_bytes_mean',
+            prefix + 'connection.resp_pkts_mean']
+
+
+def neighbourhood_categorical_cols(prefix):
+    return [prefix + 'connection.protocol_mode',
+            prefix + 'connection.service_mode',
+            prefix + 'connection.conn_state_mode']
+
+
+def neighbourhood_ports_cols(prefix):
+    return [prefix + 'orig_p_well_known_count',
+            prefix + 'orig_p_reg_or_dyn_count'] + \
+           [prefix + 'resp_p_' + str(port) + '_count' for port in [21, 22, 53, 80, 123, 443, 3389]] + \
+           [prefix + 'resp_p_well_known_count',
+            prefix + 'resp_p_reg_count',
+            prefix + 'resp_p_dyn_count']
+
+
+def neighbourhood_app_stats_cols(prefix):
+    return [prefix + app_stat + '_mean' for app_stat in CONN_APP_STATS]
+
+
+def neighbourhood_similar_cols(prefix):
+    return [prefix + 'similar_conns_count'] + \
+           [prefix + 'similar_' + attribute + '_count' for attribute in SIMILAR_ATTRIBUTES]
+
+
+# originator originated neighbourhood columns:
+ORIG_ORIG_NUMERICAL_COLS = neighbourhood_numerical_cols('orig_orig_')
+ORIG_ORIG_CATEGORICAL_COLS = neighbourhood_categorical_cols('orig_orig_')
+ORIG_ORIG_PORTS_COLS = neighbourhood_ports_cols('orig_orig_')
+ORIG_ORIG_APP_STATS_COLS = neighbourhood_app_stats_cols('orig_orig_')
+ORIG_ORIG_SIMILAR_COLS = neighbourhood_similar_cols('orig_orig_')
+
+# originator responded neighbourhood columns:
+ORIG_RESP_NUMERICAL_COLS = neighbourhood_numerical_cols('orig_resp_')
+ORIG_RESP_CATEGORICAL_COLS = neighbourhood_categorical_cols('orig_resp_')
+ORIG_RESP_PORTS_COLS = neighbourhood_ports_cols('orig_resp_')
+ORIG_RESP_APP_STATS_COLS = neighbourhood_app_stats_cols('orig_resp_')
+ORIG_RESP_SIMILAR_COLS = neighbourhood_similar_cols('orig_resp_')
+
+# responder originated neighbourhood columns:
+RESP_ORIG_NUMERICAL_COLS = neighbourhood_numerical_cols('resp_orig_')
+RESP_ORIG_CATEGORICAL_COLS = neighbourhood_categorical_cols('resp_orig_')
+RESP_ORIG_PORTS_COLS = neighbourhood_ports_cols('resp_orig_')
+RESP_ORIG_APP_STATS_COLS = neighbourhood_app_stats_cols('resp_orig_')
+RESP_ORIG_SIMILAR_COLS = neighbourhood_similar_cols('resp_orig_')
+
+# responder responded neighbourhood columns:
+RESP_RESP_NUMERICAL_COLS = neighbourhood_numerical_cols('resp_resp_')
+RESP_RESP_CATEGORICAL_COLS = neighbourhood_categorical_cols('resp_resp_')
+RESP_RESP_PORTS_COLS = neighbourhood_ports_cols('resp_resp_')
+RESP_RESP_APP_STATS_COLS = neighbourhood_app_stats_cols('resp_resp_')
+RESP_RESP_SIMILAR_COLS = neighbourhood_similar_cols('resp_resp_')
+
+
+def neighbourhood_column_groups(prefix):
+    name = prefix.upper()
+    return {name + 'NUMERICAL_COLS': neighbourhood_numerical_cols(prefix),
+            name + 'PORTS_COLS': neighbourhood_ports_cols(prefix),
+            name + 'APP_STATS_COLS': neighbourhood_app_stats_cols(prefix),
+            name + 'SIMILAR_COLS': neighbourhood_similar_cols(prefix),
+            name + 'CATEGORICAL_COLS': neighbourhood_categorical_cols(prefix)}
+
+
+# column groups in the order of the model input (dictionary { group name -> columns }):
+COLUMN_GROUPS = {
+    'CONN_IDS_COLS': CONN_IDS_COLS,
+    'CONN_NUMERICAL_COLS': CONN_NUMERICAL_COLS,
+    'CONN_CATEGORICAL_COLS': CONN_CATEGORICAL_COLS,
+    'CONN_DERIVED_CATEGORICAL_COLS': CONN_DERIVED_CATEGORICAL_COLS,
+    'CONN_APP_STATS': CONN_APP_STATS,
+    'GRAPH_COLS': GRAPH_COLS,
+    **neighbourhood_column_groups('orig_orig_'),
+    **neighbourhood_column_groups('orig_resp_'),
+    **neighbourhood_column_groups('resp_orig_'),
+    **neighbourhood_column_groups('resp_resp_'),
+    'BACKUP_COLS': BACKUP_COLS
+}
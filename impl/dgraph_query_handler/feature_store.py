@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Memory-mapped feature store of the final neighbourhood dataset.
+
+The model notebooks parse the whole (very wide) CSV file and filter the column groups they need afterwards. The
+store is written once at the end of the neighbourhood pipeline and the notebooks map only the columns they use:
+
+  <store directory>/
+      schema.json       number of rows, numeric and categorical columns, column groups, numeric dtype
+      numeric.bin       numeric features, float32/float64 matrix (rows x numeric columns) in column-major order
+      categorical.bin   int32 codes of categorical features (rows x categorical columns) in column-major order,
+                        -1 marks a missing value
+      dictionary.json   { categorical column -> list of categories (code = index in the list) }
+
+Columns are stored group after group (in the order of feature_columns.COLUMN_GROUPS), so a group - or several
+consecutive groups - is a contiguous block of the matrix and is returned as a view of the mapped file (no copy).
+
+Usage: $ python3 feature_store.py -i FINAL_neighbourhood_both_days.csv -o feature_store [-dt float64]
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import orjson as json
+import feature_columns
+
+
+SCHEMA_FILE = 'schema.json'
+NUMERIC_FILE = 'numeric.bin'
+CATEGORICAL_FILE = 'categorical.bin'
+DICTIONARY_FILE = 'dictionary.json'
+
+CODES_DTYPE = 'int32'
+
+
+def order_columns(columns, groups):
+    """
+    :return: columns ordered by groups (columns not present in any group are at the end in the original order)
+    """
+    ordered = []
+    seen = set()
+    for group_columns in groups.values():
+        for column in group_columns:
+            if column in columns and column not in seen:
+                ordered.append(column)
+                seen.add(column)
+    return ordered + [column for column in columns if column not in seen]
+
+
+def open_matrix(file_name, dtype, n_rows, n_columns, mode):
+    if n_rows == 0 or n_columns == 0:
+        return np.empty((n_rows, n_columns), dtype=dtype, order='F')
+    return np.memmap(file_name, dtype=dtype, mode=mode, shape=(n_rows, n_columns), order='F')
+
+
+def write_feature_store(df, directory, groups=None, dtype='float32'):
+    """
+    Write the DataFrame to a feature store.
+
+    :param df: final neighbourhood DataFrame
+    :param directory: output directory (created if it does not exist)
+    :param groups: dictionary { group name -> columns }, feature_columns.COLUMN_GROUPS by default
+    :param dtype: 'float32' or 'float64' - dtype of the numeric matrix
+    """
+    groups = feature_columns.COLUMN_GROUPS if groups is None else groups
+    os.makedirs(directory, exist_ok=True)
+
+    columns = order_columns(list(df.columns), groups)
+    numeric_columns = [column for column in columns if pd.api.types.is_numeric_dtype(df[column])]
+    numeric_set = set(numeric_columns)
+    categorical_columns = [column for column in columns if column not in numeric_set]
+    n_rows = len(df)
+
+    # columns are copied one by one directly to the mapped files (no intermediate matrix in memory):
+    numeric_matrix = open_matrix(os.path.join(directory, NUMERIC_FILE), dtype, n_rows, len(numeric_columns), 'w+')
+    for i, column in enumerate(numeric_columns):
+        numeric_matrix[:, i] = df[column].to_numpy(dtype=dtype, na_value=np.nan)
+
+    dictionary = {}
+    codes_matrix = open_matrix(os.path.join(directory, CATEGORICAL_FILE), CODES_DTYPE, n_rows,
+                               len(categorical_columns), 'w+')
+    for i, column in enumerate(categorical_columns):
+        codes, categories = pd.factorize(df[column])
+        codes_matrix[:, i] = codes
+        dictionary[column] = [str(category) for category in categories]
+
+    if isinstance(numeric_matrix, np.memmap):
+        numeric_matrix.flush()
+    if isinstance(codes_matrix, np.memmap):
+        codes_matrix.flush()
+
+    schema = {
+        'n_rows': n_rows,
+        'dtype': dtype,
+        'numeric_columns': numeric_columns,
+        'categorical_columns': categorical_columns,
+        'groups': {name: [column for column in group_columns if column in df.columns]
+                   for name, group_columns in groups.items()}
+    }
+    with open(os.path.join(directory, DICTIONARY_FILE), 'wb') as file:
+        file.write(json.dumps(dictionary))
+    with open(os.path.join(directory, SCHEMA_FILE), 'wb') as file:
+        file.write(json.dumps(schema, option=json.OPT_INDENT_2))
+
+
+class FeatureStore:
+    """
+    Read-only access to a feature store written by write_feature_store.
+
+    :ivar schema: content of schema.json
+    :ivar dictionary: content of dictionary.json
+    :ivar numeric_matrix: memory-mapped numeric matrix (rows x numeric columns)
+    :ivar codes_matrix: memory-mapped matrix of categorical codes (rows x categorical columns)
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, SCHEMA_FILE), 'rb') as file:
+            self.schema = json.loads(file.read())
+        with open(os.path.join(directory, DICTIONARY_FILE), 'rb') as file:
+            self.dictionary = json.loads(file.read())
+
+        n_rows = self.schema['n_rows']
+        self.numeric_matrix = open_matrix(os.path.join(directory, NUMERIC_FILE), self.schema['dtype'], n_rows,
+                                          len(self.schema['numeric_columns']), 'r')
+        self.codes_matrix = open_matrix(os.path.join(directory, CATEGORICAL_FILE), CODES_DTYPE, n_rows,
+                                        len(self.schema['categorical_columns']), 'r')
+        self._numeric_index = {column: i for i, column in enumerate(self.schema['numeric_columns'])}
+        self._categorical_index = {column: i for i, column in enumerate(self.schema['categorical_columns'])}
+
+    def __len__(self):
+        return self.schema['n_rows']
+
+    def group_columns(self, *group_names):
+        return [column for group_name in group_names for column in self.schema['groups'][group_name]]
+
+    def numeric(self, columns):
+        """
+        :return: numeric matrix of the columns (a view of the mapped file if the columns are stored next to each
+                 other in the given order, a copy otherwise)
+        """
+        indexes = [self._numeric_index[column] for column in columns]
+        if indexes and indexes == list(range(indexes[0], indexes[0] + len(indexes))):
+            return self.numeric_matrix[:, indexes[0]:indexes[-1] + 1]
+        return self.numeric_matrix[:, indexes]
+
+    def numeric_groups(self, *group_names):
+        """
+        :return: numeric matrix of numeric columns of the groups (e.g. 'CONN_NUMERICAL_COLS', 'CONN_APP_STATS')
+        """
+        return self.numeric([column for column in self.group_columns(*group_names) if column in self._numeric_index])
+
+    def codes(self, column):
+        """
+        :return: codes of a categorical column (view of the mapped file), categories are in self.dictionary[column]
+        """
+        return self.codes_matrix[:, self._categorical_index[column]]
+
+    def categorical(self, column):
+        return pd.Categorical.from_codes(self.codes(column), categories=pd.Index(self.dictionary[column]))
+
+    def to_frame(self, columns=None):
+        """
+        Materialize the columns (all by default) as a DataFrame, categorical columns as pandas categories.
+        """
+        columns = columns if columns is not None else self.schema['numeric_columns'] + \
+            self.schema['categorical_columns']
+        return pd.DataFrame({column: self.numeric_matrix[:, self._numeric_index[column]]
+                             if column in self._numeric_index else self.categorical(column) for column in columns},
+                            columns=columns)
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='Final neighbourhood CSV file', type=str, required=True)
+    parser.add_argument('-o', '--output_directory', help='Feature store directory', type=str, required=True)
+    parser.add_argument('-dt', '--dtype', help='dtype of numeric features', choices=['float32', 'float64'],
+                        default='float32')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    data = pd.read_csv(args.input_csv, low_memory=False)
+    write_feature_store(data, args.output_directory, dtype=args.dtype)
+    print('Successfully wrote {} rows to feature store {}.'.format(len(data), args.output_directory))
@@ -0,0 +1,220 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Graph features of connections computed locally from the CONNECTIONS mode output (no Dgraph queries).
+
+Hosts are numbered and connections are stored once as compressed sparse row (CSR) adjacency of hosts - out-edges of
+originators and in-edges of responders, edges of each host sorted by timestamp. For every connection (window
+<ts - window, ts + window> as in the time neighbourhood, the connection itself included):
+
+  graph_orig_fan_out         connections originated by the originator in the window
+  graph_orig_unique_resp     distinct responders of these connections
+  graph_resp_fan_in          connections responded by the responder in the window
+  graph_resp_unique_orig     distinct originators of these connections
+  graph_orig_two_hop_reach   hosts reachable from the originator by at most two connections
+  graph_resp_two_hop_reach   hosts reachable from the responder by at most two connections
+
+Windows of a host are contiguous ranges of its CSR row found by binary search. Distinct peers of all windows are
+counted at once - each edge adds one to the range of windows in which it is the first edge to its peer (window
+bounds grow monotonically with the timestamp, so the range is contiguous) using a difference array. Two-hop
+reachability is computed on tumbling windows of length 2 * window: host graphs of all windows form one
+block-diagonal sparse matrix A and reachable hosts of a row are the non-zero entries of A + A @ A (without the host).
+
+Usage: $ python3 host_graph.py -i output-o-*.csv -o graph_features.csv [-w 300]
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+import responses
+import partitioned_output
+import feature_columns
+
+
+GRAPH_INPUT_COLS = ['connection.uid', 'connection.ts', 'originated_ip', 'responded_ip']
+
+
+def build_csr(rows, ts_ns, n_rows):
+    """
+    :return: (indptr, order) - order sorts edges by (row, ts), indptr[row]:indptr[row + 1] is the range of the row
+    """
+    order = np.lexsort((ts_ns, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, order
+
+
+class HostGraph:
+    """
+    :ivar hosts: IP addresses of hosts (host id = index)
+    :ivar src: originator ids of connections
+    :ivar dst: responder ids of connections
+    :ivar ts_ns: int64 timestamps of connections (nanoseconds since epoch)
+    :ivar out_indptr, out_order: CSR of out-edges (connections in order out_order, row = originator)
+    :ivar in_indptr, in_order: CSR of in-edges (connections in order in_order, row = responder)
+    """
+
+    def __init__(self, originated_ips, responded_ips, ts_ns):
+        codes, self.hosts = pd.factorize(np.concatenate([np.asarray(originated_ips, dtype=object),
+                                                         np.asarray(responded_ips, dtype=object)]))
+        n_edges = len(ts_ns)
+        self.src = codes[:n_edges].astype(np.int64)
+        self.dst = codes[n_edges:].astype(np.int64)
+        self.ts_ns = np.asarray(ts_ns, dtype=np.int64)
+        self.out_indptr, self.out_order = build_csr(self.src, self.ts_ns, self.n_hosts)
+        self.in_indptr, self.in_order = build_csr(self.dst, self.ts_ns, self.n_hosts)
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        :param df: DataFrame with originated_ip, responded_ip and connection.ts columns
+        """
+        return cls(df['originated_ip'].to_numpy(), df['responded_ip'].to_numpy(),
+                   responses.convert_ts_to_epoch_ns(df['connection.ts'].tolist()))
+
+    @property
+    def n_hosts(self):
+        return len(self.hosts)
+
+    def window_ranges(self, rows, order, window_ns):
+        """
+        :return: (lo, hi) - for each edge of the CSR (in CSR order) the range of edges of its row with timestamps
+                 in <ts - window, ts + window>
+        """
+        # (row, timestamp rank) as one sortable int64 key, CSR order is the order of keys:
+        unique_ts = np.unique(self.ts_ns)
+        n_ranks = len(unique_ts) + 1
+        sorted_rows = rows[order]
+        sorted_ts = self.ts_ns[order]
+        keys = sorted_rows * n_ranks + np.searchsorted(unique_ts, sorted_ts)
+        lo = np.searchsorted(keys, sorted_rows * n_ranks + np.searchsorted(unique_ts, sorted_ts - window_ns, 'left'))
+        hi = np.searchsorted(keys, sorted_rows * n_ranks + np.searchsorted(unique_ts, sorted_ts + window_ns, 'right'))
+        return lo, hi
+
+    @staticmethod
+    def previous_edges(rows, peers, order):
+        """
+        :return: position of the previous edge of the same row to the same peer for every edge in CSR order (-1 if
+                 there is none)
+        """
+        n_edges = len(order)
+        sorted_rows = rows[order]
+        sorted_peers = peers[order]
+        by_peer = np.lexsort((np.arange(n_edges), sorted_peers, sorted_rows))
+        same = np.zeros(n_edges, dtype=bool)
+        same[1:] = (sorted_rows[by_peer[1:]] == sorted_rows[by_peer[:-1]]) & \
+            (sorted_peers[by_peer[1:]] == sorted_peers[by_peer[:-1]])
+        previous = np.full(n_edges, -1, dtype=np.int64)
+        previous[by_peer[same]] = by_peer[np.flatnonzero(same) - 1]
+        return previous
+
+    @staticmethod
+    def count_distinct_peers(rows, peers, order, lo, hi, previous=None):
+        """
+        :param lo, hi: ranges of the CSR lo[q]:hi[q] (non-decreasing bounds, e.g. windows of edges in CSR order)
+        :param previous: output of previous_edges (computed if not given)
+        :return: number of distinct peers in the range of every q
+        """
+        previous = previous if previous is not None else HostGraph.previous_edges(rows, peers, order)
+
+        # edge p is the first edge to its peer in windows q with previous[p] < lo[q] <= p < hi[q]:
+        positions = np.arange(len(order))
+        start = np.maximum(np.searchsorted(lo, previous, 'right'), np.searchsorted(hi, positions, 'right'))
+        end = np.searchsorted(lo, positions, 'right')
+        valid = start < end
+        difference = np.zeros(len(lo) + 1, dtype=np.int64)
+        np.add.at(difference, start[valid], 1)
+        np.add.at(difference, end[valid], -1)
+        return np.cumsum(difference[:-1])
+
+    def window_counts(self, window_ns, direction='out'):
+        """
+        :return: (number of edges, number of distinct peers) of the host in the window of every connection (in the
+                 original order of connections) - originator out-edges or responder in-edges
+        """
+        if direction == 'out':
+            rows, peers, order = self.src, self.dst, self.out_order
+        else:
+            rows, peers, order = self.dst, self.src, self.in_order
+        lo, hi = self.window_ranges(rows, order, window_ns)
+        distinct = self.count_distinct_peers(rows, peers, order, lo, hi)
+
+        counts = np.empty(len(order), dtype=np.int64)
+        unique_counts = np.empty(len(order), dtype=np.int64)
+        counts[order] = hi - lo
+        unique_counts[order] = distinct
+        return counts, unique_counts
+
+    def two_hop_reach(self, bucket_ns):
+        """
+        :return: (originator reach, responder reach) - number of hosts reachable by at most two connections from
+                 the host in the tumbling window of the connection
+        """
+        # tumbling windows are aligned to the epoch, so they do not depend on which connections are loaded:
+        buckets = self.ts_ns // bucket_ns
+        # (bucket, host) pairs are the nodes of the block-diagonal graph:
+        node_codes, nodes = pd.factorize(np.concatenate([buckets * self.n_hosts + self.src,
+                                                         buckets * self.n_hosts + self.dst]))
+        n_nodes = len(nodes)
+        n_edges = len(self.ts_ns)
+        src_nodes = node_codes[:n_edges]
+        dst_nodes = node_codes[n_edges:]
+
+        adjacency = sparse.csr_matrix((np.ones(n_edges, dtype=np.int64), (src_nodes, dst_nodes)),
+                                      shape=(n_nodes, n_nodes))
+        adjacency.data[:] = 1
+        reachable = (adjacency + adjacency @ adjacency).tocsr()
+        # the host itself is not counted (reachable back by a connection in the opposite direction):
+        reach = np.diff(reachable.indptr) - (reachable.diagonal() != 0)
+        return reach[src_nodes], reach[dst_nodes]
+
+    def compute_features(self, window_ns):
+        """
+        :return: DataFrame of graph features (feature_columns.GRAPH_COLS) in the original order of connections
+        """
+        fan_out, unique_resp = self.window_counts(window_ns, 'out')
+        fan_in, unique_orig = self.window_counts(window_ns, 'in')
+        orig_reach, resp_reach = self.two_hop_reach(2 * window_ns)
+        return pd.DataFrame(dict(zip(feature_columns.GRAPH_COLS,
+                                     [fan_out, unique_resp, fan_in, unique_orig, orig_reach, resp_reach])))
+
+
+def load_connections(input_files):
+    """
+    Load connections from CONNECTIONS mode CSV files or partitioned datasets (a connection present in several files is
+    used once).
+    """
+    frames = [partitioned_output.read_connections(input_file, usecols=lambda column: column in GRAPH_INPUT_COLS)
+              for input_file in input_files]
+    return pd.concat(frames, ignore_index=True).drop_duplicates('connection.uid').reset_index(drop=True)
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='CONNECTIONS mode CSV files (output-o-<IP>.csv) or partitioned '
+                        'datasets', nargs='+', required=True)
+    parser.add_argument('-o', '--output_csv', help='Output CSV file (connection.uid + graph features)', type=str,
+                        default='graph_features.csv')
+    parser.add_argument('-w', '--window', help='Half-width of the time window in seconds (as in the neighbourhood)',
+                        type=int, default=300)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    connections = load_connections(args.input_csv)
+    graph = HostGraph.from_frame(connections)
+    print('Host graph: {} hosts, {} connections.'.format(graph.n_hosts, len(connections)))
+
+    features = graph.compute_features(args.window * responses.NANOSECONDS_IN_SECOND)
+    features.insert(0, 'connection.uid', connections['connection.uid'])
+    features.to_csv(args.output_csv, index=False, header=True)
+    print('Successfully wrote to file ' + args.output_csv + '.')
@@ -0,0 +1,233 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Parallel model selection of the number of clusters K (elbow method) for k-prototypes and k-means.
+
+The dataset is encoded once (numerical matrix + categorical codes, e.g. from feature_store.FeatureStore) and put to
+shared memory, worker processes attach to it instead of receiving a copy. Candidate K values and random seeds are
+fitted in parallel, cost, number of iterations and time of each fit are collected in a results table.
+
+  * warm start - the K values of one seed are fitted in ascending order as a chain, each model starts from the
+    prototypes of the previous (smaller) K extended by D^2 seeding (chains of different seeds run in parallel),
+  * early stopping - the sweep stops once the best cost of consecutive K values improves by less than a relative
+    threshold (the cost curve flattened, the elbow was passed).
+
+Usage: $ python3 k_sweep.py -fs feature_store -ng CONN_NUMERICAL_COLS CONN_APP_STATS -cc protocol service
+         -k 2 15 -s 0 1 2 [-m kprototypes -w 8 --warm_start --early_stop 0.01 -o k_sweep.csv]
+"""
+
+import time
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+import minibatch_kprototypes
+from minibatch_kprototypes import MiniBatchKPrototypes
+
+
+MODELS = ['kprototypes', 'kmeans']
+
+# arrays of the dataset attached in the worker process:
+worker_arrays = {}
+
+
+def share_array(array):
+    """
+    Copy the array to a new shared memory block.
+
+    :return: (SharedMemory, descriptor used by attach_array)
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(descriptor):
+    """
+    :return: (SharedMemory, numpy array backed by the shared memory block)
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def init_worker(descriptors):
+    for key, descriptor in descriptors.items():
+        worker_arrays[key] = attach_array(descriptor)
+
+
+def fit_model(model, n_clusters, seed, init, params):
+    """
+    Fit one model on the shared dataset.
+
+    :return: (result row dictionary, (centers, modes) usable as warm start of a larger K)
+    """
+    X_num = worker_arrays['numerical'][1]
+    X_cat = worker_arrays['categorical'][1]
+    start = time.perf_counter()
+
+    if model == 'kmeans':
+        from sklearn.cluster import KMeans
+        rng = np.random.default_rng(seed)
+        if init is not None:
+            sample = X_num[rng.choice(len(X_num), min(len(X_num), params['batch_size']), replace=False)]
+            centers, _ = minibatch_kprototypes.extend_prototypes(init[0], np.zeros((len(init[0]), 0)), sample,
+                                                                 np.zeros((len(sample), 0)), n_clusters, 0.0, rng)
+            kmeans = KMeans(n_clusters=n_clusters, init=centers, n_init=1, max_iter=params['max_iter'],
+                            random_state=seed)
+        else:
+            kmeans = KMeans(n_clusters=n_clusters, n_init=1, max_iter=params['max_iter'], random_state=seed)
+        kmeans.fit(X_num)
+        cost, n_iter = kmeans.inertia_, kmeans.n_iter_
+        prototypes = (kmeans.cluster_centers_, np.zeros((n_clusters, 0)))
+    else:
+        kprototypes = MiniBatchKPrototypes(n_clusters=n_clusters, batch_size=params['batch_size'],
+                                           max_iter=params['max_iter'], gamma=params['gamma'],
+                                           init=init if init is not None else 'k-means++', random_state=seed)
+        kprototypes.fit(X_num, X_cat)
+        cost, n_iter = kprototypes.cost_, kprototypes.n_iter_
+        prototypes = (kprototypes.cluster_centers_, kprototypes.cluster_modes_)
+
+    return {'k': n_clusters, 'seed': seed, 'cost': cost, 'n_iter': n_iter, 'seconds': time.perf_counter() - start,
+            'warm_start': init is not None}, prototypes
+
+
+def is_flat(costs, early_stop):
+    """
+    :param costs: costs of consecutive K values
+    :return: True if the last K improved the cost by less than early_stop (relative to the previous cost)
+    """
+    if len(costs) < 2 or costs[-2] <= 0:
+        return False
+    return (costs[-2] - costs[-1]) / costs[-2] < early_stop
+
+
+def best_costs_of_prefix(results, k_values, seeds):
+    """
+    :return: best costs of the longest prefix of K values whose fits of all seeds are finished
+    """
+    costs = []
+    for n_clusters in k_values:
+        k_costs = [row['cost'] for row in results if row['k'] == n_clusters]
+        if len(k_costs) < len(seeds):
+            break
+        costs.append(min(k_costs))
+    return costs
+
+
+def run_sweep(X_num, X_cat, k_values, seeds=(0,), model='kprototypes', workers=None, warm_start=False,
+              early_stop=None, batch_size=10000, max_iter=10, gamma=None):
+    """
+    Fit all K values and seeds in parallel worker processes.
+
+    :param X_num: float array (rows x numerical attributes)
+    :param X_cat: int array of category codes (rows x categorical attributes), ignored by k-means
+    :param k_values: candidate numbers of clusters
+    :param seeds: random seeds (each K is fitted once for every seed)
+    :param model: 'kprototypes' (minibatch_kprototypes.MiniBatchKPrototypes) or 'kmeans' (sklearn KMeans)
+    :param workers: number of worker processes (None = number of CPUs)
+    :param warm_start: fit K values of a seed as a chain starting from prototypes of the previous K
+    :param early_stop: stop when the best cost (over all seeds) improves by less than this fraction between
+                       consecutive K values, K values after it are not reported
+    :return: DataFrame with columns k, seed, cost, n_iter, seconds, warm_start
+    """
+    k_values = sorted(k_values)
+    if gamma is None:
+        # rows drawn from the whole data, a prefix of data ordered by host or time is not representative:
+        rows = minibatch_kprototypes.sample_rows(X_num.shape[0], batch_size, np.random.default_rng(seeds[0]))
+        gamma = minibatch_kprototypes.estimate_gamma(np.asarray(X_num[rows], dtype=np.float64))
+    params = {'batch_size': batch_size, 'max_iter': max_iter, 'gamma': gamma}
+
+    shared_blocks = []
+    descriptors = {}
+    for key, array in [('numerical', np.asarray(X_num, dtype=np.float64)), ('categorical', np.asarray(X_cat))]:
+        shm, descriptors[key] = share_array(array)
+        shared_blocks.append(shm)
+
+    results = []
+    flat_k = None
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                    initargs=(descriptors,)) as executor:
+            if warm_start:
+                # the next K of a seed is submitted when its previous K is fitted (chains of seeds run in parallel):
+                pending = {executor.submit(fit_model, model, k_values[0], seed, None, params) for seed in seeds}
+            else:
+                # smaller K values are submitted first, so the cost curve is known from the left:
+                pending = {executor.submit(fit_model, model, n_clusters, seed, None, params)
+                           for n_clusters in k_values for seed in seeds}
+            while pending and flat_k is None:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    row, prototypes = future.result()
+                    results.append(row)
+                    print('K = {:3}, seed {:3}: cost {:.2f} ({:.2f} s)'.format(
+                        row['k'], row['seed'], row['cost'], row['seconds']))
+
+                    # all seeds of K values in the finished prefix are done, only larger K values are stopped:
+                    costs = best_costs_of_prefix(results, k_values, seeds)
+                    if early_stop and flat_k is None and is_flat(costs, early_stop):
+                        flat_k = k_values[len(costs) - 1]
+                        print('Cost curve flattened at K = {}, larger K values are cancelled.'.format(flat_k))
+                    next_index = k_values.index(row['k']) + 1
+                    if warm_start and flat_k is None and next_index < len(k_values):
+                        pending.add(executor.submit(fit_model, model, k_values[next_index], row['seed'], prototypes,
+                                                    params))
+            executor.shutdown(wait=True, cancel_futures=True)
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+
+    if flat_k is not None:
+        # fits of larger K values finished before the stop do not cover all seeds:
+        results = [row for row in results if row['k'] <= flat_k]
+    return pd.DataFrame(results, columns=['k', 'seed', 'cost', 'n_iter', 'seconds', 'warm_start']) \
+        .sort_values(['k', 'seed']).reset_index(drop=True)
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-fs', '--feature_store', help='Feature store directory (see feature_store.py)', type=str,
+                        required=True)
+    parser.add_argument('-ng', '--numerical_groups', help='Column groups of numerical features', nargs='+',
+                        required=True)
+    parser.add_argument('-cc', '--categorical_columns', help='Categorical columns (k-prototypes)', nargs='*',
+                        default=[])
+    parser.add_argument('-m', '--model', help='Clustering model', choices=MODELS, default='kprototypes')
+    parser.add_argument('-k', '--k_range', help='Range of K values: first last', type=int, nargs=2, default=[2, 15])
+    parser.add_argument('-s', '--seeds', help='Random seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('-w', '--workers', help='Number of worker processes', type=int, default=None)
+    parser.add_argument('--warm_start', help='Start each K from prototypes of the previous K', action='store_true')
+    parser.add_argument('--early_stop', help='Stop when the cost improves by less than this fraction', type=float,
+                        default=None)
+    parser.add_argument('-b', '--batch_size', help='Mini-batch size (k-prototypes)', type=int, default=10000)
+    parser.add_argument('-i', '--max_iter', help='Maximum number of iterations (passes over data)', type=int,
+                        default=10)
+    parser.add_argument('-o', '--output_csv', help='Results table', type=str, default='k_sweep.csv')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import feature_store
+
+    args = define_arguments()
+    store = feature_store.FeatureStore(args.feature_store)
+    numerical = store.numeric_groups(*args.numerical_groups)
+    categorical = np.column_stack([store.codes(column) for column in args.categorical_columns]) \
+        if args.categorical_columns else np.zeros((len(store), 0), dtype=np.int32)
+
+    sweep = run_sweep(numerical, categorical, range(args.k_range[0], args.k_range[1] + 1), args.seeds, args.model,
+                      args.workers, args.warm_start, args.early_stop, args.batch_size, args.max_iter)
+    sweep.to_csv(args.output_csv, index=False, header=True)
+    print(sweep.groupby('k')['cost'].min())
+    print('Successfully wrote to file ' + args.output_csv + '.')
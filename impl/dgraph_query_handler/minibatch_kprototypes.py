@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Mini-batch k-prototypes clustering of mixed numerical and categorical data.
+
+kmodes.kprototypes.KPrototypes goes over the whole object matrix in every iteration. This implementation works on
+two separate arrays - float numerical features and int-coded categorical features (e.g. feature_store.FeatureStore
+numeric matrix and codes) - and reads them in batches, so memory does not grow with the number of rows (arrays can
+be memory-mapped files):
+
+  * numerical part of a prototype is a running mean of the assigned rows (mini-batch k-means update),
+  * categorical part of a prototype is the mode of each attribute, computed from per-cluster category counts,
+  * distance of a row to a prototype is the squared euclidean distance of numerical features + gamma * number of
+    mismatching categorical attributes (the same cost as kmodes.kprototypes).
+
+Missing categorical values are coded as -1; they are not counted and always mismatch.
+"""
+
+import time
+import numpy as np
+
+
+def iterate_batches(n_rows, batch_size, rng=None):
+    """
+    Generate (start, end) row ranges of batches. Batches are contiguous blocks (cheap reads of memory-mapped files)
+    visited in random order if rng is given.
+    """
+    starts = np.arange(0, n_rows, batch_size)
+    if rng is not None:
+        rng.shuffle(starts)
+    for start in starts:
+        yield int(start), int(min(start + batch_size, n_rows))
+
+
+def sample_rows(n_rows, size, rng):
+    """
+    :return: sorted indices of size rows drawn without replacement from the whole array (data stored ordered by host
+             or time is not represented by a contiguous block of rows; sorted indices keep reads of memory-mapped
+             arrays sequential)
+    """
+    if size >= n_rows:
+        return np.arange(n_rows)
+    return np.sort(rng.choice(n_rows, size, replace=False))
+
+
+def estimate_gamma(X_num):
+    """
+    Weight of categorical mismatches, the same default as in kmodes.kprototypes: half of the mean standard deviation
+    of numerical attributes.
+    """
+    if X_num.shape[1] == 0:
+        return 1.0
+    gamma = 0.5 * float(np.mean(np.std(X_num, axis=0)))
+    return gamma if gamma > 0 else 1.0
+
+
+def compute_distances(X_num, X_cat, centers, modes, gamma):
+    """
+    :return: matrix (rows x clusters) of k-prototypes distances
+    """
+    X_num = np.asarray(X_num, dtype=centers.dtype)
+    distances = (np.einsum('ij,ij->i', X_num, X_num)[:, None] - 2 * X_num @ centers.T
+                 + np.einsum('ij,ij->i', centers, centers)[None, :])
+    np.maximum(distances, 0, out=distances)
+
+    if modes.shape[1]:
+        mismatches = np.zeros(distances.shape, dtype=np.int32)
+        for j in range(modes.shape[1]):
+            mismatches += np.asarray(X_cat[:, j])[:, None] != modes[None, :, j]
+        distances += gamma * mismatches
+    return distances
+
+
+def assign_labels(X_num, X_cat, centers, modes, gamma):
+    """
+    :return: (labels, distances of rows to their prototypes)
+    """
+    # the squared norm of a row is the same for all prototypes, it is added only to the distance of the nearest one
+    X_num = np.asarray(X_num, dtype=centers.dtype)
+    distances = np.einsum('ij,ij->i', centers, centers)[None, :] - 2 * X_num @ centers.T
+    for j in range(modes.shape[1]):
+        distances += gamma * (np.asarray(X_cat[:, j])[:, None] != modes[None, :, j])
+    labels = np.argmin(distances, axis=1)
+    nearest = distances[np.arange(len(labels)), labels] + np.einsum('ij,ij->i', X_num, X_num)
+    return labels, np.maximum(nearest, 0)
+
+
+def extend_prototypes(centers, modes, X_num, X_cat, n_clusters, gamma, rng):
+    """
+    Add prototypes by D^2 seeding (k-means++ with the k-prototypes distance): each new prototype is a row drawn with
+    probability proportional to its distance to the closest prototype. Used for initialization and for warm start
+    from prototypes of a model with a smaller number of clusters.
+
+    :return: (centers, modes) with n_clusters prototypes
+    """
+    centers = np.array(centers, dtype=np.float64)
+    modes = np.array(modes, dtype=np.int64)
+    n_rows = X_num.shape[0]
+    closest = compute_distances(X_num, X_cat, centers, modes, gamma).min(axis=1)
+    rows = []
+    for _ in range(len(centers), n_clusters):
+        total = closest.sum()
+        row = int(rng.choice(n_rows, p=closest / total) if total > 0 else rng.integers(n_rows))
+        rows.append(row)
+        closest = np.minimum(closest, compute_distances(X_num, X_cat, X_num[[row]], X_cat[[row]], gamma)[:, 0])
+    return np.vstack([centers, np.asarray(X_num[rows], dtype=np.float64).reshape(len(rows), -1)]), \
+        np.vstack([modes, np.asarray(X_cat[rows], dtype=np.int64).reshape(len(rows), -1)])
+
+
+class MiniBatchKPrototypes:
+    """
+    Mini-batch k-prototypes.
+
+    :ivar cluster_centers_: numerical part of prototypes (n_clusters x numerical attributes)
+    :ivar cluster_modes_: categorical part of prototypes, category codes (n_clusters x categorical attributes)
+    :ivar gamma: weight of categorical mismatches
+    :ivar labels_: labels of the rows used by fit (if compute_labels is set)
+    :ivar cost_: sum of distances of the rows used by fit to their prototypes (if compute_labels is set)
+    :ivar n_iter_: number of passes over the data performed by fit
+    :ivar n_steps_: number of processed batches
+    """
+
+    def __init__(self, n_clusters=8, batch_size=10000, max_iter=10, tol=1e-4, gamma=None, init='k-means++',
+                 random_state=None, compute_labels=True, verbose=False):
+        """
+        :param n_clusters: number of clusters
+        :param batch_size: number of rows in a batch
+        :param max_iter: maximum number of passes over the data
+        :param tol: fit stops when the largest relative movement of numerical prototypes during a pass is smaller
+        :param gamma: weight of categorical mismatches (estimated from the initialization sample by default)
+        :param init: 'k-means++' (rows of the sample drawn with probability proportional to the distance to the
+                     closest chosen row), 'huang' (numerical prototypes drawn around the mean, modes drawn by category
+                     frequencies, both snapped to the nearest rows), 'random' (random rows of the sample) or a tuple
+                     (centers, modes) to start from (e.g. prototypes of a model with a smaller number of clusters,
+                     missing prototypes are added by D^2 seeding). The sample is batch_size rows drawn from the whole
+                     data by fit, the first batch by partial_fit.
+        :param random_state: seed of the random generator
+        :param compute_labels: compute labels_ and cost_ in a final pass over the data
+        """
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.max_iter = max_iter
+        self.tol = tol
+        self.gamma = gamma
+        self.init = init
+        self.random_state = random_state
+        self.compute_labels = compute_labels
+        self.verbose = verbose
+
+        self.cluster_centers_ = None
+        self.cluster_modes_ = None
+        self.labels_ = None
+        self.cost_ = None
+        self.n_iter_ = 0
+        self.n_steps_ = 0
+        self._rng = np.random.default_rng(random_state)
+        self._center_counts = None
+        self._category_counts = None
+
+    @property
+    def cluster_centroids_(self):
+        """
+        Prototypes in the format of kmodes.kprototypes (numerical attributes followed by categorical codes).
+        """
+        return np.hstack([self.cluster_centers_, self.cluster_modes_])
+
+    def _init_prototypes(self, X_num, X_cat):
+        n_rows = X_num.shape[0]
+        if isinstance(self.init, tuple):
+            # prototypes of a smaller model are extended by D^2 seeding
+            centers, modes = self.init
+            return extend_prototypes(centers, modes, X_num, X_cat, self.n_clusters, self.gamma, self._rng)
+
+        if self.init == 'k-means++':
+            row = int(self._rng.integers(n_rows))
+            return extend_prototypes(X_num[[row]], X_cat[[row]], X_num, X_cat, self.n_clusters, self.gamma, self._rng)
+
+        if self.init == 'random':
+            rows = self._rng.choice(n_rows, self.n_clusters, replace=n_rows < self.n_clusters)
+            return np.array(X_num[rows], dtype=np.float64), np.array(X_cat[rows], dtype=np.int64)
+
+        # 'huang': numerical attributes around the mean, categorical attributes by frequency of categories
+        centers = np.mean(X_num, axis=0) + self._rng.standard_normal((self.n_clusters, X_num.shape[1])) \
+            * np.std(X_num, axis=0)
+        modes = np.zeros((self.n_clusters, X_cat.shape[1]), dtype=np.int64)
+        for j in range(X_cat.shape[1]):
+            codes = X_cat[:, j][X_cat[:, j] >= 0]
+            if len(codes):
+                categories, frequencies = np.unique(codes, return_counts=True)
+                modes[:, j] = self._rng.choice(categories, self.n_clusters, p=frequencies / frequencies.sum())
+
+        # replace each prototype by the nearest row not used yet (prototypes are then real distinct rows):
+        distances = compute_distances(X_num, X_cat, centers, modes, self.gamma)
+        used = set()
+        rows = []
+        for cluster in range(self.n_clusters):
+            for row in np.argsort(distances[:, cluster]):
+                if row not in used:
+                    used.add(row)
+                    rows.append(row)
+                    break
+            else:
+                rows.append(int(self._rng.integers(n_rows)))
+        return np.array(X_num[rows], dtype=np.float64), np.array(X_cat[rows], dtype=np.int64)
+
+    def _initialize(self, X_num, X_cat):
+        """
+        Estimate gamma (if not given) and initialize prototypes from the sample rows.
+        """
+        X_num = np.asarray(X_num, dtype=np.float64)
+        X_cat = np.asarray(X_cat, dtype=np.int64)
+        if self.gamma is None:
+            self.gamma = estimate_gamma(X_num)
+        self.cluster_centers_, self.cluster_modes_ = self._init_prototypes(X_num, X_cat)
+        self._center_counts = np.zeros(self.n_clusters, dtype=np.int64)
+        self._category_counts = [np.zeros((self.n_clusters, 0), dtype=np.int64) for _ in range(X_cat.shape[1])]
+
+    def _update(self, X_num, X_cat):
+        """
+        One mini-batch step. Numerical prototypes move to the running mean of all rows assigned so far, modes are
+        the most frequent categories of all rows assigned so far.
+
+        :return: (labels, costs) of the batch rows (assignment before the update)
+        """
+        labels, costs = assign_labels(X_num, X_cat, self.cluster_centers_, self.cluster_modes_, self.gamma)
+
+        batch_counts = np.bincount(labels, minlength=self.n_clusters)
+        batch_sums = np.zeros_like(self.cluster_centers_)
+        np.add.at(batch_sums, labels, X_num)
+        self._center_counts += batch_counts
+        assigned = batch_counts > 0
+        self.cluster_centers_[assigned] += (batch_sums[assigned] - batch_counts[assigned, None]
+                                            * self.cluster_centers_[assigned]) / self._center_counts[assigned, None]
+
+        for j in range(X_cat.shape[1]):
+            codes = np.asarray(X_cat[:, j])
+            valid = codes >= 0
+            n_categories = max(self._category_counts[j].shape[1], int(codes.max(initial=-1)) + 1)
+            if n_categories > self._category_counts[j].shape[1]:
+                counts = np.zeros((self.n_clusters, n_categories), dtype=np.int64)
+                counts[:, :self._category_counts[j].shape[1]] = self._category_counts[j]
+                self._category_counts[j] = counts
+            self._category_counts[j] += np.bincount(labels[valid] * n_categories + codes[valid],
+                                                    minlength=self.n_clusters * n_categories
+                                                    ).reshape(self.n_clusters, n_categories)
+            counted = self._category_counts[j].sum(axis=1) > 0
+            self.cluster_modes_[counted, j] = np.argmax(self._category_counts[j][counted], axis=1)
+
+        self.n_steps_ += 1
+        return labels, costs
+
+    def partial_fit(self, X_num, X_cat):
+        """
+        Update the prototypes by one batch (the first batch initializes them).
+
+        :param X_num: float array (rows x numerical attributes)
+        :param X_cat: int array of category codes (rows x categorical attributes)
+        """
+        X_num = np.asarray(X_num, dtype=np.float64)
+        X_cat = np.asarray(X_cat, dtype=np.int64)
+        if self.cluster_centers_ is None:
+            self._initialize(X_num, X_cat)
+        self._update(X_num, X_cat)
+        return self
+
+    def fit(self, X_num, X_cat):
+        """
+        Fit the prototypes by passes of mini-batches over the data (arrays are only sliced, memory-mapped arrays are
+        read batch by batch). Gamma and the initial prototypes come from a random sample of rows of the whole data,
+        not from the first batch (a contiguous block).
+        """
+        n_rows = X_num.shape[0]
+        start = time.perf_counter()
+        if self.cluster_centers_ is None:
+            rows = sample_rows(n_rows, self.batch_size, self._rng)
+            self._initialize(X_num[rows], X_cat[rows])
+        for iteration in range(self.max_iter):
+            previous_centers = None if self.cluster_centers_ is None else self.cluster_centers_.copy()
+            for batch_start, batch_end in iterate_batches(n_rows, self.batch_size, self._rng):
+                self.partial_fit(X_num[batch_start:batch_end], X_cat[batch_start:batch_end])
+            self.n_iter_ = iteration + 1
+
+            if previous_centers is not None:
+                scale = np.maximum(np.abs(previous_centers).max(axis=0), 1e-12)
+                shift = float(np.max(np.abs(self.cluster_centers_ - previous_centers) / scale))
+                if self.verbose:
+                    print('Pass {:3}: max relative shift {:.6f} ({:.2f} s)'.format(
+                        self.n_iter_, shift, time.perf_counter() - start))
+                if shift < self.tol:
+                    break
+
+        if self.compute_labels:
+            self.labels_, self.cost_ = self._predict_and_cost(X_num, X_cat)
+        return self
+
+    def _predict_and_cost(self, X_num, X_cat):
+        labels = np.empty(X_num.shape[0], dtype=np.int32)
+        cost = 0.0
+        for batch_start, batch_end in iterate_batches(X_num.shape[0], self.batch_size):
+            batch_labels, batch_costs = assign_labels(X_num[batch_start:batch_end], X_cat[batch_start:batch_end],
+                                                      self.cluster_centers_, self.cluster_modes_, self.gamma)
+            labels[batch_start:batch_end] = batch_labels
+            cost += float(batch_costs.sum())
+        return labels, cost
+
+    def predict(self, X_num, X_cat):
+        """
+        :return: labels of the rows (computed batch by batch)
+        """
+        return self._predict_and_cost(X_num, X_cat)[0]
+
+    def cost(self, X_num, X_cat):
+        """
+        :return: sum of distances of the rows to their prototypes
+        """
+        return self._predict_and_cost(X_num, X_cat)[1]
+
+    def fit_predict(self, X_num, X_cat):
+        self.fit(X_num, X_cat)
+        return self.labels_ if self.labels_ is not None else self.predict(X_num, X_cat)
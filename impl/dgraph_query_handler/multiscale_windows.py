@@ -0,0 +1,329 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Time neighbourhood features of several window sizes computed locally in one pass over the CONNECTIONS mode output
+(no Dgraph queries, no rerun for another window size).
+
+The four neighbourhood blocks of the preprocessing notebook are computed for every window size w - connections of
+the host with timestamps in (ts - w, ts + w>:
+
+  orig_orig   connections originated by the originator
+  orig_resp   connections responded by the originator
+  resp_orig   connections originated by the responder
+  resp_resp   connections responded by the responder
+
+Columns are the columns of the notebook (totals, protocol counts, modes, means, port categories, application
+statistics, similar attribute counts if attribute bitsets are given - see attribute_bitsets.py, similar connection
+counts are not computed) and distinct peers of the host in the window (<prefix>_unique_peers) with a window size
+suffix, e.g. orig_orig_total_5m. connection.time_mean is in seconds since epoch.
+
+Connections are sorted once by (host, timestamp) - the CSR of host_graph.HostGraph - and every attribute is stored
+as prefix sums in this order, so any window is a range of the sorted connections and its sums / counts are
+differences of two prefix sums. All window sizes share the sorted index and the prefix sums; every window size
+runs its own two binary searches (np.searchsorted of the range bounds over the whole sorted index) per connection.
+
+Usage: $ python3 multiscale_windows.py -i output-o-*.csv -o multiscale_features.csv [-w 10 60 300 1800]
+         [-sa | -at <output_path of app data tables>]
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import responses
+import partitioned_output
+import feature_columns
+from host_graph import HostGraph
+from attribute_bitsets import AttributeBitsets
+
+
+WINDOW_NUMERICAL_COLS = ['connection.duration', 'connection.orig_pkts', 'connection.orig_bytes',
+                         'connection.resp_bytes', 'connection.resp_pkts']
+
+# categorical attribute -> name of its mode in the neighbourhood columns:
+WINDOW_MODE_COLS = {'connection.proto': 'connection.protocol_mode',
+                    'connection.service': 'connection.service_mode',
+                    'connection.conn_state': 'connection.conn_state_mode'}
+
+COUNTED_PROTOCOLS = ['tcp', 'udp', 'icmp']
+COMMON_RESP_PORTS = [21, 22, 53, 80, 123, 443, 3389]
+
+MULTISCALE_INPUT_COLS = feature_columns.CONN_IDS_COLS + ['connection.ts', 'connection.orig_p', 'connection.resp_p'] + \
+    WINDOW_NUMERICAL_COLS + list(WINDOW_MODE_COLS) + feature_columns.CONN_APP_STATS
+
+# neighbourhood block -> (host of the connection, direction of connections of the host):
+NEIGHBOURHOODS = {'orig_orig': ('originator', 'out'),
+                  'orig_resp': ('originator', 'in'),
+                  'resp_orig': ('responder', 'out'),
+                  'resp_resp': ('responder', 'in')}
+
+
+def window_label(seconds):
+    """
+    :return: column suffix of the window size (10s, 1m, 5m, 1h, ...)
+    """
+    if seconds % 3600 == 0:
+        return '{}h'.format(seconds // 3600)
+    if seconds % 60 == 0:
+        return '{}m'.format(seconds // 60)
+    return '{}s'.format(seconds)
+
+
+def port_categories(orig_p, resp_p):
+    """
+    :return: (originator port category codes, responder port category codes) - the categories of the notebook in the
+             order of feature_columns.neighbourhood_ports_cols
+    """
+    orig_codes = (orig_p >= 1024).astype(np.int64)
+    # common ports, then well known, registered and dynamic ports:
+    resp_codes = np.select([resp_p < 1024, resp_p < 49152], [len(COMMON_RESP_PORTS), len(COMMON_RESP_PORTS) + 1],
+                           len(COMMON_RESP_PORTS) + 2)
+    for code, port in enumerate(COMMON_RESP_PORTS):
+        resp_codes[resp_p == port] = code
+    return orig_codes, resp_codes
+
+
+def merge_rows(mask, values, other_values):
+    """
+    :return: values in rows of the mask and other_values in the remaining rows (Categoricals of the same categories
+             are merged by codes)
+    """
+    if isinstance(values, pd.Categorical):
+        return pd.Categorical.from_codes(merge_rows(mask, values.codes, other_values.codes), values.categories)
+    merged = np.empty(len(mask), dtype=np.result_type(values, other_values))
+    merged[mask] = values
+    merged[~mask] = other_values
+    return merged
+
+
+class MultiScaleWindows:
+    """
+    :ivar graph: host_graph.HostGraph of the connections
+    :ivar values: float matrix of numerical attributes (time offset, WINDOW_NUMERICAL_COLS, application statistics)
+    :ivar indicators: int8 matrix of one-hot encoded categories (categorical attributes and port categories)
+    :ivar categories: { categorical column -> categories } (sorted, code = index)
+    :ivar offsets: { categorical column / port category -> first column in indicators }
+    :ivar attribute_bitsets: attribute_bitsets.AttributeBitsets of the connections or None
+    """
+
+    def __init__(self, df, attribute_bitsets=None):
+        """
+        :param df: DataFrame of connections with MULTISCALE_INPUT_COLS (one row per connection)
+        :param attribute_bitsets: AttributeBitsets with rows in the order of df (similar attribute counts are
+                                  computed for its attributes)
+        """
+        self.graph = HostGraph.from_frame(df)
+        self.attribute_bitsets = attribute_bitsets
+        self.time_origin = int(self.graph.ts_ns.min()) if len(df) else 0
+        self.numerical_columns = WINDOW_NUMERICAL_COLS + feature_columns.CONN_APP_STATS
+        time_offset = (self.graph.ts_ns - self.time_origin) / responses.NANOSECONDS_IN_SECOND
+        self.values = np.column_stack([time_offset] + [df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+                                                       for column in self.numerical_columns])
+
+        self.categories = {}
+        self.offsets = {}
+        blocks = []
+        for column in WINDOW_MODE_COLS:
+            # missing service means Zeek was not able to extract it - a category of its own (as in the notebook)
+            codes, self.categories[column] = pd.factorize(df[column].fillna('none').astype(str), sort=True)
+            blocks.append((column, codes, len(self.categories[column])))
+        orig_codes, resp_codes = port_categories(df['connection.orig_p'].to_numpy(), df['connection.resp_p'].to_numpy())
+        blocks.append(('orig_p', orig_codes, 2))
+        blocks.append(('resp_p', resp_codes, len(COMMON_RESP_PORTS) + 3))
+
+        self.indicators = np.zeros((len(df), sum(width for _, _, width in blocks)), dtype=np.int8)
+        offset = 0
+        for name, codes, width in blocks:
+            self.offsets[name] = offset
+            self.indicators[np.arange(len(df)), offset + codes] = 1
+            offset += width
+
+    def prefix_sums(self, order):
+        """
+        :return: (sums of values, numbers of non-missing values, sums of indicators) of the first i connections in
+                 the order for i = 0 .. number of connections
+        """
+        n_rows = len(order)
+        values = self.values[order]
+        valid = ~np.isnan(values)
+        sums = np.zeros((n_rows + 1, values.shape[1]), dtype=np.float64)
+        np.cumsum(np.where(valid, values, 0.0), axis=0, out=sums[1:])
+        valid_counts = np.zeros((n_rows + 1, values.shape[1]), dtype=np.int32)
+        np.cumsum(valid, axis=0, dtype=np.int32, out=valid_counts[1:])
+        counts = np.zeros((n_rows + 1, self.indicators.shape[1]), dtype=np.int32)
+        np.cumsum(self.indicators[order], axis=0, dtype=np.int32, out=counts[1:])
+        return sums, valid_counts, counts
+
+    def mode_values(self, column, codes):
+        """
+        :param codes: category codes of the categorical column (number of categories = empty neighbourhood)
+        :return: Categorical of modes ('-' for an empty neighbourhood)
+        """
+        categories = list(self.categories[column])
+        if '-' in categories:
+            # '-' is also the unset value of Zeek logs, empty neighbourhoods share its category:
+            codes = np.where(codes == len(categories), categories.index('-'), codes)
+        else:
+            categories.append('-')
+        return pd.Categorical.from_codes(codes, categories)
+
+    def block_features(self, prefix, label, lo, hi, query_ts, sums, valid_counts, counts):
+        """
+        :param query_ts: timestamps of the connections (nanoseconds since epoch)
+        :return: { column -> values } of one neighbourhood block and window for connections with ranges lo:hi of
+                 the sorted connections
+        """
+        suffix = '_' + label
+        total = hi - lo
+        empty = total == 0
+        features = {prefix + '_total' + suffix: total}
+
+        window_counts = counts[hi] - counts[lo]
+        proto = self.categories['connection.proto']
+        for protocol in COUNTED_PROTOCOLS:
+            features[prefix + '_proto_' + protocol + '_count' + suffix] = \
+                window_counts[:, self.offsets['connection.proto'] + proto.get_loc(protocol)] \
+                if protocol in proto else np.zeros(len(total), dtype=np.int32)
+        for column, mode_name in WINDOW_MODE_COLS.items():
+            offset = self.offsets[column]
+            categories = self.categories[column]
+            # ties are resolved to the first category in sorted order (as pandas Series.mode()[0]):
+            modes = window_counts[:, offset:offset + len(categories)].argmax(axis=1)
+            modes[empty] = len(categories)
+            features[prefix + '_' + mode_name + suffix] = self.mode_values(column, modes)
+
+        window_sums = sums[hi] - sums[lo]
+        window_valid = valid_counts[hi] - valid_counts[lo]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = window_sums / window_valid
+        # empty neighbourhood has zero means (time of the connection itself as the time mean):
+        means[empty] = 0.0
+        means[empty, 0] = (query_ts[empty] - self.time_origin) / responses.NANOSECONDS_IN_SECOND
+        features[prefix + '_connection.time_mean' + suffix] = means[:, 0] + self.time_origin / \
+            responses.NANOSECONDS_IN_SECOND
+        for j, column in enumerate(self.numerical_columns):
+            features[prefix + '_' + column + '_mean' + suffix] = means[:, j + 1]
+
+        ports = window_counts[:, self.offsets['orig_p']:]
+        for j, column in enumerate(feature_columns.neighbourhood_ports_cols(prefix + '_')):
+            features[column + suffix] = ports[:, j]
+        return features
+
+    def compute_features(self, window_seconds, sketches=None):
+        """
+        :param window_seconds: window sizes in seconds
+        :param sketches: sketch_windows.SketchWindows - neighbourhoods of its heavy hosts are approximated from
+                         sketches (<prefix>_approximate columns mark the approximated connections)
+        :return: DataFrame of neighbourhood features of all window sizes in the original order of connections
+        """
+        graph = self.graph
+        unique_ts = np.unique(graph.ts_ns)
+        n_ranks = len(unique_ts) + 1
+        csr = {'out': (graph.src, graph.out_order), 'in': (graph.dst, graph.in_order)}
+        peers = {'out': graph.dst, 'in': graph.src}
+        hosts = {'originator': graph.src, 'responder': graph.dst}
+        # connections sorted by (originator, ts) / (responder, ts) - the same order as the CSR of the host:
+        query_orders = {host: (order, np.argsort(order)) for host, order in [('originator', graph.out_order),
+                                                                             ('responder', graph.in_order)]}
+
+        prefix_sums = {}
+        edge_keys = {}
+        previous = {}
+        for direction, (rows, order) in csr.items():
+            prefix_sums[direction] = self.prefix_sums(order)
+            previous[direction] = HostGraph.previous_edges(rows, peers[direction], order)
+            edge_keys[direction] = rows[order] * n_ranks + np.searchsorted(unique_ts, graph.ts_ns[order])
+
+        features = {}
+        heavy = {}
+        if sketches is not None:
+            for prefix, (host, direction) in NEIGHBOURHOODS.items():
+                query_order, inverse = query_orders[host]
+                heavy[prefix] = sketches.heavy_queries(direction, hosts[host][query_order])
+                features[prefix + '_approximate'] = heavy[prefix][inverse]
+
+        for seconds in sorted(window_seconds):
+            window_ns = seconds * responses.NANOSECONDS_IN_SECOND
+            label = window_label(seconds)
+            for prefix, (host, direction) in NEIGHBOURHOODS.items():
+                query_order, inverse = query_orders[host]
+                query_hosts = hosts[host][query_order]
+                query_ts = graph.ts_ns[query_order]
+                exact = ~heavy[prefix] if prefix in heavy else np.ones(len(query_order), dtype=bool)
+                if not exact.all():
+                    query_order, query_hosts, query_ts = query_order[exact], query_hosts[exact], query_ts[exact]
+
+                # first connection later than ts - window, first connection later than ts + window:
+                lo = np.searchsorted(edge_keys[direction],
+                                     query_hosts * n_ranks + np.searchsorted(unique_ts, query_ts - window_ns, 'right'))
+                hi = np.searchsorted(edge_keys[direction],
+                                     query_hosts * n_ranks + np.searchsorted(unique_ts, query_ts + window_ns, 'right'))
+                block = self.block_features(prefix, label, lo, hi, query_ts, *prefix_sums[direction])
+                rows, order = csr[direction]
+                block[prefix + '_unique_peers_' + label] = HostGraph.count_distinct_peers(
+                    rows, peers[direction], order, lo, hi, previous[direction])
+                if self.attribute_bitsets is not None:
+                    for attribute in self.attribute_bitsets.attributes:
+                        block[prefix + '_similar_' + attribute + '_count_' + label] = \
+                            self.attribute_bitsets.shared_counts(attribute, query_order, order, lo, hi)
+
+                if not exact.all():
+                    approximate_order = query_orders[host][0][~exact]
+                    approximate = sketches.block_features(self, prefix, label, window_ns, approximate_order,
+                                                          hosts[host][approximate_order])
+                    block = {column: merge_rows(exact, values, approximate[column]) for column, values in block.items()}
+                for column, values in block.items():
+                    features[column] = values[inverse]
+            print('Window {} computed.'.format(label))
+        return pd.DataFrame(features)
+
+
+def load_connections(input_files, columns=MULTISCALE_INPUT_COLS):
+    """
+    Load connections from CONNECTIONS mode CSV files or partitioned datasets (a connection present in several files is
+    used once).
+    """
+    frames = [partitioned_output.read_connections(input_file, usecols=lambda column: column in columns,
+                                                  low_memory=False) for input_file in input_files]
+    return pd.concat(frames, ignore_index=True).drop_duplicates('connection.uid').reset_index(drop=True)
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='CONNECTIONS mode CSV files (output-o-<IP>.csv) or partitioned '
+                        'datasets', nargs='+', required=True)
+    parser.add_argument('-o', '--output_csv', help='Output CSV file (connection ids + neighbourhood features)',
+                        type=str, default='multiscale_features.csv')
+    parser.add_argument('-w', '--windows', help='Half-widths of time windows in seconds', nargs='+', type=int,
+                        default=[10, 60, 300, 1800])
+    parser.add_argument('-sa', '--similar_attributes', help='Compute similar attribute counts from list columns of '
+                        'the input', action='store_true')
+    parser.add_argument('-at', '--app_tables', help='Compute similar attribute counts from app data tables of this '
+                        'output path (see app_tables.py)', type=str, default=None)
+    parser.add_argument('-mb', '--max_bits', help='Maximum width of attribute bitmasks', type=int, default=256)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    connections = load_connections(args.input_csv, MULTISCALE_INPUT_COLS + feature_columns.SIMILAR_ATTRIBUTES
+                                   if args.similar_attributes else MULTISCALE_INPUT_COLS)
+    bitsets = None
+    if args.similar_attributes:
+        bitsets = AttributeBitsets.from_frame(connections, max_bits=args.max_bits)
+    elif args.app_tables:
+        bitsets = AttributeBitsets.from_app_tables(args.app_tables, connections['connection.uid'],
+                                                   max_bits=args.max_bits)
+    windows = MultiScaleWindows(connections, bitsets)
+    print('Loaded {} connections of {} hosts.'.format(len(connections), windows.graph.n_hosts))
+
+    features = windows.compute_features(args.windows)
+    features = pd.concat([connections[feature_columns.CONN_IDS_COLS], features], axis=1)
+    features.to_csv(args.output_csv, index=False, header=True)
+    print('Successfully wrote to file ' + args.output_csv + '.')
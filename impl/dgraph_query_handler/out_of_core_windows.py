@@ -0,0 +1,231 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Out-of-core time neighbourhood features (as multiscale_windows.py) of datasets larger than memory. Peak memory is
+bounded by the memory budget, not by the number of days of the input.
+
+  1. planning pass - only timestamps are read, connections are counted per second and the time axis is split to
+     slices, so that a slice, the window-sized margins before and after it and the rest of the last read-ahead
+     slice fit the memory budget
+  2. spill pass - input rows are read in chunks and appended to files of their slices in a temporary directory
+  3. slices are processed in time order. The state of a slice is the carry-over tail of the previous slices
+     (connections later than slice start - window), the slice and the head of the next slices (connections up to
+     slice end + window, a slice can be shorter than the window), so windows of all connections of the slice are
+     complete. Their features are appended to the
+     output file, only the tail is kept for the next slice.
+
+Memory of a row is estimated (BASE_ROW_BYTES + WINDOW_ROW_BYTES per window size, measured on the bundled datasets), a
+second with more connections than the budget allows is still one slice. Output rows are ordered by slices (time).
+
+Usage: $ python3 out_of_core_windows.py -i output-o-*.csv -o multiscale_features.csv --memory_budget 4G
+         [-w 10 60 300 1800 -cs 200000 -td /tmp -sa]
+"""
+
+import os
+import re
+import glob
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import responses
+import feature_columns
+import partitioned_output
+from attribute_bitsets import AttributeBitsets
+from multiscale_windows import MultiScaleWindows, MULTISCALE_INPUT_COLS
+
+
+BASE_ROW_BYTES = 2048
+WINDOW_ROW_BYTES = 2304
+MEMORY_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_memory_size(value):
+    """
+    :param value: number of bytes with an optional unit (512M, 4G, ...)
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(value).upper())
+    if not match:
+        raise argparse.ArgumentTypeError('invalid memory size: ' + str(value))
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def iter_input_chunks(input_files, columns, chunk_size):
+    """
+    :return: generator of DataFrame chunks of CONNECTIONS mode CSV files or partitioned datasets
+    """
+    for input_file in input_files:
+        if os.path.isdir(input_file):
+            dataset = partitioned_output.PartitionedDataset(input_file)
+            yield from dataset.scan(dataset.index[dataset.index['direction'] == 'o'],
+                                    usecols=lambda column: column in columns, low_memory=False)
+        else:
+            yield from pd.read_csv(input_file, chunksize=chunk_size, usecols=lambda column: column in columns,
+                                   low_memory=False)
+
+
+def chunk_seconds(chunk):
+    return responses.convert_ts_to_epoch_ns(chunk['connection.ts'].tolist()) // responses.NANOSECONDS_IN_SECOND
+
+
+def plan_slices(second_counts, first_second, window_seconds, budget_rows):
+    """
+    Split seconds to slices - a slice, the connections of one window before and after the slice (carry-over tail,
+    head) and the rest of the last slice read for the head have at most budget_rows connections.
+
+    :param second_counts: number of connections of every second from first_second
+    :return: list of slice start seconds (the last item is the end of the last slice)
+    """
+    cumulative = np.concatenate([[0], np.cumsum(second_counts)])
+    # largest number of connections in a window before a second:
+    tail_rows = int((cumulative[window_seconds:] - cumulative[:-window_seconds]).max()) \
+        if len(cumulative) > window_seconds else int(cumulative[-1])
+    slice_rows = max(1, (budget_rows - 2 * tail_rows) // 2)
+    if budget_rows - 2 * tail_rows < 2:
+        print('Memory budget is too small for {} connections of the window, slices of one second are used.'.format(
+            tail_rows))
+
+    starts = [0]
+    while starts[-1] < len(second_counts):
+        # the last second whose end keeps the slice within slice_rows (at least one second):
+        end = int(np.searchsorted(cumulative, cumulative[starts[-1]] + slice_rows, 'right')) - 1
+        starts.append(min(len(second_counts), max(end, starts[-1] + 1)))
+    return [first_second + start for start in starts]
+
+
+def spill_slices(input_files, columns, chunk_size, boundaries, spill_directory):
+    """
+    Append input rows to CSV files of their slices.
+
+    :return: list of slice files
+    """
+    slice_files = [os.path.join(spill_directory, 'slice-{:06d}.csv'.format(i)) for i in range(len(boundaries) - 1)]
+    written = set()
+    for chunk in iter_input_chunks(input_files, columns, chunk_size):
+        slices = np.searchsorted(boundaries, chunk_seconds(chunk), 'right') - 1
+        for slice_index, rows in chunk.groupby(slices, sort=False):
+            rows.to_csv(slice_files[slice_index], mode='a', index=False, header=slice_index not in written)
+            written.add(slice_index)
+    return slice_files
+
+
+def read_slice(slice_file, columns):
+    """
+    :return: DataFrame of the slice with a ts_ns column (empty if the slice has no connections)
+    """
+    if not os.path.exists(slice_file):
+        return pd.DataFrame(columns=columns + ['ts_ns'])
+    df = pd.read_csv(slice_file, low_memory=False).drop_duplicates('connection.uid')
+    df['ts_ns'] = responses.convert_ts_to_epoch_ns(df['connection.ts'].tolist())
+    return df
+
+
+def compute_slice_features(state, current, window_seconds, similar_attributes):
+    """
+    :param state: DataFrame of the tail, the slice and the head of the next slice
+    :param current: bool array - rows of the slice
+    :return: DataFrame of connection ids and neighbourhood features of the rows of the slice
+    """
+    state = state.reset_index(drop=True)
+    bitsets = AttributeBitsets.from_frame(state) if similar_attributes else None
+    features = MultiScaleWindows(state.drop(columns='ts_ns'), bitsets).compute_features(window_seconds)
+    return pd.concat([state.loc[current, feature_columns.CONN_IDS_COLS].reset_index(drop=True),
+                      features[current].reset_index(drop=True)], axis=1)
+
+
+def compute_out_of_core(input_files, output_csv, window_seconds, memory_budget, chunk_size=200000,
+                        temp_directory=None, similar_attributes=False):
+    """
+    :param memory_budget: bound of memory of the features computation in bytes
+    :return: number of connections written to the output file
+    """
+    columns = MULTISCALE_INPUT_COLS + (feature_columns.SIMILAR_ATTRIBUTES if similar_attributes else [])
+    window = max(window_seconds)
+    window_ns = window * responses.NANOSECONDS_IN_SECOND
+    row_bytes = BASE_ROW_BYTES + WINDOW_ROW_BYTES * len(window_seconds)
+    budget_rows = max(1, memory_budget // row_bytes)
+
+    # planning pass (only timestamps are read, seconds are counted in the chunk and merged):
+    counts = {}
+    for chunk in iter_input_chunks(input_files, ['connection.ts'], chunk_size):
+        seconds, second_counts = np.unique(chunk_seconds(chunk), return_counts=True)
+        for second, count in zip(seconds.tolist(), second_counts.tolist()):
+            counts[second] = counts.get(second, 0) + count
+    if not counts:
+        print('No connections in the input.')
+        return 0
+    first_second = min(counts)
+    second_counts = np.zeros(max(counts) - first_second + 1, dtype=np.int64)
+    second_counts[np.array(list(counts)) - first_second] = list(counts.values())
+    del counts
+    boundaries = plan_slices(second_counts, first_second, window, budget_rows)
+    print('{} connections split to {} slices (at most {} connections in memory).'.format(
+        second_counts.sum(), len(boundaries) - 1, budget_rows))
+
+    spill_directory = tempfile.mkdtemp(prefix='out_of_core_windows-', dir=temp_directory)
+    try:
+        slice_files = spill_slices(input_files, columns, chunk_size, boundaries, spill_directory)
+
+        written = 0
+        tail = read_slice('', columns)
+        # slice i and the following slices read for its head:
+        loaded = []
+        for i in range(len(slice_files)):
+            slice_end_ns = boundaries[i + 1] * responses.NANOSECONDS_IN_SECOND
+            while i + len(loaded) < len(slice_files) and \
+                    boundaries[i + len(loaded)] * responses.NANOSECONDS_IN_SECOND <= slice_end_ns + window_ns:
+                loaded.append(read_slice(slice_files[i + len(loaded)], columns))
+            current = loaded.pop(0)
+            head = pd.concat([following[following['ts_ns'] <= slice_end_ns + window_ns] for following in loaded] +
+                             [read_slice('', columns)], ignore_index=True)
+            if len(current):
+                state = pd.concat([tail, current, head], ignore_index=True)
+                is_current = np.zeros(len(state), dtype=bool)
+                is_current[len(tail):len(tail) + len(current)] = True
+                features = compute_slice_features(state, is_current, window_seconds, similar_attributes)
+                features.to_csv(output_csv, mode='w' if written == 0 else 'a', index=False, header=written == 0)
+                written += len(features)
+                print('Slice {}/{}: {} connections written.'.format(i + 1, len(slice_files), len(features)))
+
+            # carry-over state - connections which can be in windows of the next slices:
+            tail = pd.concat([tail, current], ignore_index=True)
+            tail = tail[tail['ts_ns'] > slice_end_ns - window_ns]
+            if os.path.exists(slice_files[i]):
+                os.remove(slice_files[i])
+        return written
+    finally:
+        shutil.rmtree(spill_directory, ignore_errors=True)
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='CONNECTIONS mode CSV files (output-o-<IP>.csv, globs are expanded) '
+                        'or partitioned datasets', nargs='+', required=True)
+    parser.add_argument('-o', '--output_csv', help='Output CSV file (connection ids + neighbourhood features)',
+                        type=str, default='multiscale_features.csv')
+    parser.add_argument('-w', '--windows', help='Half-widths of time windows in seconds', nargs='+', type=int,
+                        default=[10, 60, 300, 1800])
+    parser.add_argument('-m', '--memory_budget', help='Memory budget of the computation (e.g. 512M, 4G)',
+                        type=parse_memory_size, default=parse_memory_size('2G'))
+    parser.add_argument('-cs', '--chunk_size', help='Number of rows read from CSV at once', type=int, default=200000)
+    parser.add_argument('-td', '--temp_directory', help='Directory of spilled slices (default: system temporary '
+                        'directory)', type=str, default=None)
+    parser.add_argument('-sa', '--similar_attributes', help='Compute similar attribute counts from list columns of '
+                        'the input', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    input_files = [path for pattern in args.input_csv for path in (sorted(glob.glob(pattern)) or [pattern])]
+    rows = compute_out_of_core(input_files, args.output_csv, args.windows, args.memory_budget, args.chunk_size,
+                               args.temp_directory, args.similar_attributes)
+    print('Successfully wrote {} connections to file {}.'.format(rows, args.output_csv))
@@ -5,6 +5,7 @@
 import orjson as json
 import pandas as pd
 from itertools import groupby
+from dgraph_queries import CONNECTION_PREDICATES
 
 
 def concat_multiple_dfs(dfs):
@@ -34,7 +35,115 @@ def unique_and_count(lst):
     return [dict(k + [("count", len(list(g)))]) for k, g in grouper]
 
 
-def convert_json_to_csv_conns(json_input, mode):
+APP_DATA_NAMES = ['dns', 'ssh', 'http', 'ssl', 'files']
+
+# app data concrete attribute values for similarity computation: { app data name -> [(column, app data key)] }
+# (files additionally produce 'file_md5' column with MD5 hashes of all files of the connection)
+APP_DATA_ATTRIBUTES = {
+    'dns': [('dns_qtype', 'dns.qtype'), ('dns_rcode', 'dns.rcode')],
+    'ssh': [('ssh_auth_attempts', 'ssh.auth_attempts'), ('ssh_host_key', 'ssh.host_key')],
+    'http': [('http_method', 'http.method'), ('http_status_code', 'http.status_code'),
+             ('http_user_agent', 'http.user_agent')],
+    'ssl': [('ssl_version', 'ssl.version'), ('ssl_cipher', 'ssl.cipher'), ('ssl_curve', 'ssl.curve'),
+            ('ssl_validation_status', 'ssl.validation_status')],
+    'files': [('files_source', 'files.source')]
+}
+
+
+# how app data attribute values are written: 'columns' - list columns on connection rows, 'tables' - normalized app
+# data tables keyed by connection.uid (see app_tables.py), only <app>_count columns stay on connection rows
+APP_DATA_LAYOUTS = ['columns', 'tables']
+
+# columns of normalized app data tables (one row per app data record, files: one row per file of the record):
+APP_TABLE_COLUMNS = {app_data_name: ['connection.uid'] + [column for column, _ in attributes] +
+                     (['file_md5'] if app_data_name == 'files' else [])
+                     for app_data_name, attributes in APP_DATA_ATTRIBUTES.items()}
+
+
+def get_app_data_columns(app_families):
+    """
+    :return: (attribute columns, dict columns) produced for the app data families
+    """
+    attribute_columns = []
+    for app_data_name in app_families:
+        attribute_columns += [column for column, _ in APP_DATA_ATTRIBUTES[app_data_name]]
+        if app_data_name == 'files':
+            attribute_columns.append('file_md5')
+    return attribute_columns, [app_data_name + '_dicts' for app_data_name in app_families]
+
+
+def flatten_app_data(produced, app_families):
+    """
+    Flatten connection.produced list of one connection.
+
+    :return: (dictionary { app data name -> count }, dictionary { attribute column -> set of values },
+              dictionary { app data name -> list of app data dictionaries })
+    """
+    counts = dict.fromkeys(APP_DATA_NAMES, 0)
+    attribute_values = {column: set() for column in get_app_data_columns(app_families)[0]}
+    app_dicts = {app_data_name: [] for app_data_name in app_families}
+
+    for app_data in produced:
+        app_data_name = str(app_data['type'][0]).lower()
+
+        if app_data_name in counts:
+            counts[app_data_name] += 1
+
+        if app_data_name not in app_dicts:
+            continue
+
+        # values of keys in specified app data:
+        temp_dict = {}
+        for column, app_data_key in APP_DATA_ATTRIBUTES[app_data_name]:
+            value = get_app_data_value(app_data, app_data_key)
+            attribute_values[column].add(value)
+            temp_dict[app_data_key] = value
+
+        if app_data_name == 'files':
+            # TODO: mime_type, local_orig, is_orig, timedout?
+            for file in app_data.get('files.fuid', []):
+                attribute_values['file_md5'].add(file['file.md5'])
+            temp_dict['file.md5s'] = attribute_values['file_md5']
+
+        app_dicts[app_data_name].append(temp_dict)
+
+    return counts, attribute_values, app_dicts
+
+
+def flatten_app_records(uids, produced_column, app_families):
+    """
+    Flatten connection.produced lists to normalized app data records.
+
+    :return: dictionary { app data name -> DataFrame with APP_TABLE_COLUMNS }
+    """
+    records = {app_data_name: [] for app_data_name in app_families}
+    for uid, produced in zip(uids, produced_column):
+        for app_data in produced if isinstance(produced, list) else []:
+            app_data_name = str(app_data['type'][0]).lower()
+            if app_data_name not in records:
+                continue
+
+            values = [uid] + [get_app_data_value(app_data, app_data_key)
+                              for _, app_data_key in APP_DATA_ATTRIBUTES[app_data_name]]
+            if app_data_name == 'files':
+                for file in app_data.get('files.fuid', []) or [{}]:
+                    records[app_data_name].append(values + [file.get('file.md5')])
+            else:
+                records[app_data_name].append(values)
+
+    return {app_data_name: pd.DataFrame(rows, columns=APP_TABLE_COLUMNS[app_data_name])
+            for app_data_name, rows in records.items()}
+
+
+def convert_json_to_csv_conns(json_input, mode, profile='full', app_families=None, app_data_layout='columns'):
+    """
+    Flatten a page of host connections. Columns produced from connection.produced app data follow the projection
+    profile of the query (see dgraph_queries.PROJECTION_PROFILES):
+    'core' - no app data columns, 'core+app_counts' - only <app>_count columns, 'core+app' - counts and attribute
+    columns of app_families (all by default), 'full' - counts and attribute columns of all app data.
+
+    :return: DataFrame, or (DataFrame, app data records - see flatten_app_records) for the 'tables' app data layout
+    """
     # set JSON query objects name according to mode (reflects same strings as used in the query definition)
     if mode == 'originated':
         query_name = 'queryHostOriginated'
@@ -49,7 +158,7 @@ def convert_json_to_csv_conns(json_input, mode):
     df = json.loads(json_input)
     loaded_host_ip = pd.json_normalize(df[query_name])
     loaded_host_originated = pd.json_normalize(data=df[query_name], record_path=conns_edge_direction)
-    loaded_host_originated = loaded_host_originated.drop(reverse_edge_direction, 1)
+    loaded_host_originated = loaded_host_originated.drop(reverse_edge_direction, axis=1)
     loaded_host_responded = pd.json_normalize(data=df[query_name], record_path=[conns_edge_direction,
                                                                                 reverse_edge_direction])
     joined1 = pd.concat([loaded_host_originated, loaded_host_responded], axis=1)
@@ -58,165 +167,100 @@ def convert_json_to_csv_conns(json_input, mode):
     new_df = new_df.loc[new_df.index.repeat(n_repeat)].reset_index(drop=True)
     final = pd.concat([new_df, joined1], axis=1)
 
+    return add_app_data_columns(final, profile, app_families, app_data_layout)
+
+
+def get_profile_app_families(profile='full', app_families=None):
+    """
+    :return: app data families whose attribute columns are produced in the projection profile
+    """
+    if profile in ('core', 'core+app_counts'):
+        return []
+    if profile == 'core+app':
+        return [app_data_name for app_data_name in APP_DATA_NAMES
+                if not app_families or app_data_name in app_families]
+    return APP_DATA_NAMES
+
+
+def add_app_data_columns(final, profile='full', app_families=None, app_data_layout='columns'):
+    """
+    Replace connection.produced column of flattened connections by app data columns of the projection profile.
+
+    :return: DataFrame, or (DataFrame, app data records - see flatten_app_records) for the 'tables' app data layout
+    """
+    if app_data_layout == 'tables':
+        # only counts stay on connection rows, attribute values go to the app data records:
+        app_families = get_profile_app_families(profile, app_families)
+        records = flatten_app_records(final['connection.uid'], final['connection.produced'], app_families) \
+            if 'connection.produced' in final else flatten_app_records([], [], app_families)
+        return add_app_data_columns(final, 'core+app_counts' if profile != 'core' else 'core'), records
+
+    if profile == 'core':
+        return final.drop('connection.produced', axis=1, errors='ignore')
+
+    app_families = get_profile_app_families(profile, app_families)
+    attribute_columns, dict_columns = get_app_data_columns(app_families)
+
     # app data counts from connection.produced:
-    final['dns_count'] = 0
-    final['ssh_count'] = 0
-    final['http_count'] = 0
-    final['ssl_count'] = 0
-    final['files_count'] = 0
-
-    app_data_names = ['dns', 'ssh', 'http', 'ssl', 'files']
-
-    # app data concrete attribute values for similarity computation:
-    final['dns_qtype'] = ''
-    final['dns_rcode'] = ''
-    final['ssh_auth_attempts'] = ''
-    final['ssh_host_key'] = ''
-    final['http_method'] = ''
-    final['http_status_code'] = ''
-    final['http_user_agent'] = ''
-    final['ssl_version'] = ''
-    final['ssl_cipher'] = ''
-    final['ssl_curve'] = ''
-    final['ssl_validation_status'] = ''
-    final['files_source'] = ''
-    final['file_md5'] = ''
-
-    # app data in one column (for dev purposes right now):
-    final['dns_dicts'] = ''
-    final['ssh_dicts'] = ''
-    final['http_dicts'] = ''
-    final['ssl_dicts'] = ''
-    final['files_dicts'] = ''
+    for app_data_name in APP_DATA_NAMES:
+        final[app_data_name + '_count'] = 0
+
+    # app data concrete attribute values for similarity computation and app data in one column (for dev purposes):
+    for column in attribute_columns + dict_columns:
+        final[column] = ''
 
     if 'connection.produced' in final:
-        # https://stackoverflow.com/questions/23330654/update-a-dataframe-in-pandas-while-iterating-row-by-row
-        for i, row in final.iterrows():
-            if isinstance(row['connection.produced'], list):
-                dns_qtypes = set()
-                dns_rcodes = set()
-                ssh_auth_attempts = set()
-                ssh_host_keys = set()
-                http_methods = set()
-                http_status_codes = set()
-                http_user_agents = set()
-                ssl_versions = set()
-                ssl_ciphers = set()
-                ssl_curves = set()
-                ssl_validation_status = set()
-                files_sources = set()
-                file_md5s = set()
-
-                dns_dict = []
-                ssh_dict = []
-                http_dict = []
-                ssl_dict = []
-                files_dict = []
-
-                for app_data in row['connection.produced']:
-                    app_data_name = str(app_data['type'][0]).lower()
-
-                    if app_data_name in app_data_names:
-                        final.at[i, app_data_name + '_count'] += 1
-
-                        # values of keys in specified app data:
-
-                    if app_data_name == 'dns':
-                        dns_qtypes.add(get_app_data_value(app_data, 'dns.qtype'))
-                        dns_rcodes.add(get_app_data_value(app_data, 'dns.rcode'))
-                        # TODO: query substring, AA, (TC has only false), RD, RA, Z?
-
-                        temp_dict = {'dns.qtype': get_app_data_value(app_data, 'dns.qtype'),
-                                     'dns.rcode': get_app_data_value(app_data, 'dns.rcode')}
-                        dns_dict.append(temp_dict)
-
-                    elif app_data_name == 'ssh':
-                        ssh_auth_attempts.add(get_app_data_value(app_data, 'ssh.auth_attempts'))
-                        ssh_host_keys.add(get_app_data_value(app_data, 'ssh.host_key'))
-
-                        temp_dict = {'ssh.auth_attempts': get_app_data_value(app_data, 'ssh.auth_attempts'),
-                                     'ssh.host_key': get_app_data_value(app_data, 'ssh.host_key')}
-                        ssh_dict.append(temp_dict)
-                    elif app_data_name == 'http':
-                        http_methods.add(get_app_data_value(app_data, 'http.method'))
-                        http_status_codes.add(get_app_data_value(app_data, 'http.status_code'))
-                        http_user_agents.add(get_app_data_value(app_data, 'http.user_agent'))
-                        # TODO: trans_depth (interval), _body_len, resp_mime_types?
-
-                        temp_dict = {'http.method': get_app_data_value(app_data, 'http.method'),
-                                     'http.status_code': get_app_data_value(app_data, 'http.status_code'),
-                                     'http.user_agent': get_app_data_value(app_data, 'http.user_agent')}
-                        http_dict.append(temp_dict)
-                    elif app_data_name == 'ssl':
-                        ssl_versions.add(get_app_data_value(app_data, 'ssl.version'))
-                        ssl_ciphers.add(get_app_data_value(app_data, 'ssl.cipher'))
-                        ssl_curves.add(get_app_data_value(app_data, 'ssl.curve'))
-                        ssl_validation_status.add(get_app_data_value(app_data, 'ssl.validation_status'))
-                        # TODO: server_name substr, cipher redo (TLS_{sth from here}_..)?
-
-                        temp_dict = {'ssl.version': get_app_data_value(app_data, 'ssl.version'),
-                                     'ssl.cipher': get_app_data_value(app_data, 'ssl.cipher'),
-                                     'ssl.curve': get_app_data_value(app_data, 'ssl.curve'),
-                                     'ssl.validation_status': get_app_data_value(app_data, 'ssl.validation_status')}
-                        ssl_dict.append(temp_dict)
-                    elif app_data_name == 'files':
-                        files_sources.add(get_app_data_value(app_data, 'files.source'))
-                        # TODO: mime_type, local_orig, is_orig, timedout?
-
-                        files_list = app_data['files.fuid']
-                        for file in files_list:
-                            file_md5s.add(file['file.md5'])
-
-                        temp_dict = {'files.source': get_app_data_value(app_data, 'files.source'),
-                                     'file.md5s': file_md5s}
-                        files_dict.append(temp_dict)
-
-                final.at[i, 'dns_qtype'] = list(dns_qtypes)
-                final.at[i, 'dns_rcode'] = list(dns_rcodes)
-                final.at[i, 'ssh_auth_attempts'] = list(ssh_auth_attempts)
-                final.at[i, 'ssh_host_key'] = list(ssh_host_keys)
-                final.at[i, 'http_method'] = list(http_methods)
-                final.at[i, 'http_status_code'] = list(http_status_codes)
-                final.at[i, 'http_user_agent'] = list(http_user_agents)
-                final.at[i, 'ssl_version'] = list(ssl_versions)
-                final.at[i, 'ssl_cipher'] = list(ssl_ciphers)
-                final.at[i, 'ssl_curve'] = list(ssl_curves)
-                final.at[i, 'ssl_validation_status'] = list(ssl_validation_status)
-                final.at[i, 'files_source'] = list(files_sources)
-                final.at[i, 'file_md5'] = list(file_md5s)
-
-                dns_dict = unique_and_count(dns_dict)
-                final.at[i, 'dns_dicts'] = dns_dict
-                ssh_dict = unique_and_count(ssh_dict)
-                final.at[i, 'ssh_dicts'] = ssh_dict
-                http_dict = unique_and_count(http_dict)
-                final.at[i, 'http_dicts'] = http_dict
-                ssl_dict = unique_and_count(ssl_dict)
-                final.at[i, 'ssl_dicts'] = ssl_dict
-                files_dict = unique_and_count(files_dict)
-                final.at[i, 'files_dicts'] = files_dict
-            else:
-                final.at[i, 'dns_qtype'] = []
-                final.at[i, 'dns_rcode'] = []
-                final.at[i, 'ssh_auth_attempts'] = []
-                final.at[i, 'ssh_host_key'] = []
-                final.at[i, 'http_method'] = []
-                final.at[i, 'http_status_code'] = []
-                final.at[i, 'http_user_agent'] = []
-                final.at[i, 'ssl_version'] = []
-                final.at[i, 'ssl_cipher'] = []
-                final.at[i, 'ssl_curve'] = []
-                final.at[i, 'ssl_validation_status'] = []
-                final.at[i, 'files_source'] = []
-                final.at[i, 'file_md5'] = []
-
-                final.at[i, 'dns_dicts'] = []
-                final.at[i, 'ssh_dicts'] = []
-                final.at[i, 'http_dicts'] = []
-                final.at[i, 'ssl_dicts'] = []
-                final.at[i, 'files_dicts'] = []
-
-        final = final.drop('connection.produced', 1)
+        counts = {app_data_name: [] for app_data_name in APP_DATA_NAMES}
+        attribute_values = {column: [] for column in attribute_columns}
+        app_dicts = {app_data_name: [] for app_data_name in app_families}
+
+        for produced in final['connection.produced']:
+            row_counts, row_attribute_values, row_app_dicts = \
+                flatten_app_data(produced if isinstance(produced, list) else [], app_families)
+
+            for app_data_name in APP_DATA_NAMES:
+                counts[app_data_name].append(row_counts[app_data_name])
+            for column in attribute_columns:
+                attribute_values[column].append(list(row_attribute_values[column]))
+            for app_data_name in app_families:
+                app_dicts[app_data_name].append(unique_and_count(row_app_dicts[app_data_name]))
+
+        for app_data_name in APP_DATA_NAMES:
+            final[app_data_name + '_count'] = counts[app_data_name]
+        for column in attribute_columns:
+            final[column] = pd.Series(attribute_values[column], index=final.index, dtype=object)
+        for app_data_name in app_families:
+            final[app_data_name + '_dicts'] = pd.Series(app_dicts[app_data_name], index=final.index, dtype=object)
+
+        final = final.drop('connection.produced', axis=1)
 
     return final
 
+
+def export_columns(profile='full', app_families=None, app_data_layout='columns'):
+    """
+    :return: columns of the connections table of the EXPORT mode (the columns of CONNECTIONS mode output files)
+    """
+    columns = ['originated_ip', 'uid'] + CONNECTION_PREDICATES + ['responded_ip']
+    if profile == 'core':
+        return columns
+    if app_data_layout == 'tables':
+        return columns + [app_data_name + '_count' for app_data_name in APP_DATA_NAMES]
+    attribute_columns, dict_columns = get_app_data_columns(get_profile_app_families(profile, app_families))
+    return columns + [app_data_name + '_count' for app_data_name in APP_DATA_NAMES] + attribute_columns + dict_columns
+
+
+def convert_connections_page(page, profile='full', app_families=None, app_data_layout='columns'):
+    """
+    Flatten a page of all connections (responses.ConnectionsPage) to the columns of export_columns.
+
+    :return: DataFrame, or (DataFrame, app data records - see flatten_app_records) for the 'tables' app data layout
+    """
+    final = pd.DataFrame(page.connections)
+    final.insert(0, 'originated_ip', page.originated_ips)
+    final['responded_ip'] = page.responded_ips
+    columns = export_columns(profile, app_families, app_data_layout)
+    if app_data_layout == 'tables':
+        final, records = add_app_data_columns(final, profile, app_families, app_data_layout)
+        return final.reindex(columns=columns), records
+    return add_app_data_columns(final, profile, app_families).reindex(columns=columns)
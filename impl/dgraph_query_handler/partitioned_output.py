@@ -0,0 +1,242 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Partitioned output layout of connections of hosts ('partitioned' output layout of the CONNECTIONS and EXPORT modes of
+query_handler.py) instead of one small file per host and direction (output-o-<IP>.csv, output-r-<IP>.csv).
+
+Connections of all hosts are appended to a few large partition files - by day of connection.ts and by hash of the
+host IP:
+
+  <output_path>-partitioned/day=<YYYY-MM-DD>/part-<crc32(IP) % partitions>.gz
+  <output_path>-partitioned/index.csv     host_ip, direction (o/r), day, file, offset, length, rows
+
+Connections of a host, direction and day are one block - a gzip member with CSV text (header and rows with the columns
+of CONNECTIONS mode output files). The index maps the block to its byte range, so a host is read by one seek and one
+read per day, and a full scan reads partition files sequentially in large blocks. A partition file is a valid gzip
+file (concatenated members), so it can also be decompressed by standard tools (headers are repeated per block).
+
+Usage: $ python3 partitioned_output.py -d output-partitioned [--host <IP> --direction o -o output-o-<IP>.csv]
+       $ python3 partitioned_output.py -d output-partitioned -i originated/output-o-*.csv responded/output-r-*.csv
+"""
+
+import os
+import io
+import re
+import gzip
+import zlib
+import shutil
+import argparse
+import threading
+import pandas as pd
+
+
+OUTPUT_LAYOUTS = ['files', 'partitioned']
+INDEX_COLUMNS = ['host_ip', 'direction', 'day', 'file', 'offset', 'length', 'rows']
+DEFAULT_PARTITIONS = 16
+
+# host and direction of a CONNECTIONS mode output file (output-o-<IP>.csv):
+HOST_FILE_PATTERN = re.compile(r'-(o|r)-(.+)\.csv$')
+
+
+def dataset_directory(output_path):
+    return output_path + '-partitioned'
+
+
+def index_file(directory):
+    return os.path.join(directory, 'index.csv')
+
+
+def host_partition(host_ip, partitions):
+    """
+    :return: partition of the host (stable across runs and processes, unlike hash())
+    """
+    return zlib.crc32(str(host_ip).encode()) % partitions
+
+
+class PartitionedWriter:
+    """
+    Appends blocks of connections of hosts to partition files (thread-safe, blocks are compressed outside the lock).
+
+    :ivar directory: directory of the dataset (a dataset of a previous run is replaced)
+    :ivar partitions: number of host hash partitions of a day
+    :ivar compresslevel: gzip compression level of blocks
+    """
+
+    def __init__(self, directory, partitions=DEFAULT_PARTITIONS, compresslevel=6):
+        self.directory = directory
+        self.partitions = partitions
+        self.compresslevel = compresslevel
+        self._lock = threading.Lock()
+        self._files = {}
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        self._index = open(index_file(directory), 'w')
+        self._index.write(','.join(INDEX_COLUMNS) + '\n')
+
+    def write_host(self, host_ip, direction, df):
+        """
+        :param direction: 'o' (originated connections of the host) or 'r' (responded connections of the host)
+        :param df: connections of the host (CONNECTIONS mode output columns)
+        """
+        days = df['connection.ts'].astype(str).str[:10] if 'connection.ts' in df else pd.Series('', index=df.index)
+        days = days.replace({'': 'unknown', 'nan': 'unknown'})
+        for day, rows in df.groupby(days.to_numpy(), sort=True):
+            block = gzip.compress(rows.to_csv(index=False, header=True).encode(), compresslevel=self.compresslevel)
+            file_name = os.path.join('day=' + day, 'part-{:05d}.gz'.format(host_partition(host_ip, self.partitions)))
+            with self._lock:
+                partition_file = self._files.get(file_name)
+                if partition_file is None:
+                    os.makedirs(os.path.join(self.directory, 'day=' + day), exist_ok=True)
+                    partition_file = self._files[file_name] = open(os.path.join(self.directory, file_name), 'ab')
+                offset = partition_file.tell()
+                partition_file.write(block)
+                self._index.write('{},{},{},{},{},{},{}\n'.format(host_ip, direction, day, file_name, offset,
+                                                                  len(block), len(rows)))
+
+    def close(self):
+        with self._lock:
+            for partition_file in self._files.values():
+                partition_file.close()
+            self._files = {}
+            self._index.close()
+
+
+class PartitionedDataset:
+    """
+    :ivar directory: directory of the dataset
+    :ivar index: DataFrame of blocks (INDEX_COLUMNS)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = pd.read_csv(index_file(directory), dtype={'host_ip': str, 'direction': str, 'day': str,
+                                                               'file': str})
+        # (host IP, direction) -> positions of its blocks in the index:
+        self.host_blocks = self.index.groupby(['host_ip', 'direction']).indices
+
+    def hosts(self, direction='o'):
+        return self.index.loc[self.index['direction'] == direction, 'host_ip'].unique().tolist()
+
+    def read_blocks(self, blocks, **read_csv_kwargs):
+        """
+        Read blocks in the order of files and offsets (one open per file, sequential reads).
+
+        :param blocks: rows of the index
+        :param read_csv_kwargs: arguments of pandas.read_csv (usecols, dtype, ...)
+        :return: generator of (index row, DataFrame)
+        """
+        for file_name, file_blocks in blocks.sort_values(['file', 'offset']).groupby('file', sort=False):
+            with open(os.path.join(self.directory, file_name), 'rb') as partition_file:
+                for block in file_blocks.itertuples(index=False):
+                    partition_file.seek(block.offset)
+                    data = gzip.decompress(partition_file.read(block.length))
+                    yield block, pd.read_csv(io.BytesIO(data), **read_csv_kwargs)
+
+    def scan(self, blocks, **read_csv_kwargs):
+        """
+        Read blocks in the order of files and offsets, consecutive blocks with the same header are parsed at once.
+
+        :return: generator of DataFrames
+        """
+        for file_name, file_blocks in blocks.sort_values(['file', 'offset']).groupby('file', sort=False):
+            with open(os.path.join(self.directory, file_name), 'rb') as partition_file:
+                header = None
+                bodies = []
+                for block in file_blocks.itertuples(index=False):
+                    partition_file.seek(block.offset)
+                    block_header, _, body = gzip.decompress(partition_file.read(block.length)).partition(b'\n')
+                    if block_header != header and bodies:
+                        yield pd.read_csv(io.BytesIO(b'\n'.join([header] + bodies)), **read_csv_kwargs)
+                        bodies = []
+                    header = block_header
+                    bodies.append(body.rstrip(b'\n'))
+                if bodies:
+                    yield pd.read_csv(io.BytesIO(b'\n'.join([header] + bodies)), **read_csv_kwargs)
+
+    def read_host(self, host_ip, direction='o', **read_csv_kwargs):
+        """
+        :return: DataFrame of connections of the host (as in the file output-<direction>-<IP>.csv), None if the
+                 dataset has no connections of the host
+        """
+        positions = self.host_blocks.get((host_ip, direction), [])
+        frames = [df for _, df in self.read_blocks(self.index.iloc[positions].sort_values('day'), **read_csv_kwargs)]
+        return pd.concat(frames, ignore_index=True) if frames else None
+
+    def read_direction(self, direction='o', **read_csv_kwargs):
+        """
+        :return: DataFrame of connections of all hosts in the direction (every connection is originated by one host,
+                 so direction 'o' contains every connection once)
+        """
+        frames = list(self.scan(self.index[self.index['direction'] == direction], **read_csv_kwargs))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def read_connections(input_path, **read_csv_kwargs):
+    """
+    :param input_path: CONNECTIONS mode CSV file or directory of a partitioned dataset (originated connections)
+    """
+    if os.path.isdir(input_path):
+        return PartitionedDataset(input_path).read_direction('o', **read_csv_kwargs)
+    return pd.read_csv(input_path, **read_csv_kwargs)
+
+
+def write_host_files(input_files, directory, partitions=DEFAULT_PARTITIONS):
+    """
+    Convert CONNECTIONS mode output files (output-o-<IP>.csv, output-r-<IP>.csv) to a partitioned dataset.
+
+    :return: number of converted files
+    """
+    writer = PartitionedWriter(directory, partitions)
+    converted = 0
+    for input_file in input_files:
+        match = HOST_FILE_PATTERN.search(os.path.basename(input_file))
+        if not match:
+            print('Skipping ' + input_file + ' (not a CONNECTIONS mode output file).')
+            continue
+        # values are copied as text:
+        writer.write_host(match.group(2), match.group(1), pd.read_csv(input_file, dtype=str, keep_default_na=False))
+        converted += 1
+    writer.close()
+    return converted
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--dataset', help='Directory of the partitioned dataset', type=str, required=True)
+    parser.add_argument('-i', '--input_csv', help='CONNECTIONS mode output files converted to the dataset', nargs='+',
+                        default=None)
+    parser.add_argument('-pn', '--partitions', help='Number of host hash partitions of a day', type=int,
+                        default=DEFAULT_PARTITIONS)
+    parser.add_argument('--host', help='IP address of the host to be extracted', type=str, default=None)
+    parser.add_argument('--direction', help='Direction of the extracted connections', choices=['o', 'r'], default='o')
+    parser.add_argument('-o', '--output_csv', help='Output CSV file of the extracted host', type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    if args.input_csv:
+        print('Converted {} files.'.format(write_host_files(args.input_csv, args.dataset, args.partitions)))
+
+    dataset = PartitionedDataset(args.dataset)
+    if args.host:
+        host_df = dataset.read_host(args.host, args.direction, dtype=str, keep_default_na=False)
+        output_csv = args.output_csv or 'output-' + args.direction + '-' + args.host + '.csv'
+        if host_df is None:
+            print('No connections of host ' + args.host + '.')
+        else:
+            host_df.to_csv(output_csv, index=False, header=True)
+            print('Successfully wrote to file ' + output_csv + '.')
+    else:
+        print('{} blocks of {} hosts in {} files, {} originated connections.'.format(
+            len(dataset.index), dataset.index['host_ip'].nunique(), dataset.index['file'].nunique(),
+            dataset.index.loc[dataset.index['direction'] == 'o', 'rows'].sum()))
@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Staged producer/consumer pipeline used by the 'CONNECTIONS mode' of query_handler.py:
+
+  fetch threads --(page queue)--> convert processes --(write queues)--> writer threads
+
+Each stage has its own concurrency and the stages are connected by bounded queues. A stage that falls behind blocks
+the stages before it (backpressure), so the run is limited by the slowest stage instead of the sum of all stages.
+"""
+
+import time
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+
+
+# marks the end of the stream of pages in a queue:
+END_OF_STREAM = None
+
+
+class StageStats:
+    """
+    Thread-safe counters of processed items and busy time of each pipeline stage.
+
+    :ivar items: dictionary { stage name -> number of processed items }
+    :ivar busy_seconds: dictionary { stage name -> time spent working on items }
+    :ivar failed: list of (host IP, mode) whose output was not written because of an error
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.busy_seconds = {}
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.items[stage] = self.items.get(stage, 0) + 1
+            self.busy_seconds[stage] = self.busy_seconds.get(stage, 0.0) + seconds
+
+    def add_failure(self, host_ip, mode):
+        with self._lock:
+            self.failed.append((host_ip, mode))
+
+    def print_summary(self):
+        for stage in self.items:
+            print('Stage {:8}: {:7} items, busy {:.2f} s'.format(stage, self.items[stage], self.busy_seconds[stage]))
+        if self.failed:
+            print('Output of {} hosts is not written because of errors.'.format(len(self.failed)))
+
+
+def fetch_stage(task_queue, page_queue, fetch_func, stats):
+    """
+    Takes (host IP, mode) tasks and puts every page returned by fetch_func to the page queue. After the last page of
+    a host, a marker (page number None) is put to the queue carrying information whether all pages were fetched.
+    """
+    while True:
+        try:
+            host_ip, mode = task_queue.get_nowait()
+        except queue.Empty:
+            return
+
+        page_number = 0
+        complete = True
+        pages = fetch_func(host_ip, mode)
+        while True:
+            start = time.perf_counter()
+            try:
+                result = next(pages)
+            except StopIteration:
+                break
+            except Exception as e:
+                print('Exception thrown while fetching connections of ' + host_ip + ' (' + mode + '): ' + str(e))
+                complete = False
+                break
+            stats.add('fetch', time.perf_counter() - start)
+
+            page_queue.put((host_ip, mode, page_number, result))
+            page_number += 1
+
+        page_queue.put((host_ip, mode, None, complete))
+
+
+def timed_convert(convert_func, page, mode):
+    start = time.perf_counter()
+    return convert_func(page, mode), time.perf_counter() - start
+
+
+def failed_future(exception):
+    future = concurrent.futures.Future()
+    future.set_exception(exception)
+    return future
+
+
+def convert_stage(page_queue, write_queues, executor, convert_func):
+    """
+    Submits fetched pages to the process pool. Futures are passed to the writer responsible for the host, so pages of
+    one host always stay in the same (ordered) writer queue. A page that cannot be submitted (e.g. broken process pool)
+    is passed as a failed future, so the writer reports the host as failed and the queues keep draining.
+    """
+    while True:
+        item = page_queue.get()
+        if item is END_OF_STREAM:
+            for write_queue in write_queues:
+                write_queue.put(END_OF_STREAM)
+            return
+
+        host_ip, mode, page_number, payload = item
+        if page_number is not None:
+            try:
+                payload = executor.submit(timed_convert, convert_func, payload, mode)
+            except Exception as e:
+                payload = failed_future(e)
+        write_queues[hash((host_ip, mode)) % len(write_queues)].put((host_ip, mode, page_number, payload))
+
+
+def write_stage(write_queue, write_func, stats):
+    """
+    Collects converted pages of each host and calls write_func once the last page of the host arrives. An error of
+    write_func fails the host only, the writer keeps taking items from its queue (otherwise the queue fills and the
+    other stages block).
+    """
+    converted_pages = {}
+    failed = set()
+    while True:
+        item = write_queue.get()
+        if item is END_OF_STREAM:
+            return
+
+        host_ip, mode, page_number, payload = item
+        key = (host_ip, mode)
+        if page_number is not None:
+            # waiting for the oldest conversion keeps the number of conversions in flight bounded by the queue size:
+            try:
+                hosts_df, convert_seconds = payload.result()
+                converted_pages.setdefault(key, []).append(hosts_df)
+                stats.add('convert', convert_seconds)
+            except Exception as e:
+                print('Exception thrown while converting connections of ' + host_ip + ' (' + mode + '): ' + str(e))
+                failed.add(key)
+            continue
+
+        hosts_dfs = converted_pages.pop(key, [])
+        if not payload or key in failed:
+            failed.discard(key)
+            stats.add_failure(host_ip, mode)
+            print('Connections of ' + host_ip + ' (' + mode + ') are incomplete, output is not written.')
+        elif hosts_dfs:
+            start = time.perf_counter()
+            try:
+                write_func(host_ip, mode, hosts_dfs)
+            except Exception as e:
+                stats.add_failure(host_ip, mode)
+                print('Exception thrown while writing connections of ' + host_ip + ' (' + mode + '): ' + str(e))
+                continue
+            stats.add('write', time.perf_counter() - start)
+        else:
+            print('No result returned for IP ' + host_ip + ' (' + mode + ').')
+
+
+def run_pipeline(tasks, fetch_func, convert_func, write_func, fetch_workers=4, convert_workers=None, write_workers=1,
+                 queue_size=16):
+    """
+    Run the staged pipeline over all tasks.
+
+    :param tasks: iterable of (host IP, mode) tuples
+    :param fetch_func: generator function (host IP, mode) -> pages of query results (called in threads)
+    :param convert_func: picklable function (page, mode) -> DataFrame (called in worker processes started by a fork
+                         server - forking the process with running gRPC threads of fetch stages is not safe)
+    :param write_func: function (host IP, mode, list of DataFrames) -> None (called in threads)
+    :param fetch_workers: number of threads performing Dgraph queries
+    :param convert_workers: number of processes converting pages (None = number of CPUs)
+    :param write_workers: number of threads writing output
+    :param queue_size: capacity of every queue between stages
+    :return: statistics of the stages
+    """
+    task_queue = queue.Queue()
+    for task in tasks:
+        task_queue.put(task)
+
+    page_queue = queue.Queue(maxsize=queue_size)
+    write_queues = [queue.Queue(maxsize=queue_size) for _ in range(write_workers)]
+    stats = StageStats()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=convert_workers,
+                                                mp_context=multiprocessing.get_context('forkserver')) as executor:
+        writers = [threading.Thread(target=write_stage, args=(write_queue, write_func, stats))
+                   for write_queue in write_queues]
+        converter = threading.Thread(target=convert_stage, args=(page_queue, write_queues, executor, convert_func))
+        fetchers = [threading.Thread(target=fetch_stage, args=(task_queue, page_queue, fetch_func, stats))
+                    for _ in range(fetch_workers)]
+
+        for thread in writers + [converter] + fetchers:
+            thread.start()
+
+        for fetcher in fetchers:
+            fetcher.join()
+        page_queue.put(END_OF_STREAM)
+        converter.join()
+        for writer in writers:
+            writer.join()
+
+    return stats
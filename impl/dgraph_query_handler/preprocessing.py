@@ -0,0 +1,347 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Data preparation of the final neighbourhood dataset fitted chunk by chunk and reusable at scoring time.
+
+The model notebooks one-hot encode categorical columns into dense OHE_* columns, scale the whole DataFrame and run
+a full PCA - the dense matrix is in memory at least twice. Preprocessor is fitted over chunks of rows instead:
+
+  * first pass - running mean and variance of numerical columns (missing values are ignored) and categories of
+    categorical columns (in the order of appearance, as pandas.factorize),
+  * second pass (only if n_components is set) - sklearn IncrementalPCA over chunks of scaled numerical columns
+    and one-hot encoded categorical columns (only one chunk is dense at a time).
+
+Output of transform:
+
+  * numerical columns standardized (missing values become 0 - the mean) or unchanged (missing values become the
+    mean) if standardize is disabled,
+  * categorical columns as int codes (-1 = missing or unknown category, input of k-prototypes) or as a scipy sparse
+    one-hot matrix,
+  * or the PCA projection, computed directly from codes (no one-hot matrix is built).
+
+The fitted state is stored in a numpy .npz archive (no pickle) and can be embedded in a cluster_model.ClusterModel.
+
+Usage: $ python3 preprocessing.py -i FINAL_neighbourhood_both_days.csv -o preprocessor.npz
+         -ng CONN_NUMERICAL_COLS CONN_APP_STATS [-cc orig_p_cat resp_p_cat protocol service conn_state -pc 150
+         -cs 200000 -t projection.npy]
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import orjson as json
+from scipy import sparse
+from sklearn.decomposition import IncrementalPCA
+import feature_columns
+
+
+CATEGORICAL_OUTPUTS = ['codes', 'onehot']
+
+
+def merge_moments(count, mean, m2, batch):
+    """
+    Merge column statistics with a batch (parallel algorithm of Chan et al.), missing values are ignored.
+
+    :return: (count, mean, sum of squared deviations) per column
+    """
+    valid = ~np.isnan(batch)
+    batch_count = valid.sum(axis=0)
+    batch_mean = np.divide(np.nansum(batch, axis=0), batch_count, out=np.zeros(batch.shape[1]),
+                           where=batch_count > 0)
+    batch_m2 = np.nansum((batch - batch_mean) ** 2, axis=0)
+
+    total = count + batch_count
+    delta = batch_mean - mean
+    weight = np.divide(batch_count, total, out=np.zeros(batch.shape[1]), where=total > 0)
+    return total, mean + delta * weight, m2 + batch_m2 + delta ** 2 * count * weight
+
+
+class Preprocessor:
+    """
+    :ivar numeric_columns: numerical input columns
+    :ivar categorical_columns: categorical input columns
+    :ivar categories: dictionary { categorical column -> list of categories (code = index in the list) }
+    :ivar n_rows: number of rows used by fit
+    :ivar mean: means of numerical columns
+    :ivar scale: standard deviations of numerical columns (1 for constant columns and if scaling is disabled)
+    :ivar components: PCA components (components x encoded features) or None
+    :ivar pca_mean: means of encoded features used by PCA
+    :ivar explained_variance_ratio: explained variance ratio of PCA components
+    """
+
+    def __init__(self, numeric_columns, categorical_columns, standardize=True, n_components=None,
+                 categorical_output='codes'):
+        """
+        :param numeric_columns: numerical input columns
+        :param categorical_columns: categorical input columns
+        :param standardize: scale numerical columns to zero mean and unit variance
+        :param n_components: number of PCA components (transform returns the projection), None = no PCA
+        :param categorical_output: 'codes' (int codes) or 'onehot' (scipy sparse one-hot matrix)
+        """
+        if categorical_output not in CATEGORICAL_OUTPUTS:
+            raise ValueError('categorical_output must be one of {}'.format(CATEGORICAL_OUTPUTS))
+        self.numeric_columns = list(numeric_columns)
+        self.categorical_columns = list(categorical_columns)
+        self.standardize = standardize
+        self.n_components = n_components
+        self.categorical_output = categorical_output
+
+        self.categories = {column: [] for column in self.categorical_columns}
+        self.n_rows = 0
+        self.count = np.zeros(len(self.numeric_columns))
+        self.mean = np.zeros(len(self.numeric_columns))
+        self.m2 = np.zeros(len(self.numeric_columns))
+        self.scale = np.ones(len(self.numeric_columns))
+        self.components = None
+        self.pca_mean = None
+        self.explained_variance_ratio = None
+
+        self._category_index = {column: {} for column in self.categorical_columns}
+        self._pca = None
+        self._pca_pending = []
+
+    # fitting:
+
+    def partial_fit(self, df):
+        """
+        Update statistics of numerical columns and categories of categorical columns by a chunk of rows.
+        """
+        X_num = df.reindex(columns=self.numeric_columns).to_numpy(dtype=np.float64, na_value=np.nan)
+        self.n_rows += len(df)
+        self.count, self.mean, self.m2 = merge_moments(self.count, self.mean, self.m2, X_num)
+        if self.standardize:
+            std = np.sqrt(np.divide(self.m2, self.count, out=np.zeros(len(self.count)), where=self.count > 0))
+            self.scale = np.where(std > 0, std, 1.0)
+
+        for column in self.categorical_columns:
+            if column not in df.columns:
+                continue
+            index = self._category_index[column]
+            for category in pd.unique(df[column].dropna().astype(str)):
+                if category not in index:
+                    index[category] = len(self.categories[column])
+                    self.categories[column].append(category)
+        return self
+
+    def partial_fit_pca(self, df):
+        """
+        Update PCA by a chunk of rows (statistics have to be fitted before). Chunks smaller than n_components are
+        merged with the following ones.
+        """
+        if self._pca is None:
+            self._pca = IncrementalPCA(n_components=self.n_components)
+        self._pca_pending.append(self.encode_dense(df))
+        if sum(len(batch) for batch in self._pca_pending) >= self.n_components:
+            self._update_pca()
+        return self
+
+    def flush_pca(self):
+        """
+        Update PCA by the pending rows of chunks merged so far (only the first update needs n_components rows).
+        """
+        pending_rows = sum(len(batch) for batch in self._pca_pending)
+        if self.components is None and pending_rows < self.n_components:
+            raise ValueError('PCA with {} components needs at least as many rows, {} rows were given.'.format(
+                self.n_components, pending_rows))
+        if pending_rows:
+            self._update_pca()
+        return self
+
+    def _update_pca(self):
+        self._pca.partial_fit(np.vstack(self._pca_pending))
+        self._pca_pending = []
+        self.components = self._pca.components_
+        self.pca_mean = self._pca.mean_
+        self.explained_variance_ratio = self._pca.explained_variance_ratio_
+
+    def fit(self, read_chunks):
+        """
+        :param read_chunks: function returning a new iterator of DataFrame chunks (called once for every pass)
+        """
+        for chunk in read_chunks():
+            self.partial_fit(chunk)
+        if self.n_components:
+            if self.n_rows < self.n_components:
+                raise ValueError('PCA with {} components needs at least as many rows, the fit data has {} rows.'.format(
+                    self.n_components, self.n_rows))
+            for chunk in read_chunks():
+                self.partial_fit_pca(chunk)
+            # rows of the last chunks which did not fill a PCA batch:
+            self.flush_pca()
+        return self
+
+    # transformation:
+
+    @property
+    def n_categories(self):
+        return [len(self.categories[column]) for column in self.categorical_columns]
+
+    def feature_names(self):
+        """
+        :return: names of the output columns of transform (numerical and categorical part)
+        """
+        if self.n_components:
+            return ['pc_' + str(i) for i in range(self.n_components)], []
+        if self.categorical_output == 'onehot':
+            return self.numeric_columns, ['OHE_' + column + '_' + category for column in self.categorical_columns
+                                          for category in self.categories[column]]
+        return self.numeric_columns, self.categorical_columns
+
+    def encode_numeric(self, df):
+        X_num = df.reindex(columns=self.numeric_columns).to_numpy(dtype=np.float64, na_value=np.nan)
+        if not self.standardize:
+            return np.where(np.isnan(X_num), self.mean, X_num)
+        X_num -= self.mean
+        X_num /= self.scale
+        return np.nan_to_num(X_num, copy=False, nan=0.0)
+
+    def encode_categorical(self, df):
+        """
+        :return: int matrix of category codes (-1 = missing value or category not seen in fit)
+        """
+        X_cat = np.empty((len(df), len(self.categorical_columns)), dtype=np.int64)
+        for j, column in enumerate(self.categorical_columns):
+            values = df[column].astype(str).where(df[column].notna()) if column in df.columns \
+                else pd.Series(np.nan, index=df.index)
+            X_cat[:, j] = pd.Categorical(values, categories=self.categories[column]).codes
+        return X_cat
+
+    def one_hot(self, X_cat):
+        """
+        :return: scipy sparse CSR one-hot matrix of the codes (a row of a missing value has no entry)
+        """
+        offsets = np.concatenate([[0], np.cumsum(self.n_categories)])
+        valid = X_cat >= 0
+        rows = np.broadcast_to(np.arange(len(X_cat))[:, None], X_cat.shape)[valid]
+        columns = (X_cat + offsets[:-1])[valid]
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(X_cat), offsets[-1]))
+
+    def encode_dense(self, df):
+        """
+        :return: dense matrix of standardized numerical columns followed by one-hot encoded categorical columns
+        """
+        return np.hstack([self.encode_numeric(df), self.one_hot(self.encode_categorical(df)).toarray()])
+
+    def project(self, X_num, X_cat):
+        """
+        PCA projection of encoded rows; the one-hot part is a sum of gathered component columns.
+        """
+        if self.components is None:
+            raise ValueError('PCA is not fitted (fit the preprocessor or call flush_pca after partial_fit_pca).')
+        n_numeric = len(self.numeric_columns)
+        projection = (X_num - self.pca_mean[:n_numeric]) @ self.components[:, :n_numeric].T
+        projection -= self.pca_mean[n_numeric:] @ self.components[:, n_numeric:].T
+        offset = n_numeric
+        for j, n_categories in enumerate(self.n_categories):
+            valid = X_cat[:, j] >= 0
+            projection[valid] += self.components[:, offset + X_cat[valid, j]].T
+            offset += n_categories
+        return projection
+
+    def transform(self, df):
+        """
+        :return: (numerical output, categorical output) - see the module docstring
+        """
+        X_num = self.encode_numeric(df)
+        X_cat = self.encode_categorical(df)
+        if self.n_components:
+            return self.project(X_num, X_cat), np.zeros((len(df), 0), dtype=np.int64)
+        if self.categorical_output == 'onehot':
+            return X_num, self.one_hot(X_cat)
+        return X_num, X_cat
+
+    # persistence:
+
+    def to_arrays(self, prefix=''):
+        """
+        :return: dictionary of arrays of the fitted state (keys prefixed by prefix)
+        """
+        meta = {'numeric_columns': self.numeric_columns, 'categorical_columns': self.categorical_columns,
+                'categories': self.categories, 'standardize': self.standardize, 'n_components': self.n_components,
+                'categorical_output': self.categorical_output, 'n_rows': self.n_rows}
+        arrays = {'meta': np.frombuffer(json.dumps(meta), dtype=np.uint8), 'count': self.count, 'mean': self.mean,
+                  'm2': self.m2, 'scale': self.scale}
+        if self.components is not None:
+            arrays.update({'components': self.components, 'pca_mean': self.pca_mean,
+                           'explained_variance_ratio': self.explained_variance_ratio})
+        return {prefix + key: array for key, array in arrays.items()}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        meta = json.loads(arrays[prefix + 'meta'].tobytes())
+        preprocessor = cls(meta['numeric_columns'], meta['categorical_columns'], meta['standardize'],
+                           meta['n_components'], meta['categorical_output'])
+        preprocessor.categories = meta['categories']
+        preprocessor.n_rows = meta['n_rows']
+        preprocessor._category_index = {column: {category: i for i, category in enumerate(categories)}
+                                        for column, categories in preprocessor.categories.items()}
+        for key in ['count', 'mean', 'm2', 'scale']:
+            setattr(preprocessor, key, arrays[prefix + key])
+        if prefix + 'components' in arrays:
+            preprocessor.components = arrays[prefix + 'components']
+            preprocessor.pca_mean = arrays[prefix + 'pca_mean']
+            preprocessor.explained_variance_ratio = arrays[prefix + 'explained_variance_ratio']
+        return preprocessor
+
+    def save(self, file_name):
+        with open(file_name, 'wb') as file:
+            np.savez(file, **self.to_arrays())
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name, allow_pickle=False) as archive:
+            return cls.from_arrays({key: archive[key] for key in archive.files})
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='Final neighbourhood CSV file', type=str, required=True)
+    parser.add_argument('-o', '--output_file', help='Fitted preprocessor (.npz)', type=str, required=True)
+    parser.add_argument('-ng', '--numerical_groups', help='Column groups of numerical features (feature_columns.py)',
+                        nargs='+', required=True)
+    parser.add_argument('-cc', '--categorical_columns', help='Categorical columns', nargs='*',
+                        default=feature_columns.CONN_DERIVED_CATEGORICAL_COLS)
+    parser.add_argument('-pc', '--pca_components', help='Number of PCA components', type=int, default=None)
+    parser.add_argument('-cs', '--chunk_size', help='Number of rows read from CSV at once', type=int, default=200000)
+    parser.add_argument('-t', '--transform_output', help='Write transformed rows (PCA projection or standardized '
+                        'numerical columns) to this .npy file', type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    numerical_columns = [column for group in args.numerical_groups for column in feature_columns.COLUMN_GROUPS[group]]
+    usecols = set(numerical_columns + args.categorical_columns)
+
+    def read_chunks():
+        return pd.read_csv(args.input_csv, chunksize=args.chunk_size, low_memory=False,
+                           usecols=lambda column: column in usecols)
+
+    preprocessor = Preprocessor(numerical_columns, args.categorical_columns, n_components=args.pca_components)
+    preprocessor.fit(read_chunks)
+    preprocessor.save(args.output_file)
+    if preprocessor.explained_variance_ratio is not None:
+        print('Variance explained by {} principal components: {}'.format(
+            args.pca_components, preprocessor.explained_variance_ratio.sum()))
+    print('Successfully wrote preprocessor to file ' + args.output_file + '.')
+
+    if args.transform_output:
+        output = None
+        row = 0
+        for chunk in read_chunks():
+            transformed = preprocessor.transform(chunk)[0]
+            if output is None:
+                output = np.lib.format.open_memmap(args.transform_output, mode='w+', dtype=np.float64,
+                                                   shape=(preprocessor.n_rows, transformed.shape[1]))
+            output[row:row + len(chunk)] = transformed
+            row += len(chunk)
+        if output is not None:
+            output.flush()
+        print('Successfully wrote transformed rows to file ' + args.transform_output + '.')
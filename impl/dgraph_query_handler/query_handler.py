@@ -5,29 +5,69 @@
 """
 Connects to running Dgraph database on <dgraph_ip:dgraph_port>.
 
-2 modes:
+5 modes:
   'IPs mode' is used to get all host IPs in network. They are saved to a new file (one line contains one host IP).
   It has to be used beforehand, because the output file is used as input to the next mode.
       Usage: $ python3 query_handler.py -im -ou host_ips
 
   'CONNECTIONS mode' is used to get connections of all hosts whose IPs are in input file. The result JSON is then
-  flattened and the result for each host is saved to a separate CSV file.
-      Usage: $ python3 query_handler.py -cm --ips_csv host_ips.csv
-
-Usage: $ python3 query_handler.py <-im|-cm> -ip <dgraph_ip> -p <dgraph_port> -a <amount_on_page> -of <output_file>
-         -od <output_directory> --ips_csv <output_of_ips_mode>
+  flattened and the result for each host is saved to a separate CSV file. Querying, flattening and writing run as
+  a pipeline of concurrent stages (-fw fetch threads, -cw flattening processes, -ww writer threads).
+      Usage: $ python3 query_handler.py -cm --ips_csv host_ips.csv [-fw 4 -cw 8 -ww 1 -qs 16]
+  Columns fetched from connection.produced app data are selected by -pp projection profile (core, core+app_counts,
+  core+app with --app_families, full), -gc enables gRPC compression of queries and responses.
+      Usage: $ python3 query_handler.py -cm --ips_csv host_ips.csv -pp core+app --app_families dns http -gc gzip
+  With -adl tables, app data attribute values are written to normalized tables keyed by connection.uid (see
+  app_tables.py) instead of list columns of connection rows. With -ol partitioned, connections of hosts are appended
+  to compressed partition files by day and host hash with an index of blocks (see partitioned_output.py) instead of
+  files of hosts.
+
+  'NEIGHBOURHOOD mode' computes a time neighbourhood for each originated connection of all hosts whose IPs are in
+  input file. Hosts are processed by a pool of -np processes, the hosts with the most connections are handed out first.
+  Hosts with more than -st originated connections are split to time shards processed by different processes.
+      Usage: $ python3 query_handler.py -nm --ips_csv host_ips.csv [-np 32 -st 100000]
+  With -wq, tasks are taken from a lease-based work queue in a shared directory (see work_queue.py), so processes on
+  any number of nodes started with the same queue share the hosts (the first one plans the queue, a planner whose
+  lease expired is taken over).
+      Usage: $ python3 query_handler.py -nm --ips_csv host_ips.csv -wq /shared/neighbourhood-queue.sqlite [-ls 300
+               -pt 3600]
+
+  'EXPORT mode' scans all connections once (uid cursor pagination, both hosts resolved by reverse edges) and writes
+  them to one table, files of hosts as in the CONNECTIONS mode are derived from it locally (unless --table_only).
+      Usage: $ python3 query_handler.py -xm [--ips_csv host_ips.csv -pp core+app_counts --table_only]
+
+  'STREAMING mode' polls for connections newer than the persisted watermark (-wf) every -pi seconds and appends
+  their neighbourhoods to the files of their originators once the forward half-window of the neighbourhood is closed
+  (connections are held back in memory until connections newer than ts + window + -al seconds are loaded).
+      Usage: $ python3 query_handler.py -sm [--ips_csv host_ips.csv -wf watermark.json -pi 60 -al 30]
+
+Usage: $ python3 query_handler.py <-im|-cm|-xm|-nm|-sm> -ip <dgraph_ip> -p <dgraph_port> -a <amount_on_page>
+         -of <output_file> -od <output_directory> --ips_csv <output_of_ips_mode>
+Queries can be balanced over several alphas (-ep), transient errors are retried (-r) and slow queries hedged (-ha):
+       $ python3 query_handler.py -cm --ips_csv host_ips.csv -ep 10.0.0.1:9080 10.0.0.2:9080 -r 5 -ha 2.0
 """
 
+import os
 import sys
+import time
 import argparse
+import functools
 import orjson as json
-import dateutil.parser
 import datetime
 import multiprocessing
+import concurrent.futures
+import pipeline
+import app_tables
+import connections_export
+import scheduler
+import streaming
+import work_queue
+import partitioned_output
+import responses
 import pandas_funcs
 import pandas as pd
 import dgraph_queries as queries
-from dgraph_client import DgraphClient
+from dgraph_client import DgraphClient, DgraphQueryError, DgraphUnavailableError, GRPC_COMPRESSION
 
 
 COMMON_PORTS_MAPPER = {
@@ -73,41 +113,62 @@ def generate_empty_port_count_dictionary(first_direction, second_direction):
             prefix + prefix2 + '_resp_p_dyn_count': 0}
 
 
-def extract_mean_values(dgraph_client, first_direction, second_direction, uid, time_start, time_end):
+class DgraphNeighbourhoods:
+    """
+    Aggregates of time neighbourhoods queried from Dgraph (dgraph_queries.query_neighbourhood_* of the client). The
+    STREAMING mode computes the same responses from memory (streaming.WindowNeighbourhoods).
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def query_neighbourhood_mean(self, *query_args):
+        return queries.query_neighbourhood_mean(self.client, *query_args)
+
+    def query_neighbourhood_counts(self, *query_args):
+        return queries.query_neighbourhood_counts(self.client, *query_args)
+
+    def query_neighbourhood_port_counts(self, *query_args):
+        return queries.query_neighbourhood_port_counts(self.client, *query_args)
+
+    def query_neighbourhood_similar_counts(self, *query_args):
+        return queries.query_neighbourhood_similar_counts(self.client, *query_args)
+
+
+def extract_mean_values(neighbourhoods, first_direction, second_direction, uid, time_start, time_end):
     prefix = 'orig_' if first_direction == 'originated' else 'resp_'
     prefix2 = 'orig' if second_direction == 'originated' else 'resp'
-    neighbourhood_averages = queries.query_neighbourhood_mean(dgraph_client, first_direction, second_direction, uid,
-                                                              str(time_start), str(time_end))
-
-    if neighbourhood_averages:
-        neighbourhood_json = json.loads(neighbourhood_averages)
-        avg_json = neighbourhood_json['queryAverageNeighbourhood']
-
-        if avg_json:
-            average_over_all_conns = avg_json[0][f'~host.{first_direction}'][0]
-            avg_duration = average_over_all_conns['avg_duration']
-            avg_orig_bytes = average_over_all_conns['avg_orig_bytes']
-            avg_orig_ip_bytes = average_over_all_conns['avg_orig_ip_bytes']
-            avg_orig_pkts = average_over_all_conns['avg_orig_pkts']
-            avg_resp_bytes = average_over_all_conns['avg_resp_bytes']
-            avg_resp_ip_bytes = average_over_all_conns['avg_resp_ip_bytes']
-            avg_resp_pkts = average_over_all_conns['avg_resp_pkts']
-            # TODO: Dgraph does not know how to do avg over time
-            min_ts = average_over_all_conns['min_ts']
-            max_ts = average_over_all_conns['max_ts']
-            count_all = average_over_all_conns['count_all']
-
-            return {prefix + prefix2 + '_total': count_all,
-                    prefix + prefix2 + '_connection.time_min': min_ts,
-                    prefix + prefix2 + '_connection.time_max': max_ts,
-                    prefix + prefix2 + '_connection.duration_mean': avg_duration,
-                    prefix + prefix2 + '_connection.orig_bytes_mean': avg_orig_bytes,
-                    prefix + prefix2 + '_connection.orig_ip_bytes_mean': avg_orig_ip_bytes,
-                    prefix + prefix2 + '_connection.orig_pkts_mean': avg_orig_pkts,
-                    prefix + prefix2 + '_connection.resp_bytes_mean': avg_resp_bytes,
-                    prefix + prefix2 + '_connection.resp_ip_bytes_mean': avg_resp_ip_bytes,
-                    prefix + prefix2 + '_connection.resp_pkts_mean': avg_resp_pkts
-                    }
+    neighbourhood_averages = neighbourhoods.query_neighbourhood_mean(first_direction, second_direction, uid,
+                                                                     str(time_start), str(time_end))
+
+    neighbourhood_json = json.loads(neighbourhood_averages)
+    avg_json = neighbourhood_json['queryAverageNeighbourhood']
+
+    if avg_json:
+        average_over_all_conns = avg_json[0][f'~host.{first_direction}'][0]
+        avg_duration = average_over_all_conns['avg_duration']
+        avg_orig_bytes = average_over_all_conns['avg_orig_bytes']
+        avg_orig_ip_bytes = average_over_all_conns['avg_orig_ip_bytes']
+        avg_orig_pkts = average_over_all_conns['avg_orig_pkts']
+        avg_resp_bytes = average_over_all_conns['avg_resp_bytes']
+        avg_resp_ip_bytes = average_over_all_conns['avg_resp_ip_bytes']
+        avg_resp_pkts = average_over_all_conns['avg_resp_pkts']
+        # TODO: Dgraph does not know how to do avg over time
+        min_ts = average_over_all_conns['min_ts']
+        max_ts = average_over_all_conns['max_ts']
+        count_all = average_over_all_conns['count_all']
+
+        return {prefix + prefix2 + '_total': count_all,
+                prefix + prefix2 + '_connection.time_min': min_ts,
+                prefix + prefix2 + '_connection.time_max': max_ts,
+                prefix + prefix2 + '_connection.duration_mean': avg_duration,
+                prefix + prefix2 + '_connection.orig_bytes_mean': avg_orig_bytes,
+                prefix + prefix2 + '_connection.orig_ip_bytes_mean': avg_orig_ip_bytes,
+                prefix + prefix2 + '_connection.orig_pkts_mean': avg_orig_pkts,
+                prefix + prefix2 + '_connection.resp_bytes_mean': avg_resp_bytes,
+                prefix + prefix2 + '_connection.resp_ip_bytes_mean': avg_resp_ip_bytes,
+                prefix + prefix2 + '_connection.resp_pkts_mean': avg_resp_pkts
+                }
 
     return {prefix + prefix2 + '_total': 0,
             prefix + prefix2 + '_connection.time_min': 0,
@@ -134,40 +195,30 @@ def save_result_counts(query_json, query_name, value_name, count_dictionary):
             count_dictionary[category_name] = val
 
 
-def extract_cat_counts(dgraph_client, first_direction, second_direction, uid, time_start, time_end):
+def extract_cat_counts(neighbourhoods, first_direction, second_direction, uid, time_start, time_end):
     prefix = 'orig_' if first_direction == 'originated' else 'resp_'
     prefix2 = 'orig' if second_direction == 'originated' else 'resp'
 
-    neighbourhood_counts = queries.query_neighbourhood_counts(dgraph_client, first_direction, second_direction, uid,
-                                                              str(time_start), str(time_end))
-
-    if neighbourhood_counts:
-        neighbourhood_json = json.loads(neighbourhood_counts)
-        conn_state_dict, proto_dict, service_dict = generate_empty_cat_count_dictionaries()
-
-        save_result_counts(neighbourhood_json, 'queryNeighbourhoodConnstateCount', 'connection.conn_state',
-                           conn_state_dict)
-        save_result_counts(neighbourhood_json, 'queryNeighbourhoodProtoCount', 'connection.proto', proto_dict)
-        save_result_counts(neighbourhood_json, 'queryNeighbourhoodServiceCount', 'connection.service',
-                           service_dict)
-
-        return {prefix + prefix2 + '_proto_tcp_count': proto_dict['tcp'],
-                prefix + prefix2 + '_proto_udp_count': proto_dict['udp'],
-                prefix + prefix2 + '_proto_icmp_count': proto_dict['icmp'],
-                prefix + prefix2 + '_connection.protocol_mode': max(proto_dict, key=proto_dict.get),
-                prefix + prefix2 + '_connection.service_mode': max(service_dict, key=service_dict.get),
-                prefix + prefix2 + '_connection.conn_state_mode': max(conn_state_dict, key=conn_state_dict.get)
-                }
+    neighbourhood_counts = neighbourhoods.query_neighbourhood_counts(first_direction, second_direction, uid,
+                                                                     str(time_start), str(time_end))
+
+    neighbourhood_json = json.loads(neighbourhood_counts)
+    conn_state_dict, proto_dict, service_dict = generate_empty_cat_count_dictionaries()
+
+    save_result_counts(neighbourhood_json, 'queryNeighbourhoodConnstateCount', 'connection.conn_state',
+                       conn_state_dict)
+    save_result_counts(neighbourhood_json, 'queryNeighbourhoodProtoCount', 'connection.proto', proto_dict)
+    save_result_counts(neighbourhood_json, 'queryNeighbourhoodServiceCount', 'connection.service', service_dict)
 
     # TODO: if all are 0, don't return max? (mode = most frequent category)
 
     # prefixes: <orig/resp neighbourhood>_<first_direction>_<second_direction>
-    return {prefix + prefix2 + '_proto_tcp_count': 0,
-            prefix + prefix2 + '_proto_udp_count': 0,
-            prefix + prefix2 + '_proto_icmp_count': 0,
-            prefix + prefix2 + '_connection.protocol_mode': '-',
-            prefix + prefix2 + '_connection.service_mode': '-',
-            prefix + prefix2 + '_connection.conn_state_mode': '-'
+    return {prefix + prefix2 + '_proto_tcp_count': proto_dict['tcp'],
+            prefix + prefix2 + '_proto_udp_count': proto_dict['udp'],
+            prefix + prefix2 + '_proto_icmp_count': proto_dict['icmp'],
+            prefix + prefix2 + '_connection.protocol_mode': max(proto_dict, key=proto_dict.get),
+            prefix + prefix2 + '_connection.service_mode': max(service_dict, key=service_dict.get),
+            prefix + prefix2 + '_connection.conn_state_mode': max(conn_state_dict, key=conn_state_dict.get)
             }
 
 
@@ -209,85 +260,62 @@ def save_port_result_counts(query_json, query_name, value_name, count_dictionary
             count_dictionary[real_category_name] = val
 
 
-def extract_port_cat_counts(dgraph_client, first_direction, second_direction, uid, time_start, time_end):
+def extract_port_cat_counts(neighbourhoods, first_direction, second_direction, uid, time_start, time_end):
     prefix = 'orig_' if first_direction == 'originated' else 'resp_'
     prefix2 = 'orig_' if second_direction == 'originated' else 'resp_'
-    neighbourhood_port_counts = queries.query_neighbourhood_port_counts(dgraph_client, first_direction,
-                                                                        second_direction, uid, str(time_start),
-                                                                        str(time_end))
-
-    if neighbourhood_port_counts:
-        neighbourhood_json = json.loads(neighbourhood_port_counts)
-
-        orig_port_dict = generate_empty_port_count_dictionary(first_direction, second_direction)
-        resp_port_dict = generate_empty_port_count_dictionary(first_direction, second_direction)
-
-        save_port_result_counts(neighbourhood_json, 'queryNeighbourhoodPortOrigCount', 'connection.orig_p',
-                                orig_port_dict, first_direction, second_direction, 'orig')
-        save_port_result_counts(neighbourhood_json, 'queryNeighbourhoodPortRespCount', 'connection.resp_p',
-                                resp_port_dict, first_direction, second_direction, 'resp')
-
-        return join_dicts('', [orig_port_dict, resp_port_dict])
-
-    return {prefix + prefix2 + 'orig_p_well_known_count': 0,
-            prefix + prefix2 + 'orig_p_reg_or_dyn_count': 0,
-            prefix + prefix2 + 'resp_21_count': 0,
-            prefix + prefix2 + 'resp_22_count': 0,
-            prefix + prefix2 + 'resp_53_count': 0,
-            prefix + prefix2 + 'resp_80_count': 0,
-            prefix + prefix2 + 'resp_123_count': 0,
-            prefix + prefix2 + 'resp_443_count': 0,
-            prefix + prefix2 + 'resp_3389_count': 0,
-            prefix + prefix2 + 'resp_p_well_known_count': 0,
-            prefix + prefix2 + 'resp_p_reg_count': 0,
-            prefix + prefix2 + 'resp_p_dyn_count': 0
-            }
+    neighbourhood_port_counts = neighbourhoods.query_neighbourhood_port_counts(first_direction, second_direction, uid,
+                                                                               str(time_start), str(time_end))
+
+    neighbourhood_json = json.loads(neighbourhood_port_counts)
+
+    orig_port_dict = generate_empty_port_count_dictionary(first_direction, second_direction)
+    resp_port_dict = generate_empty_port_count_dictionary(first_direction, second_direction)
+
+    save_port_result_counts(neighbourhood_json, 'queryNeighbourhoodPortOrigCount', 'connection.orig_p',
+                            orig_port_dict, first_direction, second_direction, 'orig')
+    save_port_result_counts(neighbourhood_json, 'queryNeighbourhoodPortRespCount', 'connection.resp_p',
+                            resp_port_dict, first_direction, second_direction, 'resp')
+
+    return join_dicts('', [orig_port_dict, resp_port_dict])
 
 
-def extract_similar_count(dgraph_client, first_direction, second_direction, uid, time_start, time_end, orig_attributes):
+def extract_similar_count(neighbourhoods, first_direction, second_direction, uid, time_start, time_end,
+                          orig_attributes):
     prefix = 'orig_' if first_direction == 'originated' else 'resp_'
     prefix2 = 'orig_' if second_direction == 'originated' else 'resp_'
-    neighbourhood_similar_counts = queries.query_neighbourhood_similar_counts(dgraph_client, first_direction,
-                                                                              second_direction, uid, str(time_start),
-                                                                              str(time_end), orig_attributes)
+    neighbourhood_similar_counts = neighbourhoods.query_neighbourhood_similar_counts(
+        first_direction, second_direction, uid, str(time_start), str(time_end), orig_attributes)
 
-    if neighbourhood_similar_counts:
-        neighbourhood_json = json.loads(neighbourhood_similar_counts)
-        neighbourhood_json = neighbourhood_json['querySimilarNeighbourhoodCount']
-        if len(neighbourhood_json) >= 1:
-            return {prefix + prefix2 + 'similar_count': neighbourhood_json[0]['count_similar']}
+    neighbourhood_json = json.loads(neighbourhood_similar_counts)['querySimilarNeighbourhoodCount']
+    if len(neighbourhood_json) >= 1:
+        return {prefix + prefix2 + 'similar_count': neighbourhood_json[0]['count_similar']}
 
     return {prefix + prefix2 + 'similar_count': 0}
 
 
-def generate_time_interval(dgraph_time_str, hours, minutes, seconds):
-    # time is in the RFC3339 format
-    date_time = dateutil.parser.isoparse(dgraph_time_str)
-    start_time = date_time - datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
-    end_time = date_time + datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
-    return start_time.isoformat().replace("+00:00", "Z"), end_time.isoformat().replace("+00:00", "Z")
-
-
-def compute_time_neighbourhood(conn_uid, cur_time, direction, orig_attributes):
+def compute_time_neighbourhood(conn_uid, start_time, end_time, direction, orig_attributes, neighbourhoods=None):
+    """
+    :param neighbourhoods: source of neighbourhood aggregates (DgraphNeighbourhoods of the Dgraph client by default)
+    """
     reverse_direction = 'responded' if direction == 'originated' else 'originated'
-    start_time, end_time = generate_time_interval(cur_time, TIME_WINDOW_HOURS, TIME_WINDOW_MINUTES, TIME_WINDOW_SECONDS)
+    neighbourhoods = neighbourhoods or DgraphNeighbourhoods(dgraph_client)
 
     # a dictionary will be returned (thought of as one row in resulting csv file (df))
     neighbourhood_dict = {}
 
-    neighbourhood_avgs_orig = extract_mean_values(dgraph_client, direction, direction, conn_uid, start_time, end_time)
-    neighbourhood_cnts_orig = extract_cat_counts(dgraph_client, direction, direction, conn_uid, start_time, end_time)
-    neighbourhood_port_cat_orig = extract_port_cat_counts(dgraph_client, direction, direction, conn_uid, start_time,
+    neighbourhood_avgs_orig = extract_mean_values(neighbourhoods, direction, direction, conn_uid, start_time, end_time)
+    neighbourhood_cnts_orig = extract_cat_counts(neighbourhoods, direction, direction, conn_uid, start_time, end_time)
+    neighbourhood_port_cat_orig = extract_port_cat_counts(neighbourhoods, direction, direction, conn_uid, start_time,
                                                           end_time)
-    neighbourhood_cnt_similar_orig = extract_similar_count(dgraph_client, direction, direction, conn_uid, start_time,
+    neighbourhood_cnt_similar_orig = extract_similar_count(neighbourhoods, direction, direction, conn_uid, start_time,
                                                            end_time, orig_attributes)
-    neighbourhood_avgs_rev = extract_mean_values(dgraph_client, direction, reverse_direction, conn_uid, start_time,
+    neighbourhood_avgs_rev = extract_mean_values(neighbourhoods, direction, reverse_direction, conn_uid, start_time,
                                                  end_time)
-    neighbourhood_cnts_rev = extract_cat_counts(dgraph_client, direction, reverse_direction, conn_uid, start_time,
+    neighbourhood_cnts_rev = extract_cat_counts(neighbourhoods, direction, reverse_direction, conn_uid, start_time,
                                                 end_time)
-    neighbourhood_port_cat_resp = extract_port_cat_counts(dgraph_client, direction, reverse_direction, conn_uid,
+    neighbourhood_port_cat_resp = extract_port_cat_counts(neighbourhoods, direction, reverse_direction, conn_uid,
                                                           start_time, end_time)
-    neighbourhood_cnt_similar_resp = extract_similar_count(dgraph_client, direction, reverse_direction, conn_uid,
+    neighbourhood_cnt_similar_resp = extract_similar_count(neighbourhoods, direction, reverse_direction, conn_uid,
                                                            start_time, end_time, orig_attributes)
 
     neighbourhood_dict.update(neighbourhood_avgs_orig)
@@ -302,29 +330,109 @@ def compute_time_neighbourhood(conn_uid, cur_time, direction, orig_attributes):
     return neighbourhood_dict
 
 
-def result_is_valid(result, mode):
-    if mode == 'originated':
-        query_name = 'queryHostOriginated'
-        edge_direction = 'host.originated'
+def plan_neighbourhood_tasks(host_ips_list):
+    """
+    Planning step of NEIGHBOURHOOD mode: split heavy hosts to time shards and hand out the largest tasks first, so that
+    small tasks fill the gaps at the end of the run.
+
+    :return: (output of scheduler.generate_shard_tasks, schedule)
+    """
+    host_counts = get_host_connection_counts()
+    host_costs = scheduler.estimate_host_costs(host_counts, host_ips_list)
+    shard_counts = scheduler.plan_shard_counts(host_costs, args.processes, args.shard_threshold)
+    task_costs = scheduler.generate_shard_tasks(host_costs, shard_counts, get_originated_ts_at_offset)
+    return task_costs, scheduler.longest_first(task_costs)
+
+
+def compute_and_write_neighbourhood_task(task):
+    """
+    Compute neighbourhoods of one task of the schedule. Query errors are raised, nothing is written for a failed task
+    (a task of the work queue is released and claimed again).
+    """
+    host_ip, shard_index, shard_count, ts_start, ts_end = task
+    start = time.perf_counter()
+    if shard_count == 1:
+        compute_and_write_host_neighbourhood(host_ip)
+    else:
+        compute_and_write_host_neighbourhood(host_ip, ts_start, ts_end, shard_file_name(host_ip, shard_index))
+    return task, time.perf_counter() - start
+
+
+def try_neighbourhood_task(task):
+    """
+    :return: output of compute_and_write_neighbourhood_task, duration is None if a query of the task failed
+    """
+    try:
+        return compute_and_write_neighbourhood_task(task)
+    except DgraphQueryError as e:
+        print('Neighbourhoods of task {} are not written: {}'.format(task, str(e)))
+        return task, None
+
+
+def run_queue_worker(worker_index):
+    """
+    Process tasks of the work queue (one process of the pool, its own connection to the queue).
+    """
+    queue = work_queue.WorkQueue(args.work_queue, args.lease_seconds, retry_seconds=args.retry_seconds)
+    try:
+        return work_queue.run_worker(queue, compute_and_write_neighbourhood_task, merge_host_shards)
+    finally:
+        queue.close()
+
+
+def get_originated_ts_at_offset(host_ip, offset):
+    try:
+        result = queries.query_host_originated_ts_at_offset(dgraph_client, host_ip, str(offset))
+    except DgraphQueryError as e:
+        # the host is not sharded without the boundary:
+        print('Shard boundary of ' + host_ip + ' at offset ' + str(offset) + ' is not available: ' + str(e))
+        return None
+    host_json = json.loads(result)['queryHostTsAtOffset']
+    if host_json and 'host.originated' in host_json[0]:
+        return host_json[0]['host.originated'][0]['connection.ts']
+    return None
+
+
+def shard_file_name(host_ip, shard_index):
+    return output_path + '-' + str(host_ip) + '.shard-' + str(shard_index) + '.csv'
+
+
+def merge_host_shards(host_ip, shard_count):
+    # shards are consecutive time ranges ordered by time => concatenation keeps timestamp order
+    # (values are read as strings, so they are written back unchanged; missing columns are aligned by pandas)
+    shard_dfs = []
+    for shard_index in range(shard_count):
+        file_name = shard_file_name(host_ip, shard_index)
+        if os.path.exists(file_name):
+            shard_dfs.append(pd.read_csv(file_name, dtype=str, keep_default_na=False))
+            os.remove(file_name)
+
+    if shard_dfs:
+        output_conns_csv(output_path, host_ip, '', shard_dfs)
     else:
-        query_name = 'queryHostResponded'
-        edge_direction = 'host.responded'
+        print('No result returned for IP ' + host_ip + '.')
+
 
-    json_result = json.loads(result)
-    if query_name in json_result:
-        json_level_1 = json_result[query_name]
+def remove_host_shards(host_ip, shard_count):
+    """
+    Remove shard files of a host whose output is not written (a shard failed), so that they are not read as output.
+    """
+    for shard_index in range(shard_count):
+        file_name = shard_file_name(host_ip, shard_index)
+        if os.path.exists(file_name):
+            os.remove(file_name)
 
-        # helper variable for storing for how many hosts there are no connection returner
-        no_result_counter = len(json_level_1)
-        for json_level_2 in json_level_1:
-            if edge_direction not in json_level_2:
-                no_result_counter -= 1
 
-        # if at least for one host there were some connections returned, we still want to keep paginating,
-        # otherwise we already got everything and we can end it
-        if no_result_counter > 0:
-            return True
-    return False
+def get_host_connection_counts():
+    """
+    :return: output of scheduler.parse_host_connection_counts, empty if the query failed (the counts are only used to
+             plan the work)
+    """
+    try:
+        return scheduler.parse_host_connection_counts(queries.query_host_connection_counts(dgraph_client))
+    except DgraphQueryError as e:
+        print('Something went wrong with trying to get the connection counts from Dgraph: ' + str(e))
+        return {}
 
 
 def get_next_result(ip_var, offset_var, first_var, mode):
@@ -349,9 +457,24 @@ def output_conns_csv(output_path, host_ip, direction_str, hosts_dfs):
     print('Successfully wrote to file ' + file_name + '.')
 
 
-def compute_and_write_host_neighbourhood(host_ip):
-    print('\n[{}]: Computing neighbourhood for connections of originator {:15}'.format(
-        datetime.datetime.now().strftime("%H:%M:%S"), host_ip))
+def get_originated_page(host_ip, page_counter, page_step, ts_start, ts_end):
+    if ts_start is None:
+        return queries.query_host_originated_connections_simple(dgraph_client, str(host_ip), str(page_counter),
+                                                                str(page_step), args.projection_profile,
+                                                                args.app_families)
+    return queries.query_host_originated_connections_in_time_range(dgraph_client, str(host_ip), str(page_counter),
+                                                                   str(page_step), ts_start, ts_end,
+                                                                   args.projection_profile, args.app_families)
+
+
+def compute_and_write_host_neighbourhood(host_ip, ts_start=None, ts_end=None, shard_file=None):
+    """
+    Compute neighbourhoods of originated connections of the host (optionally only of connections from the time shard
+    [ts_start, ts_end), the result is then written to shard_file instead of the file of the host).
+    """
+    print('\n[{}]: Computing neighbourhood for connections of originator {:15}{}'.format(
+        datetime.datetime.now().strftime("%H:%M:%S"), host_ip,
+        ' [{}, {})'.format(ts_start, ts_end) if ts_start is not None else ''))
 
     # pagination vars:
     page_counter = 0
@@ -359,52 +482,47 @@ def compute_and_write_host_neighbourhood(host_ip):
 
     host_ip = host_ip.strip()
     print('##############\n' + host_ip + '\n##############')
-    result = queries.query_host_originated_connections_simple(dgraph_client, str(host_ip), str(page_counter),
-                                                              str(page_step))
+    result = get_originated_page(host_ip, page_counter, page_step, ts_start, ts_end)
     hosts_dfs = []
 
-    if result:
-        while result_is_valid(result, 'originated'):
-            print('Result for IP ' + host_ip + ' and first ' + str(page_step) + ' with offset ' +
-                  str(page_counter) + ' is valid.')
-
-            # get all returned originated connections and compute neighbourhood for each:
-            result_json = json.loads(result)
-            connections = result_json['queryHostOriginated'][0]['host.originated']
-
-            df_result = pd.DataFrame()
-            for connection in connections:
-                conn_uid = connection['uid']
-                conn_ts = connection['connection.ts']
-
-                originator_neighbourhood = compute_time_neighbourhood(conn_uid, conn_ts, 'originated', connection)
-                responder_neighbourhood = compute_time_neighbourhood(conn_uid, conn_ts, 'responded', connection)
-
-                # concat neighbourhoods with original connection:
-                connection.update({'originated_ip': host_ip,
-                                   'responded_ip': connection['~host.responded'][0]['responded_ip']})
-                connection.pop('~host.responded', None)
-                connection.update(originator_neighbourhood)
-                connection.update(responder_neighbourhood)
-
-                row_df = pd.DataFrame([connection])
-                df_result = pd.concat([df_result, row_df], axis=0, ignore_index=True)
-
-            # convert result in page range to CSV in order to write to one output file:
-            # write result to a separate file:
-            # csv_result = json_to_csv_mode(result)
-            hosts_dfs.append(df_result)
-
-            # get connections for subsequent page range:
-            page_counter += page_step
-            result = queries.query_host_originated_connections_simple(dgraph_client, str(host_ip), str(page_counter),
-                                                                      str(page_step))
-
-        print('Result for IP ' + host_ip + ' and first ' + str(page_step) + ' with offset ' + str(page_counter)
-              + ' is NOT valid.')
+    # each page is decoded only once, the same object is used for pagination and neighbourhood computation:
+    page = responses.parse_host_connections_page(result, 'originated')
+    while len(page) > 0:
+        print('Result for IP ' + host_ip + ' and first ' + str(page_step) + ' with offset ' +
+              str(page_counter) + ' is valid.')
+
+        # compute neighbourhood for each returned originated connection (windows of all connections at once):
+        window_starts, window_ends = responses.generate_time_windows(page.ts_ns, TIME_WINDOW_HOURS,
+                                                                     TIME_WINDOW_MINUTES, TIME_WINDOW_SECONDS)
+        rows = []
+        for connection, conn_uid, responded_ip, start_time, end_time in zip(page.connections, page.uids,
+                                                                            page.peer_ips, window_starts,
+                                                                            window_ends):
+            originator_neighbourhood = compute_time_neighbourhood(conn_uid, start_time, end_time, 'originated',
+                                                                  connection)
+            responder_neighbourhood = compute_time_neighbourhood(conn_uid, start_time, end_time, 'responded',
+                                                                 connection)
+
+            # concat neighbourhoods with original connection:
+            connection.update({'originated_ip': host_ip, 'responded_ip': responded_ip})
+            connection.update(originator_neighbourhood)
+            connection.update(responder_neighbourhood)
+            rows.append(connection)
+
+        hosts_dfs.append(pd.DataFrame(rows))
+
+        # get connections for subsequent page range:
+        page_counter += page_step
+        result = get_originated_page(host_ip, page_counter, page_step, ts_start, ts_end)
+        page = responses.parse_host_connections_page(result, 'originated')
+
+    print('Result for IP ' + host_ip + ' and first ' + str(page_step) + ' with offset ' + str(page_counter)
+          + ' is NOT valid.')
 
     # write to one final CSV file:
-    if len(hosts_dfs) > 0:
+    if len(hosts_dfs) > 0 and shard_file:
+        pandas_funcs.concat_multiple_dfs(hosts_dfs).to_csv(shard_file, index=False, header=True)
+    elif len(hosts_dfs) > 0:
         output_conns_csv(output_path, host_ip, '', hosts_dfs)
 
         # head -n1 test.txt | tr , '\n' # print out only csv header - each col on new line
@@ -412,7 +530,14 @@ def compute_and_write_host_neighbourhood(host_ip):
         print('No result returned for IP ' + host_ip + '.')
 
 
-def get_host_connections(host_ip, mode):
+def iterate_host_connections(host_ip, mode):
+    """
+    Generator of all pages of originated/responded connections of one host (fetch stage of the pipeline). Pages are
+    fetched until a page is not full. The count of the planning query is only a hint (the query may have failed and
+    connections may be added meanwhile): pages before it are known to be full and are passed on without decoding them
+    (they are decoded only once, by the flattening process), only the pages from the hinted end on are decoded to
+    find the last page.
+    """
     if mode == 'originated':
         query_func = queries.query_host_originated_connections_simple
     else:
@@ -422,33 +547,126 @@ def get_host_connections(host_ip, mode):
     page_step = args.amount_on_page
 
     host_ip = host_ip.strip()
-    print('\n##############\n' + host_ip + '\n (' + mode + ')' + '\n##############')
-    result = query_func(dgraph_client, str(host_ip), str(page_counter), str(page_step))
-
-    hosts_dfs = []
-
-    if result:
-        while result_is_valid(result, mode):
-            print('Result for IP ' + host_ip + ' and first ' + str(page_step) + ' with offset ' + str(page_counter) +
-                  ' is valid.')
+    originated_count, responded_count = host_connection_counts.get(host_ip, (0, 0))
+    connections_count = originated_count if mode == 'originated' else responded_count
+    print('\n##############\n' + host_ip + '\n (' + mode + ', ' + str(connections_count) + ' connections planned)' +
+          '\n##############')
+
+    while True:
+        result = query_func(dgraph_client, str(host_ip), str(page_counter), str(page_step), args.projection_profile,
+                            args.app_families)
+
+        page_length = page_step if page_counter + page_step <= connections_count \
+            else responses.count_host_connections_page(result, mode)
+        if page_length == 0:
+            break
+
+        print('Result for IP ' + host_ip + ' and first ' + str(page_step) + ' with offset ' + str(page_counter) +
+              ' is valid.')
+        yield result
+        if page_length < page_step:
+            break
+
+        # get connections for subsequent page range:
+        page_counter += page_step
+
+
+def write_host_connections(host_ip, mode, hosts_dfs):
+    if args.app_data_layout == 'tables':
+        # every connection is originated by one host, so its app data records are written only once:
+        if mode == 'originated':
+            for _, records in hosts_dfs:
+                app_data_tables.append(records)
+        hosts_dfs = [hosts_df for hosts_df, _ in hosts_dfs]
+
+    if partitioned_writer is not None:
+        partitioned_writer.write_host(host_ip, mode[0], pandas_funcs.concat_multiple_dfs(hosts_dfs))
+        return
+
+    # write to one CSV file:
+    output_conns_csv(output_path, host_ip, mode[0], hosts_dfs)
+
+
+def convert_export_page(page):
+    result = pandas_funcs.convert_connections_page(page, args.projection_profile, args.app_families,
+                                                   args.app_data_layout)
+    if args.app_data_layout == 'tables':
+        hosts_df, records = result
+        app_data_tables.append(records)
+        return hosts_df
+    return result
+
+
+def get_connections_since_page(ts_start, offset, first):
+    try:
+        result = queries.query_connections_since(dgraph_client, ts_start, str(offset), str(first),
+                                                 args.projection_profile, args.app_families)
+    except DgraphUnavailableError as e:
+        # Dgraph is unavailable for now, the poll is repeated after the poll interval:
+        print(str(e))
+        return None
+    return responses.parse_connections_since_page(result)
+
+
+def get_export_page(after, first):
+    result = queries.query_connections_export(dgraph_client, after, str(first), args.projection_profile,
+                                              args.app_families)
+    return responses.parse_connections_since_page(result, 'queryConnectionsExport')
+
+
+def append_conns_csv(file_name, rows):
+    # columns of the existing file are kept, so that all appended parts share the header
+    rows_df = pd.DataFrame(rows)
+    if os.path.exists(file_name):
+        header = pd.read_csv(file_name, nrows=0).columns
+        rows_df.reindex(columns=header).to_csv(file_name, mode='a', index=False, header=False)
+    else:
+        rows_df.to_csv(file_name, index=False, header=True)
 
-            # convert result in page range to CSV in order to write to one output file:
-            # write result to a separate file:
-            csv_result = pandas_funcs.convert_json_to_csv_conns(result, mode)
-            hosts_dfs.append(csv_result)
 
-            # get connections for subsequent page range:
-            page_counter += page_step
-            result = query_func(dgraph_client, str(host_ip), str(page_counter), str(page_step))
+def compute_and_append_stream_neighbourhoods(host_ip, closed_connections, state):
+    """
+    Compute neighbourhoods of connections of the host whose time windows are closed and append them to the file of
+    the host (STREAMING mode). Neighbourhoods are computed from the histories of hosts kept in memory, no query is
+    sent to Dgraph.
 
-        print('Result for IP ' + host_ip + ' and first ' + str(page_step) + ' with offset ' + str(page_counter)
-              + ' is NOT valid.')
+    :param closed_connections: output of streaming.HostWindowState.pop_closed
+    :param state: streaming.StreamingState
+    """
+    ts_ns = [ts for ts, _, _, _ in closed_connections]
+    window_starts, window_ends = responses.generate_time_windows(ts_ns, TIME_WINDOW_HOURS, TIME_WINDOW_MINUTES,
+                                                                 TIME_WINDOW_SECONDS)
+    neighbourhoods = streaming.WindowNeighbourhoods(state, {conn_uid: (host_ip, responded_ip)
+                                                            for _, conn_uid, responded_ip, _ in closed_connections})
+    rows = []
+    for (_, conn_uid, responded_ip, connection), start_time, end_time in zip(closed_connections, window_starts,
+                                                                              window_ends):
+        originator_neighbourhood = compute_time_neighbourhood(conn_uid, start_time, end_time, 'originated', connection,
+                                                              neighbourhoods)
+        responder_neighbourhood = compute_time_neighbourhood(conn_uid, start_time, end_time, 'responded', connection,
+                                                             neighbourhoods)
+
+        # the connection dictionary stays in the histories of its hosts, the row is a copy:
+        row = dict(connection)
+        row.update({'originated_ip': host_ip, 'responded_ip': responded_ip})
+        row.update(originator_neighbourhood)
+        row.update(responder_neighbourhood)
+        rows.append(row)
+
+    append_conns_csv(output_path + '-' + str(host_ip) + '.csv', rows)
+
+
+def emit_stream_neighbourhoods(state, closed):
+    """
+    Emit closed connections of all hosts (hosts are processed by -fw threads, the histories are only read).
 
-        # write to one CSV file:
-        if len(hosts_dfs) > 0:
-            output_conns_csv(output_path, host_ip, mode[0], hosts_dfs)
-    else:
-        print('Something went wrong with trying to get the connections result of ' + str(host_ip) + ' from Dgraph.')
+    :param state: streaming.StreamingState
+    :param closed: dictionary { host IP -> output of streaming.HostWindowState.pop_closed }
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.fetch_workers) as executor:
+        for future in [executor.submit(compute_and_append_stream_neighbourhoods, host_ip, host_closed, state)
+                       for host_ip, host_closed in closed.items()]:
+            future.result()
 
 
 def define_arguments():
@@ -461,20 +679,81 @@ def define_arguments():
 
     parser.add_argument('-ip', '--dgraph_ip', help='Dgraph server IP address', type=str, default='127.0.0.1')
     parser.add_argument('-p', '--dgraph_port', help='Dgraph server port', type=int, default=9080)
+    parser.add_argument('-ep', '--endpoints', help='Addresses (<ip>:<port>) of Dgraph alphas to balance queries over '
+                        '(default: -ip and -p)', nargs='+', default=None)
+    parser.add_argument('-r', '--retries', help='Number of repeated attempts of a query failed by a transient error',
+                        type=int, default=3)
+    parser.add_argument('-ha', '--hedge_after', help='Send a query also to the next alpha if there is no answer after '
+                        'this number of seconds (default: no hedging)', type=float, default=None)
+    parser.add_argument('-qt', '--query_timeout', help='Deadline of one query attempt in seconds', type=float,
+                        default=None)
+    parser.add_argument('-gc', '--grpc_compression', help='gRPC message compression', choices=GRPC_COMPRESSION.keys(),
+                        default='none')
 
     mode = parser.add_mutually_exclusive_group(required=True)
     mode.add_argument('-im', '--ips_mode', help='Host IPs will be stored to a CSV file.', action='store_true')
     mode.add_argument('-nm', '--neighbourhood_mode', help='CSV result of query with neighbourhood will be stored.',
                       action='store_true')
     mode.add_argument('-cm', '--connections_mode', help='CSV result of query will be stored.', action='store_true')
+    mode.add_argument('-xm', '--export_mode', help='All connections will be stored to one CSV table by a single '
+                      'scan and split to CSV files of hosts.', action='store_true')
+    mode.add_argument('-sm', '--streaming_mode', help='Neighbourhoods of newly loaded connections will be appended to '
+                      'CSV files.', action='store_true')
 
     parser.add_argument('-a', '--amount_on_page', help='Query variable: "first" query pagination value', type=int,
                         default=10000)
+    parser.add_argument('-pp', '--projection_profile', help='Which connection.produced app data are queried and '
+                        'flattened: core (none), core+app_counts (counts only), core+app (attributes of --app_families '
+                        'used by flattening), full (all)', choices=queries.PROJECTION_PROFILES, default='full')
+    parser.add_argument('--app_families', help='App data fetched in core+app profile (default: all)', nargs='+',
+                        choices=queries.APP_DATA_PREDICATES.keys(), default=None)
+    parser.add_argument('-adl', '--app_data_layout', help='CONNECTIONS and EXPORT mode: app data attribute values '
+                        'as list columns of connection rows or in normalized tables (see app_tables.py)',
+                        choices=pandas_funcs.APP_DATA_LAYOUTS, default='columns')
+    parser.add_argument('-ol', '--output_layout', help='CONNECTIONS and EXPORT mode: files of hosts or partitioned '
+                        'dataset <output_path>-partitioned (see partitioned_output.py)',
+                        choices=partitioned_output.OUTPUT_LAYOUTS, default='files')
+    parser.add_argument('-pn', '--partitions', help='Partitioned output layout: number of host hash partitions of a '
+                        'day', type=int, default=partitioned_output.DEFAULT_PARTITIONS)
     parser.add_argument('-of', '--output_file', help='Output JSON/CSV file name (without ".json"/".csv")', type=str,
                         default='output')
     parser.add_argument('-od', '--output_directory', help='Output directory absolute path', type=str,
                         default='/home/sramkova/dev/storage/ml/')
 
+    parser.add_argument('-np', '--processes', help='NEIGHBOURHOOD mode: number of worker processes', type=int,
+                        default=32)
+    parser.add_argument('-st', '--shard_threshold', help='NEIGHBOURHOOD mode: hosts with more originated connections '
+                        'are split to time shards (default: total connections / number of processes)', type=int,
+                        default=None)
+    parser.add_argument('-wq', '--work_queue', help='NEIGHBOURHOOD mode: SQLite file of a work queue shared by '
+                        'processes of several nodes (see work_queue.py)', type=str, default=None)
+    parser.add_argument('-ls', '--lease_seconds', help='NEIGHBOURHOOD mode: lease timeout of a task (and of the '
+                        'planning) of the work queue', type=float, default=300)
+    parser.add_argument('-rs', '--retry_seconds', help='NEIGHBOURHOOD mode: delay before a failed task of the work '
+                        'queue is claimed again (doubled for every further attempt)', type=float, default=30)
+    parser.add_argument('-pt', '--planning_timeout', help='NEIGHBOURHOOD mode: maximum time in seconds to wait for '
+                        'another process to plan the work queue (a planner whose lease expired is taken over)',
+                        type=float, default=3600)
+    parser.add_argument('-fw', '--fetch_workers', help='CONNECTIONS and STREAMING mode: number of threads querying '
+                        'Dgraph', type=int, default=4)
+    parser.add_argument('-cw', '--convert_workers', help='CONNECTIONS mode: number of processes flattening JSON '
+                        'results (default: number of CPUs)', type=int, default=None)
+    parser.add_argument('-ww', '--write_workers', help='CONNECTIONS mode: number of threads writing CSV files',
+                        type=int, default=1)
+    parser.add_argument('-qs', '--queue_size', help='CONNECTIONS mode: capacity of queues between pipeline stages',
+                        type=int, default=16)
+    parser.add_argument('--table_only', help='EXPORT mode: only the connections table is written (no files of '
+                        'hosts)', action='store_true')
+    parser.add_argument('-wf', '--watermark_file', help='STREAMING mode: file with the persisted watermark (default: '
+                        '<output_path>.watermark.json)', type=str, default=None)
+    parser.add_argument('-ws', '--watermark_start', help='STREAMING mode: watermark used if the watermark file does '
+                        'not exist (RFC3339)', type=str, default=streaming.STREAM_START)
+    parser.add_argument('-pi', '--poll_interval', help='STREAMING mode: seconds between polls', type=float, default=60)
+    parser.add_argument('-al', '--allowed_lateness', help='STREAMING mode: seconds a connection may be loaded after '
+                        'newer connections', type=float, default=30)
+    parser.add_argument('-mp', '--max_polls', help='STREAMING mode: stop after this number of polls (default: run '
+                        'forever)', type=int, default=None)
+
     parser.add_argument('--ips_csv', help='Path to CSV file with host IPs', type=str, required='--connections_mode' in
                         sys.argv or '-cm' in sys.argv or 'neighbourhood_mode' in sys.argv or 'nm' in sys.argv)
 
@@ -487,37 +766,160 @@ if __name__ == '__main__':
     print('\n ========   S T A R T E D   [{}]\n'.format(start_time.strftime("%H:%M:%S")))
 
     # initialize Dgraph client:
-    dgraph_client = DgraphClient()
-    dgraph_client.connect(ip=args.dgraph_ip, port=args.dgraph_port)
+    dgraph_client = DgraphClient(retries=args.retries, hedge_after=args.hedge_after, timeout=args.query_timeout)
+    dgraph_client.connect(ip=args.dgraph_ip, port=args.dgraph_port, compression=args.grpc_compression,
+                          endpoints=args.endpoints)
 
     output_path = args.output_directory + '/' + args.output_file
     print('Output file path (name) is "' + output_path + '".')
 
     if args.ips_mode:
         # output only IPs from dataset:
-        ips_json = queries.query_get_host_ips(dgraph_client)
-        if ips_json:
-            output_file_name = output_path + '.csv'
-            ips_csv = pandas_funcs.convert_json_to_csv_ips(ips_json)
-            ips_csv.to_csv(output_file_name, index=False, header=False)
-            print('Successfully wrote to file ' + output_file_name + '.')
-        else:
-            print('Something went wrong with trying to get the result from Dgraph.')
+        try:
+            ips_json = queries.query_get_host_ips(dgraph_client)
+        except DgraphQueryError as e:
+            sys.exit('Something went wrong with trying to get the result from Dgraph: ' + str(e))
+        output_file_name = output_path + '.csv'
+        ips_csv = pandas_funcs.convert_json_to_csv_ips(ips_json)
+        ips_csv.to_csv(output_file_name, index=False, header=False)
+        print('Successfully wrote to file ' + output_file_name + '.')
 
     elif args.neighbourhood_mode:
         # output connections of all hosts from input IPs file and their neighbourhoods:
         ips_file = open(args.ips_csv, 'r')
 
-        with multiprocessing.Pool(processes=32) as pool:
-            host_ips_list = [host_ip for host_ip in ips_file]
-            pool.map(compute_and_write_host_neighbourhood, host_ips_list)
+        host_ips_list = [host_ip.strip() for host_ip in ips_file if host_ip.strip()]
+
+        queue = work_queue.WorkQueue(args.work_queue, args.lease_seconds, retry_seconds=args.retry_seconds) \
+            if args.work_queue else None
+        if queue is None:
+            task_costs, schedule = plan_neighbourhood_tasks(host_ips_list)
+        else:
+            # nodes started with the same hosts and planning arguments share the plan (a rerun resumes it):
+            plan_key = work_queue.plan_key(host_ips_list, output_path, args.processes, args.shard_threshold)
+            planning = queue.claim_planning(plan_key)
+            while True:
+                if not planning:
+                    print('Waiting for the work queue {} to be planned by another process.'.format(args.work_queue))
+                    if queue.wait_until_planned(plan_key, args.planning_timeout):
+                        break
+                with work_queue.LeaseHeartbeat(queue):
+                    task_costs, schedule = plan_neighbourhood_tasks(host_ips_list)
+                if queue.enqueue(schedule, task_costs):
+                    print('Work queue {} planned: {} tasks.'.format(args.work_queue, len(schedule)))
+                    break
+                # the planning lease expired meanwhile and another process took the planning over:
+                planning = False
+
+        if queue is not None:
+            # pool processes claim tasks from the shared queue until it is empty (tasks of other nodes included), an
+            # SQLite connection is not shared by forked processes:
+            queue.close()
+            with multiprocessing.Pool(processes=args.processes) as pool:
+                processed = sum(pool.map(run_queue_worker, range(args.processes), chunksize=1))
+            print('Processed {} tasks of the work queue.'.format(processed))
+            queue = work_queue.WorkQueue(args.work_queue, args.lease_seconds, retry_seconds=args.retry_seconds)
+            queue.print_summary()
+            queue.close()
+        else:
+            task_durations = {}
+            finished_shards = {}
+            pool_start = time.perf_counter()
+            failed_tasks = []
+            with multiprocessing.Pool(processes=args.processes) as pool:
+                for task, duration in pool.imap_unordered(try_neighbourhood_task, schedule, chunksize=1):
+                    if duration is None:
+                        failed_tasks.append(task)
+                        continue
+                    task_durations[task] = duration
+
+                    host_ip, _, shard_count, _, _ = task
+                    if shard_count > 1:
+                        finished_shards[host_ip] = finished_shards.get(host_ip, 0) + 1
+                        if finished_shards[host_ip] == shard_count:
+                            merge_host_shards(host_ip, shard_count)
+            scheduler.print_makespan_report(task_costs, schedule, host_ips_list, task_durations,
+                                            time.perf_counter() - pool_start, args.processes)
+            if failed_tasks:
+                failed_hosts = sorted({task[0] for task in failed_tasks})
+                print('Neighbourhoods of {} hosts ({} tasks) are not written because of query errors:'.format(
+                    len(failed_hosts), len(failed_tasks)))
+                for host_ip, shard_count in sorted({(task[0], task[2]) for task in failed_tasks}):
+                    remove_host_shards(host_ip, shard_count)
+                    print('  ' + host_ip)
+    elif args.export_mode:
+        # output all connections once to a table and split it to files of hosts (of hosts from input IPs file if
+        # provided):
+        table_file = output_path + connections_export.EXPORT_TABLE_SUFFIX
+        app_data_tables = app_tables.AppDataTables(output_path, pandas_funcs.get_profile_app_families(
+            args.projection_profile, args.app_families)) if args.app_data_layout == 'tables' else None
+        exported = connections_export.export_connections(get_export_page, convert_export_page, table_file,
+                                                         pandas_funcs.export_columns(args.projection_profile,
+                                                                                     args.app_families,
+                                                                                     args.app_data_layout),
+                                                         args.amount_on_page)
+        print('Successfully wrote {} connections to file {}.'.format(exported, table_file))
+        if app_data_tables is not None:
+            app_data_tables.write_dictionary()
+
+        if not args.table_only:
+            host_ips_list = None
+            if args.ips_csv:
+                with open(args.ips_csv, 'r') as ips_file:
+                    host_ips_list = [host_ip.strip() for host_ip in ips_file if host_ip.strip()]
+            partitioned_writer = partitioned_output.PartitionedWriter(
+                partitioned_output.dataset_directory(output_path), args.partitions) \
+                if args.output_layout == 'partitioned' else None
+            host_files = connections_export.derive_host_views(table_file, output_path, host_ips_list,
+                                                              writer=partitioned_writer)
+            if partitioned_writer is not None:
+                partitioned_writer.close()
+                print('Successfully wrote {} blocks of hosts to {}.'.format(len(host_files),
+                                                                            partitioned_writer.directory))
+            else:
+                print('Successfully wrote {} files of hosts.'.format(len(host_files)))
+    elif args.streaming_mode:
+        # append neighbourhoods of newly loaded connections (of hosts from input IPs file if provided):
+        host_ips_list = None
+        if args.ips_csv:
+            with open(args.ips_csv, 'r') as ips_file:
+                host_ips_list = [host_ip.strip() for host_ip in ips_file if host_ip.strip()]
+
+        watermark_file = args.watermark_file or output_path + '.watermark.json'
+        watermark = streaming.load_watermark(watermark_file, args.watermark_start)
+        print('Streaming from watermark ' + watermark + ' (' + watermark_file + ').')
+
+        window_ns = ((TIME_WINDOW_HOURS * 60 + TIME_WINDOW_MINUTES) * 60 + TIME_WINDOW_SECONDS) \
+            * responses.NANOSECONDS_IN_SECOND
+        stream_state = streaming.StreamingState(watermark, window_ns,
+                                                int(args.allowed_lateness * responses.NANOSECONDS_IN_SECOND),
+                                                host_ips_list)
+        streaming.run_streaming(stream_state, get_connections_since_page, emit_stream_neighbourhoods, watermark_file,
+                                args.amount_on_page, args.poll_interval, args.max_polls)
     else:
-        # output connections of all hosts from input IPs file:
+        # output connections of all hosts from input IPs file (query -> flatten -> write stages run concurrently):
         ips_file = open(args.ips_csv, 'r')
 
-        for host_ip in ips_file:
-            get_host_connections(host_ip, 'originated')
-            get_host_connections(host_ip, 'responded')
+        host_connection_counts = get_host_connection_counts()
+
+        host_tasks = [(host_ip.strip(), mode) for host_ip in ips_file if host_ip.strip()
+                      for mode in ('originated', 'responded')]
+        convert_func = functools.partial(pandas_funcs.convert_json_to_csv_conns, profile=args.projection_profile,
+                                         app_families=args.app_families, app_data_layout=args.app_data_layout)
+        app_data_tables = app_tables.AppDataTables(output_path, pandas_funcs.get_profile_app_families(
+            args.projection_profile, args.app_families)) if args.app_data_layout == 'tables' else None
+        partitioned_writer = partitioned_output.PartitionedWriter(partitioned_output.dataset_directory(output_path),
+                                                                  args.partitions) \
+            if args.output_layout == 'partitioned' else None
+        stats = pipeline.run_pipeline(host_tasks, iterate_host_connections, convert_func, write_host_connections,
+                                      fetch_workers=args.fetch_workers, convert_workers=args.convert_workers,
+                                      write_workers=args.write_workers, queue_size=args.queue_size)
+        stats.print_summary()
+        if app_data_tables is not None:
+            app_data_tables.write_dictionary()
+        if partitioned_writer is not None:
+            partitioned_writer.close()
+            print('Successfully wrote to ' + partitioned_writer.directory + '.')
 
     finished_time = datetime.datetime.now()
     print('\n ========   F I N I S H E D   [{}]\n'.format(finished_time.strftime("%H:%M:%S")))
@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Typed layer over Dgraph responses. Each page of host connections is decoded exactly once and shared by all consumers
+(pagination check, neighbourhood computation, output), timestamps are converted to int64 epoch values in one
+vectorized pass.
+"""
+
+import numpy as np
+import pandas as pd
+import orjson as json
+
+
+NANOSECONDS_IN_SECOND = 1000000000
+
+
+class HostConnectionsPage:
+    """
+    One page of originated/responded connections of a host.
+
+    :ivar host_ip: IP address of the host
+    :ivar direction: 'originated' or 'responded'
+    :ivar connections: list of connection dictionaries (reverse edge with the peer IP is removed)
+    :ivar uids: Dgraph uids of the connections
+    :ivar peer_ips: IP addresses of the hosts on the other side of the connections
+    :ivar ts_ns: numpy int64 array of connection.ts values as nanoseconds since epoch (UTC)
+    """
+    __slots__ = ('host_ip', 'direction', 'connections', 'uids', 'peer_ips', 'ts_ns')
+
+    def __init__(self, host_ip, direction, connections, uids, peer_ips, ts_ns):
+        self.host_ip = host_ip
+        self.direction = direction
+        self.connections = connections
+        self.uids = uids
+        self.peer_ips = peer_ips
+        self.ts_ns = ts_ns
+
+    def __len__(self):
+        return len(self.connections)
+
+
+def parse_host_connections_page(result, direction):
+    """
+    Decode a response of dgraph_queries.query_host_<direction>_connections_simple.
+
+    :param result: JSON response
+    :param direction: 'originated' or 'responded'
+    :return: HostConnectionsPage (without connections if the host has no more connections)
+    """
+    if direction == 'originated':
+        query_name = 'queryHostOriginated'
+        reverse_edge_direction = '~host.responded'
+    else:
+        query_name = 'queryHostResponded'
+        reverse_edge_direction = '~host.originated'
+    edge_direction = 'host.' + direction
+
+    hosts_json = json.loads(result).get(query_name, [])
+    host_json = hosts_json[0] if hosts_json else {}
+    connections = host_json.get(edge_direction, [])
+
+    peer_ips = []
+    for connection in connections:
+        peer = connection.pop(reverse_edge_direction, None)
+        peer_ips.append(peer[0]['responded_ip'] if peer else None)
+
+    uids = [connection['uid'] for connection in connections]
+    ts_ns = convert_ts_to_epoch_ns([connection['connection.ts'] for connection in connections])
+
+    return HostConnectionsPage(host_json.get('originated_ip'), direction, connections, uids, peer_ips, ts_ns)
+
+
+def count_host_connections_page(result, direction):
+    """
+    Number of connections of a response of dgraph_queries.query_host_<direction>_connections_simple (the connections
+    are not converted).
+    """
+    query_name = 'queryHostOriginated' if direction == 'originated' else 'queryHostResponded'
+    hosts_json = json.loads(result).get(query_name, [])
+    return len(hosts_json[0].get('host.' + direction, [])) if hosts_json else 0
+
+
+class ConnectionsPage:
+    """
+    One page of connections of all hosts (result of dgraph_queries.query_connections_since or
+    query_connections_export).
+
+    :ivar connections: list of connection dictionaries (reverse edges with host IPs are removed)
+    :ivar uids: Dgraph uids of the connections
+    :ivar originated_ips: IP addresses of originators of the connections
+    :ivar responded_ips: IP addresses of responders of the connections
+    :ivar ts_ns: numpy int64 array of connection.ts values as nanoseconds since epoch (UTC)
+    """
+    __slots__ = ('connections', 'uids', 'originated_ips', 'responded_ips', 'ts_ns')
+
+    def __init__(self, connections, uids, originated_ips, responded_ips, ts_ns):
+        self.connections = connections
+        self.uids = uids
+        self.originated_ips = originated_ips
+        self.responded_ips = responded_ips
+        self.ts_ns = ts_ns
+
+    def __len__(self):
+        return len(self.connections)
+
+
+def parse_connections_since_page(result, query_name='queryConnectionsSince'):
+    """
+    Decode a response of dgraph_queries.query_connections_since (or query_connections_export with query name
+    queryConnectionsExport).
+
+    :param result: JSON response
+    :return: ConnectionsPage
+    """
+    connections = json.loads(result).get(query_name, [])
+
+    originated_ips = []
+    responded_ips = []
+    for connection in connections:
+        originator = connection.pop('~host.originated', None)
+        responder = connection.pop('~host.responded', None)
+        originated_ips.append(originator[0]['originated_ip'] if originator else None)
+        responded_ips.append(responder[0]['responded_ip'] if responder else None)
+
+    uids = [connection['uid'] for connection in connections]
+    ts_ns = convert_ts_to_epoch_ns([connection['connection.ts'] for connection in connections])
+
+    return ConnectionsPage(connections, uids, originated_ips, responded_ips, ts_ns)
+
+
+def convert_ts_to_epoch_ns(ts_strings):
+    """
+    :param ts_strings: RFC3339 time strings (as stored in connection.ts)
+    :return: numpy int64 array of nanoseconds since epoch
+    """
+    if not ts_strings:
+        return np.empty(0, dtype=np.int64)
+    return pd.to_datetime(ts_strings, utc=True).asi8
+
+
+def format_ts(ts_ns):
+    """
+    :param ts_ns: numpy int64 array of nanoseconds since epoch
+    :return: numpy array of RFC3339 time strings usable as Dgraph query variables
+    """
+    return np.datetime_as_string(np.asarray(ts_ns).astype('datetime64[ns]').astype('datetime64[us]'), unit='us',
+                                 timezone='UTC')
+
+
+def generate_time_windows(ts_ns, hours, minutes, seconds):
+    """
+    Vectorized computation of time neighbourhood windows <ts - window, ts + window> of all connections of a page.
+
+    :return: (window start strings, window end strings)
+    """
+    ts_ns = np.asarray(ts_ns, dtype=np.int64)
+    window_ns = ((hours * 60 + minutes) * 60 + seconds) * NANOSECONDS_IN_SECOND
+    return format_ts(ts_ns - window_ns), format_ts(ts_ns + window_ns)
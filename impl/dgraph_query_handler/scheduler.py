@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Size-aware scheduling of hosts for the 'NEIGHBOURHOOD mode' worker pool.
+
+A few hosts (e.g. a victim web server or a DNS resolver) hold most of the connections. If hosts are handed out in file
+order, the run ends with idle workers waiting for the last large host. The planning step queries the number of
+originated and responded connections of every host and hands out hosts largest-first (LPT scheduling), so small hosts
+fill the gaps at the end of the run.
+
+Hosts that would still take longer than the total work divided by the number of workers are split into time shards
+(consecutive ranges of connection.ts with the same number of connections), which are processed by different workers
+and merged into the file of the host afterwards.
+
+A task is a tuple (host IP, shard index, shard count, shard start time, shard end time). Hosts that are not split are
+represented by a single task (host IP, 0, 1, None, None).
+"""
+
+import math
+import heapq
+import orjson as json
+
+
+def parse_host_connection_counts(counts_json):
+    """
+    Convert result of dgraph_queries.query_host_connection_counts to a dictionary.
+
+    :param counts_json: JSON response of the query
+    :return: dictionary { host IP -> (number of originated connections, number of responded connections) }
+    """
+    host_counts = {}
+    for host in json.loads(counts_json)['queryHostCounts']:
+        if 'host.ip' in host:
+            host_counts[host['host.ip']] = (host.get('originated_count', 0), host.get('responded_count', 0))
+    return host_counts
+
+
+def estimate_host_costs(host_counts, host_ips):
+    """
+    Estimate work of each host. A neighbourhood is computed for each originated connection, so the cost is the number
+    of originated connections (responded connections only break ties, they make the windows of the host denser).
+
+    :param host_counts: output of parse_host_connection_counts
+    :param host_ips: IPs of the hosts to be processed
+    :return: dictionary { host IP -> (cost, tie breaker) }
+    """
+    return {host_ip: host_counts.get(host_ip, (0, 0)) for host_ip in host_ips}
+
+
+# connection.ts bounds of the first and the last time shard of a host:
+FIRST_SHARD_START = '0001-01-01T00:00:00Z'
+LAST_SHARD_END = '9999-12-31T23:59:59Z'
+
+
+def plan_shard_counts(host_costs, workers, shard_threshold=None):
+    """
+    Compute the number of time shards of each host, so that no task is larger than the threshold.
+
+    :param host_costs: output of estimate_host_costs
+    :param workers: number of worker processes
+    :param shard_threshold: maximum cost (number of originated connections) of one task, by default the total cost
+                            divided by the number of workers (the wall time is then bounded by total work / workers)
+    :return: dictionary { host IP -> number of shards }
+    """
+    if not shard_threshold:
+        total_cost = sum(cost[0] for cost in host_costs.values())
+        shard_threshold = max(1, math.ceil(total_cost / max(1, workers)))
+
+    return {host_ip: max(1, math.ceil(cost[0] / shard_threshold)) for host_ip, cost in host_costs.items()}
+
+
+def generate_shard_tasks(host_costs, shard_counts, ts_at_offset_func):
+    """
+    Generate tasks of all hosts. Boundaries of the time shards are timestamps of connections at equally spaced
+    offsets of the time-ordered originated connections of the host, so each shard has about the same cost.
+
+    :param host_costs: output of estimate_host_costs
+    :param shard_counts: output of plan_shard_counts
+    :param ts_at_offset_func: function (host IP, offset) -> connection.ts at the offset (None if it is not available)
+    :return: dictionary { task -> estimated cost }
+    """
+    task_costs = {}
+    for host_ip, (originated_count, responded_count) in host_costs.items():
+        shard_count = shard_counts.get(host_ip, 1)
+        boundaries = [ts_at_offset_func(host_ip, round(i * originated_count / shard_count))
+                      for i in range(1, shard_count)]
+
+        if shard_count == 1 or None in boundaries:
+            task_costs[(host_ip, 0, 1, None, None)] = (originated_count, responded_count)
+            continue
+
+        boundaries = [FIRST_SHARD_START] + boundaries + [LAST_SHARD_END]
+        for shard_index in range(shard_count):
+            task = (host_ip, shard_index, shard_count, boundaries[shard_index], boundaries[shard_index + 1])
+            task_costs[task] = (originated_count / shard_count, responded_count / shard_count)
+
+    return task_costs
+
+
+def longest_first(task_costs):
+    """
+    :return: list of tasks (or host IPs) ordered by estimated cost in descending order
+    """
+    return sorted(task_costs, key=lambda task: task_costs[task], reverse=True)
+
+
+def simulate_makespan(durations, workers):
+    """
+    Simulate greedy list scheduling (what Pool.imap_unordered with chunksize=1 does): the next task in order is taken
+    by the first worker that becomes idle.
+
+    :param durations: task durations in the order in which the tasks are handed out
+    :param workers: number of worker processes
+    :return: time when the last task finishes
+    """
+    worker_finish_times = [0.0] * max(1, workers)
+    for duration in durations:
+        heapq.heappush(worker_finish_times, heapq.heappop(worker_finish_times) + duration)
+    return max(worker_finish_times)
+
+
+def print_makespan_report(task_costs, schedule, file_order, actual_durations, actual_makespan, workers):
+    """
+    Compare the predicted makespan of the schedule with the real one. Costs are converted to seconds using the
+    average measured time per unit of cost.
+
+    :param task_costs: output of generate_shard_tasks
+    :param schedule: tasks in the order in which they were handed out
+    :param file_order: host IPs in the order of the input file
+    :param actual_durations: dictionary { task -> measured processing time in seconds }
+    :param actual_makespan: measured wall time of the whole pool in seconds
+    :param workers: number of worker processes
+    """
+    total_cost = sum(task_costs[task][0] for task in schedule)
+    total_seconds = sum(actual_durations.values())
+    seconds_per_unit = total_seconds / total_cost if total_cost else 0.0
+
+    host_durations = {}
+    for task, duration in actual_durations.items():
+        host_durations[task[0]] = host_durations.get(task[0], 0.0) + duration
+
+    predicted = simulate_makespan([task_costs[task][0] * seconds_per_unit for task in schedule], workers)
+    file_order_makespan = simulate_makespan([host_durations.get(host_ip, 0.0) for host_ip in file_order], workers)
+
+    print('Makespan predicted (longest-first):          {:10.2f} s'.format(predicted))
+    print('Makespan actual:                             {:10.2f} s'.format(actual_makespan))
+    print('Makespan lower bound (total work / workers): {:10.2f} s'.format(total_seconds / max(1, workers)))
+    print('Makespan of file order, hosts not sharded:   {:10.2f} s'.format(file_order_makespan))
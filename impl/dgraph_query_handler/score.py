@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Batch scoring of new connections by a fitted clustering model (see cluster_model.py).
+
+Neighbourhood feature rows (e.g. the final neighbourhood CSV or neighbourhood files of the streaming mode) are read
+in chunks, transformed by the preprocessing state stored with the model, assigned to the nearest prototypes and
+written with their cluster and anomaly score (distance to the prototype). Identifier columns of the connection
+(connection.uid, originated_ip, responded_ip) are copied to the output if they are present.
+
+Usage: $ python3 score.py -m model.npz -i FINAL_neighbourhood_both_days.csv -o scores.csv [-cs 200000 -b 65536]
+"""
+
+import time
+import argparse
+import pandas as pd
+import feature_columns
+from cluster_model import ClusterModel
+
+
+def score_csv(model, input_files, output_file, chunk_size=200000, batch_size=65536):
+    """
+    Score rows of the input CSV files chunk by chunk and write them to the output CSV file.
+
+    :return: number of scored rows
+    """
+    columns = set(model.input_columns() + feature_columns.CONN_IDS_COLS)
+    n_rows = 0
+    for input_file in input_files:
+        for chunk in pd.read_csv(input_file, chunksize=chunk_size, low_memory=False,
+                                 usecols=lambda column: column in columns):
+            result = model.score_frame(chunk, batch_size)
+            ids = chunk.filter(feature_columns.CONN_IDS_COLS)
+            pd.concat([ids, result], axis=1).to_csv(output_file, mode='w' if n_rows == 0 else 'a',
+                                                    header=n_rows == 0, index=False)
+            n_rows += len(chunk)
+    return n_rows
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model_file', help='Fitted model (see cluster_model.py)', type=str, required=True)
+    parser.add_argument('-i', '--input_csv', help='CSV files with neighbourhood feature rows', nargs='+',
+                        required=True)
+    parser.add_argument('-o', '--output_csv', help='Output CSV file', type=str, default='scores.csv')
+    parser.add_argument('-cs', '--chunk_size', help='Number of rows read from CSV at once', type=int, default=200000)
+    parser.add_argument('-b', '--batch_size', help='Number of rows assigned at once', type=int, default=65536)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    cluster_model = ClusterModel.load(args.model_file)
+
+    start = time.perf_counter()
+    scored = score_csv(cluster_model, args.input_csv, args.output_csv, args.chunk_size, args.batch_size)
+    seconds = time.perf_counter() - start
+    print('Scored {} rows in {:.2f} s ({:.0f} rows/s).'.format(scored, seconds, scored / max(seconds, 1e-9)))
+    print('Successfully wrote to file ' + args.output_csv + '.')
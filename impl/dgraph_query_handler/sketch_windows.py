@@ -0,0 +1,459 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Approximate time neighbourhood features of heavy hosts (DDoS victims, scanners, ...) from mergeable sketches.
+
+Connections of a host with at least degree_threshold connections in a direction (out-edges of an originator, in-edges
+of a responder) are aggregated per (host, time bucket) - buckets of bucket_seconds aligned to the epoch. Every
+occupied bucket keeps:
+
+  count-min sketch      depth x width counters of categorical values, port categories and similar attribute values
+                        (protocol counts, modes, port counts, similar attribute counts)
+  HyperLogLog           2 ** precision registers of peer hosts (distinct peers)
+  moments               number of connections, sums and numbers of non-missing values (totals and means)
+
+Sketches of buckets are merged by addition (count-min, moments - as prefix sums over the buckets of the host) and by
+register maximum (HyperLogLog), so the window of a connection is answered from the merged sketches of buckets
+floor((ts - w) / bucket) .. floor((ts + w) / bucket), once for all connections with the same bucket range. Hosts
+below the threshold keep the exact features of multiscale_windows.py, columns <prefix>_approximate mark connections
+with approximated blocks.
+
+Count-min counters and HyperLogLog registers are stored sparsely (only the non-zero cells of every bucket), so a
+bucket takes memory proportional to its connections - a heavy host spread over many sparsely occupied buckets (a slow
+scanner) does not allocate depth x width counters and 2 ** precision registers for each of them.
+
+Error bounds (N = number of connections of the merged buckets):
+
+  buckets       merged buckets cover the window (ts - w, ts + w> extended by less than one bucket on each side, all
+                features describe this extended window
+  count-min     estimates are never smaller than the counts of the extended window, with probability 1 - e^-depth
+                the over-count is at most e / width * N; modes are the category with the largest estimate
+  HyperLogLog   relative standard error of distinct peers 1.04 / sqrt(2 ** precision) (small counts use linear
+                counting and are nearly exact)
+  moments       totals and means of the extended window are exact
+  similar       sum of estimates of the values of the connection, bounded by the total - neighbours sharing several
+                values are counted several times
+
+Usage: $ python3 sketch_windows.py -i output-o-*.csv -o sketch_features.csv [-w 10 60 300 1800] [-dt 10000]
+         [-bs 10] [-cmp] [-sa | -at <output_path of app data tables>]
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import responses
+import feature_columns
+from attribute_bitsets import AttributeBitsets, WORD_BITS
+from multiscale_windows import MultiScaleWindows, COUNTED_PROTOCOLS, WINDOW_MODE_COLS, MULTISCALE_INPUT_COLS, \
+    NEIGHBOURHOODS, load_connections
+
+
+DEFAULT_DEGREE_THRESHOLD = 10000
+DEFAULT_BUCKET_SECONDS = 10
+# failure probability e^-4 < 2 %, over-count at most 0.27 % of the window:
+DEFAULT_DEPTH = 4
+DEFAULT_WIDTH = 1024
+# 1024 registers, standard error 3.25 %:
+DEFAULT_PRECISION = 10
+
+
+def mix64(values):
+    """
+    :return: 64-bit hashes of the integers (splitmix64 finalizer)
+    """
+    z = np.asarray(values).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def leading_zeros(values):
+    """
+    :return: number of leading zero bits of the uint64 values
+    """
+    counts = np.zeros(len(values), dtype=np.int64)
+    shifted = values.copy()
+    for shift in [32, 16, 8, 4, 2, 1]:
+        # the highest shift bits are zero:
+        zero = shifted < (np.uint64(1) << np.uint64(64 - shift))
+        counts[zero] += shift
+        shifted[zero] <<= np.uint64(shift)
+    counts[values == 0] = 64
+    return counts
+
+
+def hll_estimate(registers):
+    """
+    :param registers: uint8 matrix of HyperLogLog registers (one sketch per row)
+    :return: estimated numbers of distinct items
+    """
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.exp2(-np.arange(256, dtype=np.float64))[registers].sum(axis=1)
+    zeros = (registers == 0).sum(axis=1)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class BucketSketches:
+    """
+    Sketches of connections of heavy hosts in one direction per (host, bucket) group. Groups are sorted by (host,
+    bucket) - the CSR order of connections.
+
+    :ivar bucket_ns: bucket length in nanoseconds
+    :ivar group_keys: sorted keys of groups (host * span + bucket offset)
+    :ivar moments: prefix sums over groups of (numbers of connections, sums of values, numbers of non-missing values)
+    :ivar cell_keys: sorted keys of the non-zero count-min cells of groups ((row * width + counter) * groups + group)
+    :ivar cell_prefix: prefix sums of the counts of the cells (cell_keys + 1)
+    :ivar register_keys: sorted keys of the non-zero HyperLogLog registers of groups (group * 2 ** precision +
+                         register)
+    :ivar register_ranks: values of the registers
+    :ivar register_starts: first register of every group in register_keys (groups + 1)
+    """
+
+    def __init__(self, windows, direction, heavy_hosts, bucket_ns, depth, width, precision):
+        """
+        :param windows: multiscale_windows.MultiScaleWindows of all connections
+        :param direction: 'out' (connections originated by the host) or 'in' (responded by the host)
+        :param heavy_hosts: bool array - hosts whose connections are sketched
+        """
+        graph = windows.graph
+        rows, peers, order = (graph.src, graph.dst, graph.out_order) if direction == 'out' else \
+            (graph.dst, graph.src, graph.in_order)
+        self.bucket_ns = bucket_ns
+        self.depth = depth
+        self.width = width
+        self.precision = precision
+        self.seeds = mix64(np.arange(1, depth + 1))
+
+        edges = order[heavy_hosts[rows[order]]]
+        edge_rows = rows[edges]
+        buckets = graph.ts_ns[edges] // bucket_ns
+        self.first_bucket = int(buckets.min()) - 1 if len(edges) else 0
+        # bucket offsets 0 and span - 1 are empty, bucket ranges of queries are clipped to them:
+        self.span = (int(buckets.max()) - self.first_bucket + 2) if len(edges) else 2
+        edge_keys = edge_rows * self.span + (buckets - self.first_bucket)
+        starts = np.flatnonzero(np.r_[True, edge_keys[1:] != edge_keys[:-1]]) if len(edges) else \
+            np.zeros(0, dtype=np.int64)
+        self.group_keys = edge_keys[starts]
+        n_groups = len(starts)
+        groups = np.repeat(np.arange(n_groups), np.diff(np.r_[starts, len(edges)]))
+
+        values = windows.values[edges]
+        valid = ~np.isnan(values)
+        self.moments = [np.zeros(n_groups + 1, dtype=np.int64), np.zeros((n_groups + 1, values.shape[1])),
+                        np.zeros((n_groups + 1, values.shape[1]), dtype=np.int64)]
+        if n_groups:
+            np.cumsum(np.diff(np.r_[starts, len(edges)]), out=self.moments[0][1:])
+            np.cumsum(np.add.reduceat(np.where(valid, values, 0.0), starts), axis=0, out=self.moments[1][1:])
+            np.cumsum(np.add.reduceat(valid.astype(np.int64), starts), axis=0, out=self.moments[2][1:])
+
+        # categories and port categories are the one-hot columns of the windows, attribute values follow them:
+        item_groups, item_keys = np.nonzero(windows.indicators[edges])
+        item_groups = [groups[item_groups]]
+        item_keys = [item_keys.astype(np.int64)]
+        self.attribute_offsets = {}
+        offset = windows.indicators.shape[1]
+        bitsets = windows.attribute_bitsets
+        for attribute in (bitsets.attributes if bitsets is not None else []):
+            self.attribute_offsets[attribute] = offset
+            value_rows, bits = self.attribute_items(bitsets.masks[attribute][edges])
+            item_groups.append(groups[value_rows])
+            item_keys.append(offset + bits)
+            offset += bitsets.masks[attribute].shape[1] * WORD_BITS
+        item_groups = np.concatenate(item_groups)
+        item_keys = np.concatenate(item_keys)
+
+        # cells of a counter are consecutive and ordered by group, so the prefix sums answer a range of groups:
+        self.n_groups = max(n_groups, 1)
+        cells = ((np.arange(depth) * width + self.hash_keys(item_keys)) * self.n_groups + item_groups[:, None]).ravel()
+        self.cell_keys, cell_counts = np.unique(cells, return_counts=True)
+        self.cell_prefix = np.zeros(len(self.cell_keys) + 1, dtype=np.int64)
+        np.cumsum(cell_counts, out=self.cell_prefix[1:])
+
+        # register = first bits of the hash of the peer, value = position of the first one bit of the remaining bits:
+        hashes = mix64(peers[edges])
+        register_ids = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+        ranks = np.minimum(leading_zeros(hashes << np.uint64(precision)) + 1, 64 - precision + 1).astype(np.uint8)
+        register_keys = groups * (1 << precision) + register_ids
+        key_order = np.argsort(register_keys, kind='stable')
+        register_keys = register_keys[key_order]
+        starts = np.flatnonzero(np.r_[True, register_keys[1:] != register_keys[:-1]]) if len(edges) else \
+            np.zeros(0, dtype=np.int64)
+        self.register_keys = register_keys[starts]
+        self.register_ranks = np.maximum.reduceat(ranks[key_order], starts) if len(edges) else \
+            np.zeros(0, dtype=np.uint8)
+        self.register_starts = np.searchsorted(self.register_keys, np.arange(n_groups + 1) * (1 << precision))
+
+    @staticmethod
+    def attribute_items(masks):
+        """
+        :return: (row indices, bit positions) of the set bits of the bitmask rows
+        """
+        bits = np.unpackbits(masks.view(np.uint8), axis=1, bitorder='little')
+        rows, positions = np.nonzero(bits)
+        return rows, positions.astype(np.int64)
+
+    def hash_keys(self, keys):
+        """
+        :return: counter of every key in every row of the count-min sketch (keys x depth)
+        """
+        return (mix64(keys.astype(np.uint64)[:, None] ^ self.seeds[None, :]) % np.uint64(self.width)).astype(np.int64)
+
+    def ranges(self, query_hosts, query_ts, window_ns):
+        """
+        :return: (lo, hi) - groups lo:hi are the buckets of the host overlapping the window of every query
+        """
+        first = np.clip((query_ts - window_ns) // self.bucket_ns - self.first_bucket, 0, self.span - 1)
+        last = np.clip((query_ts + window_ns) // self.bucket_ns - self.first_bucket, 0, self.span - 1)
+        lo = np.searchsorted(self.group_keys, query_hosts * self.span + first, 'left')
+        hi = np.searchsorted(self.group_keys, query_hosts * self.span + last, 'right')
+        return lo, hi
+
+    def counter_sums(self, lo, hi, counters):
+        """
+        :param counters: cells (row * width + counter), broadcast with lo and hi
+        :return: sums of the counters over the groups lo:hi
+        """
+        first = counters * self.n_groups
+        return self.cell_prefix[np.searchsorted(self.cell_keys, first + hi, 'left')] - \
+            self.cell_prefix[np.searchsorted(self.cell_keys, first + lo, 'left')]
+
+    def estimate(self, lo, hi, keys):
+        """
+        :return: count-min estimates of the keys in the merged groups lo:hi (queries x keys)
+        """
+        counters = (np.arange(self.depth)[:, None] * self.width +
+                    self.hash_keys(np.asarray(keys, dtype=np.int64)).T)[None, :, :]
+        return self.counter_sums(lo[:, None, None], hi[:, None, None], counters).min(axis=1)
+
+    def estimate_items(self, lo, hi, keys):
+        """
+        :return: count-min estimate of the key of every item in the merged groups lo:hi of the item
+        """
+        counters = np.arange(self.depth)[None, :] * self.width + self.hash_keys(np.asarray(keys, dtype=np.int64))
+        return self.counter_sums(lo[:, None], hi[:, None], counters).min(axis=1)
+
+    def distinct_peers(self, lo, hi):
+        """
+        :return: HyperLogLog estimates of distinct peers of the merged groups lo:hi
+        """
+        n_registers = 1 << self.precision
+        merged = np.zeros((len(lo), n_registers), dtype=np.uint8)
+        # non-zero registers of the groups lo:hi of a query are one slice of register_keys:
+        starts, ends = self.register_starts[lo], self.register_starts[hi]
+        lengths = ends - starts
+        queries = np.repeat(np.arange(len(lo)), lengths)
+        entries = np.arange(len(queries)) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        np.maximum.at(merged, (queries, self.register_keys[entries] % n_registers), self.register_ranks[entries])
+        return np.rint(hll_estimate(merged)).astype(np.int64)
+
+
+class SketchWindows:
+    """
+    :ivar degree_threshold: hosts with at least this number of connections in a direction are approximated
+    :ivar heavy: { direction -> bool array of heavy hosts }
+    :ivar sketches: { direction -> BucketSketches }
+    """
+
+    def __init__(self, windows, degree_threshold=DEFAULT_DEGREE_THRESHOLD, bucket_seconds=DEFAULT_BUCKET_SECONDS,
+                 depth=DEFAULT_DEPTH, width=DEFAULT_WIDTH, precision=DEFAULT_PRECISION):
+        """
+        :param windows: multiscale_windows.MultiScaleWindows of the connections
+        """
+        graph = windows.graph
+        self.degree_threshold = degree_threshold
+        self.heavy = {'out': np.diff(graph.out_indptr) >= degree_threshold,
+                      'in': np.diff(graph.in_indptr) >= degree_threshold}
+        self.sketches = {direction: BucketSketches(windows, direction, heavy_hosts,
+                                                   bucket_seconds * responses.NANOSECONDS_IN_SECOND, depth, width,
+                                                   precision)
+                         for direction, heavy_hosts in self.heavy.items()}
+
+    def heavy_queries(self, direction, query_hosts):
+        """
+        :return: bool array - connections whose host is heavy in the direction
+        """
+        return self.heavy[direction][query_hosts]
+
+    def block_features(self, windows, prefix, label, window_ns, query_ids, query_hosts):
+        """
+        :param query_ids: connections (rows) of heavy hosts
+        :param query_hosts: host of the block of every connection
+        :return: { column -> values } of one neighbourhood block and window (columns of
+                 MultiScaleWindows.compute_features)
+        """
+        host, direction = NEIGHBOURHOODS[prefix]
+        sketches = self.sketches[direction]
+        query_ts = windows.graph.ts_ns[query_ids]
+        lo, hi = sketches.ranges(query_hosts, query_ts, window_ns)
+        # connections with the same bucket range share the answer:
+        ranges, inverse = np.unique(np.column_stack([lo, hi]), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        range_lo, range_hi = ranges[:, 0], ranges[:, 1]
+
+        suffix = '_' + label
+        total = sketches.moments[0][range_hi] - sketches.moments[0][range_lo]
+        empty = total[inverse] == 0
+        features = {prefix + '_total' + suffix: total[inverse]}
+
+        estimates = sketches.estimate(range_lo, range_hi, np.arange(windows.indicators.shape[1]))[inverse]
+        proto = windows.categories['connection.proto']
+        for protocol in COUNTED_PROTOCOLS:
+            features[prefix + '_proto_' + protocol + '_count' + suffix] = \
+                estimates[:, windows.offsets['connection.proto'] + proto.get_loc(protocol)] \
+                if protocol in proto else np.zeros(len(query_ids), dtype=np.int32)
+        for column, mode_name in WINDOW_MODE_COLS.items():
+            offset = windows.offsets[column]
+            categories = windows.categories[column]
+            modes = estimates[:, offset:offset + len(categories)].argmax(axis=1)
+            modes[empty] = len(categories)
+            features[prefix + '_' + mode_name + suffix] = windows.mode_values(column, modes)
+
+        window_sums = (sketches.moments[1][range_hi] - sketches.moments[1][range_lo])[inverse]
+        window_valid = (sketches.moments[2][range_hi] - sketches.moments[2][range_lo])[inverse]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = window_sums / window_valid
+        means[empty] = 0.0
+        means[empty, 0] = (query_ts[empty] - windows.time_origin) / responses.NANOSECONDS_IN_SECOND
+        features[prefix + '_connection.time_mean' + suffix] = means[:, 0] + windows.time_origin / \
+            responses.NANOSECONDS_IN_SECOND
+        for j, column in enumerate(windows.numerical_columns):
+            features[prefix + '_' + column + '_mean' + suffix] = means[:, j + 1]
+
+        ports = estimates[:, windows.offsets['orig_p']:]
+        for j, column in enumerate(feature_columns.neighbourhood_ports_cols(prefix + '_')):
+            features[column + suffix] = ports[:, j]
+        features[prefix + '_unique_peers' + suffix] = sketches.distinct_peers(range_lo, range_hi)[inverse]
+
+        bitsets = windows.attribute_bitsets
+        # the connection itself is in the window of its host in the same direction (orig_orig, resp_resp):
+        includes_self = int((host == 'originator') == (direction == 'out'))
+        for attribute in (bitsets.attributes if bitsets is not None else []):
+            value_rows, bits = sketches.attribute_items(bitsets.masks[attribute][query_ids])
+            value_counts = sketches.estimate_items(range_lo[inverse[value_rows]], range_hi[inverse[value_rows]],
+                                                   sketches.attribute_offsets[attribute] + bits)
+            shared = np.bincount(value_rows, weights=np.maximum(value_counts - includes_self, 0),
+                                 minlength=len(query_ids))
+            features[prefix + '_similar_' + attribute + '_count' + suffix] = \
+                np.minimum(shared, np.maximum(features[prefix + '_total' + suffix] - includes_self, 0)).astype(
+                    np.int64)
+        return features
+
+
+def compare_features(exact, approximate, approximated):
+    """
+    :param approximated: DataFrame of <prefix>_approximate columns
+    :return: DataFrame of errors of approximated rows of every feature (mean absolute error, mean relative error
+             against the exact value (at least 1), share of different modes)
+    """
+    rows = []
+    for column in approximate.columns:
+        prefix = column.split('_')[0] + '_' + column.split('_')[1]
+        mask = approximated[prefix + '_approximate'].to_numpy() if prefix + '_approximate' in approximated else None
+        if mask is None or not mask.any() or column not in exact:
+            continue
+        exact_values = exact[column].to_numpy()[mask]
+        approximate_values = approximate[column].to_numpy()[mask]
+        if exact[column].dtype.kind in 'biuf':
+            exact_values = exact_values.astype(np.float64)
+            error = np.abs(approximate_values.astype(np.float64) - exact_values)
+            error = np.where(np.isnan(error) & np.isnan(exact_values) & np.isnan(approximate_values.astype(
+                np.float64)), 0.0, error)
+            rows.append((column, int(mask.sum()), np.nanmean(error),
+                         np.nanmean(error / np.maximum(np.abs(exact_values), 1.0)), np.nan))
+        else:
+            rows.append((column, int(mask.sum()), np.nan, np.nan,
+                         np.mean(approximate_values.astype(str) != exact_values.astype(str))))
+    return pd.DataFrame(rows, columns=['feature', 'rows', 'mean_absolute_error', 'mean_relative_error',
+                                       'different_modes'])
+
+
+def feature_kind(column):
+    """
+    :return: kind of a neighbourhood column for error summaries (total, count, mode, mean, unique_peers, similar)
+    """
+    name = column.split('_', 2)[2].rsplit('_', 1)[0]
+    if name in ['total', 'unique_peers']:
+        return name
+    if name.startswith('similar_'):
+        return 'similar'
+    return name.rsplit('_', 1)[-1] if name.endswith('_mode') or name.endswith('_mean') else 'count'
+
+
+def summarize_errors(errors):
+    """
+    :param errors: output of compare_features
+    :return: errors averaged over the features of every window and kind
+    """
+    errors = errors.assign(window=errors['feature'].str.rsplit('_', n=1).str[-1],
+                           kind=errors['feature'].map(feature_kind))
+    return errors.groupby(['window', 'kind'], sort=False)[['mean_absolute_error', 'mean_relative_error',
+                                                           'different_modes']].mean().reset_index()
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_csv', help='CONNECTIONS mode CSV files (output-o-<IP>.csv) or partitioned '
+                        'datasets', nargs='+', required=True)
+    parser.add_argument('-o', '--output_csv', help='Output CSV file (connection ids + neighbourhood features)',
+                        type=str, default='sketch_features.csv')
+    parser.add_argument('-w', '--windows', help='Half-widths of time windows in seconds', nargs='+', type=int,
+                        default=[10, 60, 300, 1800])
+    parser.add_argument('-dt', '--degree_threshold', help='Minimum number of connections of a host in a direction '
+                        'to approximate its neighbourhoods', type=int, default=DEFAULT_DEGREE_THRESHOLD)
+    parser.add_argument('-bs', '--bucket_seconds', help='Length of sketch buckets in seconds', type=int,
+                        default=DEFAULT_BUCKET_SECONDS)
+    parser.add_argument('-d', '--depth', help='Number of rows of count-min sketches', type=int, default=DEFAULT_DEPTH)
+    parser.add_argument('-cw', '--width', help='Number of counters in a row of count-min sketches', type=int,
+                        default=DEFAULT_WIDTH)
+    parser.add_argument('-p', '--precision', help='HyperLogLog precision (2 ** precision registers)', type=int,
+                        default=DEFAULT_PRECISION)
+    parser.add_argument('-cmp', '--compare', help='Compute exact features too and print errors of the approximated '
+                        'features', action='store_true')
+    parser.add_argument('-co', '--compare_csv', help='Output CSV file with errors of every feature (with --compare)',
+                        type=str, default=None)
+    parser.add_argument('-sa', '--similar_attributes', help='Compute similar attribute counts from list columns of '
+                        'the input', action='store_true')
+    parser.add_argument('-at', '--app_tables', help='Compute similar attribute counts from app data tables of this '
+                        'output path (see app_tables.py)', type=str, default=None)
+    parser.add_argument('-mb', '--max_bits', help='Maximum width of attribute bitmasks', type=int, default=256)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    connections = load_connections(args.input_csv, MULTISCALE_INPUT_COLS + feature_columns.SIMILAR_ATTRIBUTES
+                                   if args.similar_attributes else MULTISCALE_INPUT_COLS)
+    bitsets = None
+    if args.similar_attributes:
+        bitsets = AttributeBitsets.from_frame(connections, max_bits=args.max_bits)
+    elif args.app_tables:
+        bitsets = AttributeBitsets.from_app_tables(args.app_tables, connections['connection.uid'],
+                                                   max_bits=args.max_bits)
+    windows = MultiScaleWindows(connections, bitsets)
+    sketch_windows = SketchWindows(windows, args.degree_threshold, args.bucket_seconds, args.depth, args.width,
+                                   args.precision)
+    print('Loaded {} connections of {} hosts, {} heavy originators, {} heavy responders.'.format(
+        len(connections), windows.graph.n_hosts, sketch_windows.heavy['out'].sum(), sketch_windows.heavy['in'].sum()))
+
+    features = windows.compute_features(args.windows, sketch_windows)
+    if args.compare:
+        errors = compare_features(windows.compute_features(args.windows), features,
+                                  features.filter(like='_approximate'))
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(summarize_errors(errors).to_string(index=False))
+        if args.compare_csv:
+            errors.to_csv(args.compare_csv, index=False, header=True)
+
+    features = pd.concat([connections[feature_columns.CONN_IDS_COLS], features], axis=1)
+    features.to_csv(args.output_csv, index=False, header=True)
+    print('Successfully wrote to file ' + args.output_csv + '.')
@@ -0,0 +1,418 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Event-time watermark bookkeeping of the 'STREAMING mode' of query_handler.py.
+
+New traffic is loaded into Dgraph continuously. Every poll fetches connections with connection.ts newer than the
+poll start and keeps them in memory (per originating host) until their neighbourhood can no longer change: the
+forward half-window <ts, ts + window> of a connection is closed once connections newer than ts + window +
+allowed lateness were seen. Closed connections are emitted (neighbourhood computed and appended to the output) and
+the watermark - the time up to which all connections were emitted - is persisted, so a restarted run continues
+where the previous one stopped.
+
+Held back connections stay in memory between polls, a poll therefore only re-reads the last allowed lateness
+interval (to pick up connections loaded late) instead of everything newer than the watermark. Connections of every host
+(as originator and as responder) newer than watermark - window are kept as the history of the host, so neighbourhoods
+of emitted connections are computed from memory (WindowNeighbourhoods) instead of aggregate queries re-fetching the
+window from Dgraph. The first poll of a run also fetches the window before the watermark to fill the history.
+
+Output is written before the watermark is persisted: after a crash, connections emitted by the last poll may be
+written again (at-least-once). Connections loaded into Dgraph after their window was emitted are not processed.
+"""
+
+import os
+import re
+import time
+import operator
+import numpy as np
+import orjson as json
+import responses
+import dgraph_queries as queries
+
+
+# default watermark of the first run (all connections in the database are processed):
+STREAM_START = '1970-01-01T00:00:00Z'
+
+
+def load_watermark(watermark_file, default=STREAM_START):
+    """
+    :return: persisted watermark (RFC3339 string), default if the file does not exist
+    """
+    if not os.path.exists(watermark_file):
+        return default
+    with open(watermark_file, 'rb') as file:
+        return json.loads(file.read())['watermark']
+
+
+def save_watermark(watermark_file, watermark):
+    """
+    Persist the watermark atomically (a crash never leaves a partially written file).
+    """
+    temp_file = watermark_file + '.tmp'
+    with open(temp_file, 'wb') as file:
+        file.write(json.dumps({'watermark': watermark}))
+    os.replace(temp_file, watermark_file)
+
+
+# predicates averaged by the neighbourhood mean query (avg_<name without 'connection.'>):
+MEAN_PREDICATES = ['connection.duration', 'connection.orig_bytes', 'connection.orig_ip_bytes', 'connection.orig_pkts',
+                   'connection.resp_bytes', 'connection.resp_ip_bytes', 'connection.resp_pkts']
+
+# Dgraph comparison functions of the similar connections filters:
+FILTER_FUNCTIONS = {'eq': operator.eq, 'le': operator.le, 'lt': operator.lt, 'ge': operator.ge, 'gt': operator.gt}
+FILTER_CONDITION = re.compile(r'(eq|le|lt|ge|gt)\((connection\.\w+), ("[^"]*"|[^)]+)\)')
+
+
+class HostWindowState:
+    """
+    Connections of one host kept in memory between polls.
+
+    :ivar host_ip: IP address of the host
+    :ivar pending: dictionary { uid -> (connection.ts in ns, responded IP, connection dictionary) } - originated
+                   connections that were fetched but not emitted yet
+    :ivar history: dictionary { 'originated' / 'responded' -> { uid -> (connection.ts in ns, connection dictionary) } }
+                   - connections of the host newer than watermark - window
+    """
+    __slots__ = ('host_ip', 'pending', 'history', '_sorted')
+
+    def __init__(self, host_ip):
+        self.host_ip = host_ip
+        self.pending = {}
+        self.history = {'originated': {}, 'responded': {}}
+        self._sorted = {}
+
+    def add(self, uid, ts_ns, responded_ip, connection):
+        """
+        :return: True if the connection was not seen before
+        """
+        if uid in self.pending:
+            return False
+        self.pending[uid] = (ts_ns, responded_ip, connection)
+        return True
+
+    def pop_closed(self, cutoff_ns):
+        """
+        Remove and return connections not newer than cutoff_ns.
+
+        :return: list of (connection.ts in ns, uid, responded IP, connection dictionary) ordered by time
+        """
+        closed = [(ts_ns, uid, responded_ip, connection)
+                  for uid, (ts_ns, responded_ip, connection) in self.pending.items() if ts_ns <= cutoff_ns]
+        for _, uid, _, _ in closed:
+            del self.pending[uid]
+        return sorted(closed, key=lambda item: item[0])
+
+    def add_history(self, direction, uid, ts_ns, connection):
+        connections = self.history[direction]
+        if uid not in connections:
+            connections[uid] = (ts_ns, connection)
+            self._sorted.pop(direction, None)
+
+    def prune_history(self, horizon_ns):
+        """
+        Remove connections older than horizon_ns from the history.
+        """
+        for direction, connections in self.history.items():
+            old_uids = [uid for uid, (ts_ns, _) in connections.items() if ts_ns < horizon_ns]
+            for uid in old_uids:
+                del connections[uid]
+            if old_uids:
+                self._sorted.pop(direction, None)
+
+    def window(self, direction, start_ns, end_ns):
+        """
+        :return: connection dictionaries of the history with start_ns <= connection.ts <= end_ns (between() of Dgraph)
+                 ordered by time
+        """
+        if direction not in self._sorted:
+            items = sorted(self.history[direction].values(), key=lambda item: item[0])
+            self._sorted[direction] = (np.array([ts_ns for ts_ns, _ in items], dtype=np.int64),
+                                       [connection for _, connection in items])
+        ts_ns, connections = self._sorted[direction]
+        return connections[np.searchsorted(ts_ns, start_ns, 'left'):np.searchsorted(ts_ns, end_ns, 'right')]
+
+    def is_empty(self):
+        return not self.pending and not any(self.history.values())
+
+
+class StreamingState:
+    """
+    In-memory state kept between polls.
+
+    :ivar watermark_ns: all connections with connection.ts <= watermark were emitted
+    :ivar max_seen_ns: the newest connection.ts seen so far (event time of the stream)
+    :ivar window_ns: forward half-window of the neighbourhood
+    :ivar allowed_lateness_ns: how much older than the newest connection a connection may be when it is loaded
+    :ivar host_ips: originating hosts to process (None = all hosts)
+    :ivar hosts: dictionary { host IP -> HostWindowState } (hosts of all connections of the history)
+    :ivar history_loaded: the window before the watermark was fetched (by the first poll of the run)
+    """
+
+    def __init__(self, watermark, window_ns, allowed_lateness_ns, host_ips=None):
+        self.watermark_ns = int(responses.convert_ts_to_epoch_ns([watermark])[0])
+        self.max_seen_ns = self.watermark_ns
+        self.window_ns = window_ns
+        self.allowed_lateness_ns = allowed_lateness_ns
+        self.host_ips = set(host_ips) if host_ips else None
+        self.hosts = {}
+        self.history_loaded = False
+
+    def history_horizon(self):
+        """
+        :return: connections older than this time (in ns) are not in any window of a connection to emit
+        """
+        return self.watermark_ns - self.window_ns
+
+    def poll_start(self):
+        """
+        :return: RFC3339 time after which connections are fetched by the next poll
+        """
+        if not self.history_loaded:
+            poll_start_ns = self.history_horizon() - 1
+        else:
+            poll_start_ns = max(self.watermark_ns, self.max_seen_ns - self.allowed_lateness_ns)
+        return str(responses.format_ts([poll_start_ns])[0])
+
+    def host_state(self, host_ip):
+        host_state = self.hosts.get(host_ip)
+        if host_state is None:
+            host_state = self.hosts[host_ip] = HostWindowState(host_ip)
+        return host_state
+
+    def add_page(self, page):
+        """
+        Add connections of a responses.ConnectionsPage to the histories of their hosts and not emitted connections
+        to the pending connections of their originators.
+
+        :return: number of connections to emit that were not seen before
+        """
+        horizon_ns = self.history_horizon()
+        new_count = 0
+        for connection, uid, originated_ip, responded_ip, ts_ns in zip(page.connections, page.uids,
+                                                                        page.originated_ips, page.responded_ips,
+                                                                        page.ts_ns):
+            ts_ns = int(ts_ns)
+            self.max_seen_ns = max(self.max_seen_ns, ts_ns)
+            if ts_ns < horizon_ns:
+                continue
+            if originated_ip is not None:
+                self.host_state(originated_ip).add_history('originated', uid, ts_ns, connection)
+            if responded_ip is not None:
+                self.host_state(responded_ip).add_history('responded', uid, ts_ns, connection)
+
+            if ts_ns <= self.watermark_ns or originated_ip is None:
+                continue
+            if self.host_ips is not None and originated_ip not in self.host_ips:
+                continue
+            new_count += self.host_state(originated_ip).add(uid, ts_ns, responded_ip, connection)
+        return new_count
+
+    def advance(self):
+        """
+        Pop connections whose forward half-window is closed and move the watermark (the history is kept until
+        prune_history is called - after the closed connections are emitted).
+
+        :return: (new watermark as RFC3339 string, dictionary { host IP -> output of HostWindowState.pop_closed }),
+                 None if the watermark does not move
+        """
+        cutoff_ns = self.max_seen_ns - self.window_ns - self.allowed_lateness_ns
+        if cutoff_ns <= self.watermark_ns:
+            return None
+
+        closed = {}
+        for host_ip, host_state in self.hosts.items():
+            host_closed = host_state.pop_closed(cutoff_ns)
+            if host_closed:
+                closed[host_ip] = host_closed
+
+        self.watermark_ns = cutoff_ns
+        return str(responses.format_ts([cutoff_ns])[0]), closed
+
+    def prune_history(self):
+        """
+        Remove connections older than the history horizon and hosts without connections.
+        """
+        horizon_ns = self.history_horizon()
+        for host_ip, host_state in list(self.hosts.items()):
+            host_state.prune_history(horizon_ns)
+            if host_state.is_empty():
+                del self.hosts[host_ip]
+
+    def pending_count(self):
+        return sum(len(host_state.pending) for host_state in self.hosts.values())
+
+
+def parse_filter_condition(condition):
+    """
+    :param condition: comparison of a predicate with a constant, e.g. ge(connection.orig_bytes, 100)
+    :return: function (connection dictionary) -> bool (False if the connection does not have the predicate)
+    """
+    match = FILTER_CONDITION.fullmatch(condition.strip())
+    if match is None:
+        raise ValueError('Unsupported filter condition: ' + condition)
+    compare = FILTER_FUNCTIONS[match.group(1)]
+    predicate = match.group(2)
+    value = match.group(3)
+    if value.startswith('"'):
+        value = value[1:-1]
+        return lambda connection: predicate in connection and compare(connection[predicate], value)
+    value = float(value)
+    return lambda connection: connection.get(predicate) is not None and compare(float(connection[predicate]), value)
+
+
+def parse_filters(filters):
+    """
+    Local evaluation of filters of dgraph_queries.generate_similar_filters - conjunctions of conditions
+    ('AND <condition> AND <condition>'), a parenthesized disjunction ('AND (<condition> OR <condition>)') is one
+    condition.
+
+    :return: list of functions (connection dictionary) -> bool, a connection is similar if all of them are true
+    """
+    functions = []
+    for filter_string in filters:
+        for condition in re.split(r'\s*\bAND\s+', filter_string.strip())[1:]:
+            if condition.startswith('('):
+                alternatives = [parse_filter_condition(alternative)
+                                for alternative in re.split(r'\s+OR\s+', condition.strip()[1:-1])]
+                functions.append(lambda connection, alternatives=alternatives:
+                                 any(alternative(connection) for alternative in alternatives))
+            else:
+                functions.append(parse_filter_condition(condition))
+    return functions
+
+
+def group_counts(connections, predicate):
+    """
+    :return: result of @groupby(predicate) { count(uid) } of a Dgraph query over the connections
+    """
+    counts = {}
+    for connection in connections:
+        if predicate in connection:
+            counts[connection[predicate]] = counts.get(connection[predicate], 0) + 1
+    if not counts:
+        return []
+    return [{'@groupby': [{predicate: value, 'count': count} for value, count in sorted(counts.items())]}]
+
+
+class WindowNeighbourhoods:
+    """
+    Aggregates of time neighbourhoods of emitted connections computed from the histories of hosts instead of Dgraph
+    queries. Methods take the arguments of dgraph_queries.query_neighbourhood_* (without the client) and return JSON
+    responses of the same shape, so the features are extracted by the same code as in the NEIGHBOURHOOD mode.
+
+    :ivar state: StreamingState
+    :ivar connection_hosts: dictionary { uid -> (originated IP, responded IP) } of the emitted connections
+    """
+
+    def __init__(self, state, connection_hosts):
+        self.state = state
+        self.connection_hosts = connection_hosts
+        # the queries of one connection use the same window, only the last one is kept:
+        self._times = (None, None)
+        self._window = (None, [])
+        self._filters = (None, [])
+
+    def _connections(self, first_direction, second_direction, uid, ts_start, ts_end):
+        originated_ip, responded_ip = self.connection_hosts[uid]
+        host_ip = originated_ip if first_direction == 'originated' else responded_ip
+        if self._times[0] != (ts_start, ts_end):
+            self._times = ((ts_start, ts_end), responses.convert_ts_to_epoch_ns([ts_start, ts_end]))
+        key = (host_ip, second_direction, ts_start, ts_end)
+        if self._window[0] != key:
+            host_state = self.state.hosts.get(host_ip)
+            start_ns, end_ns = self._times[1]
+            self._window = (key, host_state.window(second_direction, start_ns, end_ns) if host_state else [])
+        return self._window[1]
+
+    def query_neighbourhood_mean(self, first_direction, second_direction, uid, ts_start, ts_end):
+        connections = self._connections(first_direction, second_direction, uid, ts_start, ts_end)
+        if not connections:
+            return json.dumps({'queryAverageNeighbourhood': []})
+
+        averages = {}
+        for predicate in MEAN_PREDICATES:
+            values = [connection[predicate] for connection in connections if connection.get(predicate) is not None]
+            averages['avg_' + predicate[len('connection.'):]] = sum(values) / len(values) if values else 0
+        averages.update({'min_ts': connections[0]['connection.ts'], 'max_ts': connections[-1]['connection.ts'],
+                         'count_all': len(connections)})
+        return json.dumps({'queryAverageNeighbourhood': [{'~host.' + first_direction: [averages]}]})
+
+    def query_neighbourhood_counts(self, first_direction, second_direction, uid, ts_start, ts_end):
+        connections = self._connections(first_direction, second_direction, uid, ts_start, ts_end)
+        return json.dumps({'queryNeighbourhoodConnstateCount': group_counts(connections, 'connection.conn_state'),
+                           'queryNeighbourhoodProtoCount': group_counts(connections, 'connection.proto'),
+                           'queryNeighbourhoodServiceCount': group_counts(connections, 'connection.service')})
+
+    def query_neighbourhood_port_counts(self, first_direction, second_direction, uid, ts_start, ts_end):
+        connections = self._connections(first_direction, second_direction, uid, ts_start, ts_end)
+        return json.dumps({'queryNeighbourhoodPortOrigCount': group_counts(connections, 'connection.orig_p'),
+                           'queryNeighbourhoodPortRespCount': group_counts(connections, 'connection.resp_p')})
+
+    def query_neighbourhood_similar_counts(self, first_direction, second_direction, uid, ts_start, ts_end,
+                                           orig_attributes):
+        connections = self._connections(first_direction, second_direction, uid, ts_start, ts_end)
+        if self._filters[0] != uid:
+            self._filters = (uid, parse_filters(queries.generate_similar_filters(orig_attributes)))
+        filters = self._filters[1]
+        count = sum(all(matches(connection) for matches in filters) for connection in connections)
+        return json.dumps({'querySimilarNeighbourhoodCount': [{'count_similar': count}] if count else []})
+
+
+def poll(state, fetch_page_func, page_size):
+    """
+    Fetch all pages of connections newer than the poll start.
+
+    :param fetch_page_func: function (ts_start, offset, first) -> responses.ConnectionsPage (None if the query failed)
+    :return: number of new connections, None if a query failed
+    """
+    ts_start = state.poll_start()
+    offset = 0
+    new_count = 0
+    while True:
+        page = fetch_page_func(ts_start, offset, page_size)
+        if page is None:
+            return None
+        new_count += state.add_page(page)
+        if len(page) < page_size:
+            state.history_loaded = True
+            return new_count
+        offset += page_size
+
+
+def run_streaming(state, fetch_page_func, emit_func, watermark_file, page_size, poll_interval, max_polls=None,
+                  sleep_func=time.sleep):
+    """
+    Poll -> emit closed connections -> persist watermark loop.
+
+    :param state: StreamingState
+    :param fetch_page_func: see poll
+    :param emit_func: function (state, dictionary { host IP -> output of HostWindowState.pop_closed }) -> None
+    :param watermark_file: path of the persisted watermark
+    :param page_size: number of connections fetched by one query
+    :param poll_interval: seconds between polls
+    :param max_polls: stop after this number of polls (None = run forever)
+    :param sleep_func: function (seconds) -> None
+    """
+    poll_counter = 0
+    while max_polls is None or poll_counter < max_polls:
+        poll_counter += 1
+        new_count = poll(state, fetch_page_func, page_size)
+        if new_count is None:
+            print('Poll failed, watermark is not moved.')
+        else:
+            advanced = state.advance()
+            emitted_count = 0
+            if advanced:
+                watermark, closed = advanced
+                emit_func(state, closed)
+                emitted_count = sum(len(host_closed) for host_closed in closed.values())
+                save_watermark(watermark_file, watermark)
+                state.prune_history()
+            print('Poll {}: {} new, {} emitted, {} held back, watermark {}.'.format(
+                poll_counter, new_count, emitted_count, state.pending_count(),
+                responses.format_ts([state.watermark_ns])[0]))
+
+        if max_polls is None or poll_counter < max_polls:
+            sleep_func(poll_interval)
@@ -0,0 +1,31 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import cluster_profiles
+
+
+def test_models_are_named_by_unique_path_suffixes():
+    model_files = [os.path.join('workflow', 'model', key, 'scores.csv') for key in ['k8-a1b2', 'k16-c3d4']] + \
+        [os.path.join('sweep', 'labels_eps-1.0_ms-10.npy')]
+    assert cluster_profiles.model_names(model_files) == ['k8-a1b2/scores', 'k16-c3d4/scores', 'labels_eps-1.0_ms-10']
+
+
+def test_model_given_twice_is_rejected():
+    with pytest.raises(ValueError, match='more than once'):
+        cluster_profiles.model_names(['model/a/scores.csv', os.path.join('model', 'b', '..', 'a', 'scores.csv')])
+
+
+def test_workflow_scores_are_loaded_as_separate_models(tmp_path):
+    df = pd.DataFrame({'connection.uid': ['C1', 'C2', 'C3']})
+    model_files = []
+    for key, clusters in [('k2', [0, 1, 1]), ('k3', [2, 0, 1])]:
+        os.makedirs(tmp_path / 'model' / key)
+        model_files.append(str(tmp_path / 'model' / key / 'scores.csv'))
+        pd.DataFrame({'connection.uid': ['C3', 'C1', 'C2'], 'cluster': np.roll(clusters, 1)}).to_csv(
+            model_files[-1], index=False)
+
+    assignments = cluster_profiles.load_assignments(model_files, df)
+    assert list(assignments) == ['k2/scores', 'k3/scores']
+    assert assignments['k2/scores'].tolist() == [0, 1, 1]
+    assert assignments['k3/scores'].tolist() == [2, 0, 1]
@@ -0,0 +1,136 @@
+import time
+import threading
+import grpc
+import pytest
+from pydgraph.proto import api_pb2 as api
+from dgraph_client import DgraphClient, DgraphQueryError, DgraphUnavailableError
+
+
+ENDPOINTS = ['alpha1:9080', 'alpha2:9080', 'alpha3:9080']
+
+
+class FakeRpcError(grpc.RpcError):
+
+    def __init__(self, code):
+        super().__init__(code.name)
+        self._code = code
+
+    def code(self):
+        return self._code
+
+
+class FakeEndpoints:
+    """
+    Client stubs of fake alphas. Each alpha answers with its address, or by the next scripted behaviour: a gRPC
+    status code (the query fails) or 'slow' (the answer waits until the test releases it).
+    """
+
+    def __init__(self, scripts=None):
+        self.scripts = {address: list(script) for address, script in (scripts or {}).items()}
+        self.calls = []
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def stub_factory(self, address, options=None):
+        return FakeStub(self, address)
+
+    def answer(self, address):
+        with self._lock:
+            self.calls.append(address)
+            script = self.scripts.get(address)
+            behaviour = script.pop(0) if script else None
+        if behaviour == 'slow':
+            self.release.wait(10)
+        elif behaviour is not None:
+            raise FakeRpcError(behaviour)
+        return api.Response(json=('{"address": "' + address + '"}').encode())
+
+
+class FakeStub:
+
+    def __init__(self, endpoints, address):
+        self.endpoints = endpoints
+        self.address = address
+
+    def query(self, request, timeout=None, metadata=None, credentials=None):
+        return self.endpoints.answer(self.address)
+
+    def close(self):
+        pass
+
+
+def connect(endpoints, **kwargs):
+    sleeps = []
+    client = DgraphClient(stub_factory=endpoints.stub_factory, sleep_func=sleeps.append, **kwargs)
+    client.connect(ip=None, port=None, endpoints=ENDPOINTS)
+    return client, sleeps
+
+
+def test_queries_are_balanced_round_robin():
+    endpoints = FakeEndpoints()
+    client, sleeps = connect(endpoints)
+
+    answers = [client.query('{ q(func: uid(0x1)) { uid } }') for _ in range(6)]
+
+    assert endpoints.calls == ENDPOINTS * 2
+    assert answers == [('{"address": "' + address + '"}').encode() for address in ENDPOINTS * 2]
+    assert sleeps == []
+
+
+def test_transient_error_is_retried_on_the_next_alpha():
+    endpoints = FakeEndpoints({ENDPOINTS[0]: [grpc.StatusCode.UNAVAILABLE]})
+    client, sleeps = connect(endpoints, retries=3, backoff=0.5)
+
+    assert client.query('{}') == ('{"address": "' + ENDPOINTS[1] + '"}').encode()
+    assert endpoints.calls == ENDPOINTS[:2]
+    assert len(sleeps) == 1 and 0 <= sleeps[0] <= 0.5
+
+
+def test_permanent_error_is_raised_without_retries():
+    endpoints = FakeEndpoints({ENDPOINTS[0]: [grpc.StatusCode.INVALID_ARGUMENT]})
+    client, sleeps = connect(endpoints, retries=3)
+
+    with pytest.raises(DgraphQueryError) as error:
+        client.query('{ invalid }')
+    assert not isinstance(error.value, DgraphUnavailableError)
+    assert endpoints.calls == ENDPOINTS[:1]
+    assert sleeps == []
+
+
+def test_exhausted_retries_raise_unavailable_error():
+    endpoints = FakeEndpoints({address: [grpc.StatusCode.UNAVAILABLE] * 2 for address in ENDPOINTS})
+    client, sleeps = connect(endpoints, retries=4, backoff=0.5, max_backoff=1.0)
+
+    with pytest.raises(DgraphUnavailableError, match='after 5 attempts'):
+        client.query('{}')
+    assert endpoints.calls == (ENDPOINTS * 2)[:5]
+    # full jitter of the bounded exponential backoff:
+    assert len(sleeps) == 4
+    assert all(0 <= wait <= limit for wait, limit in zip(sleeps, [0.5, 1.0, 1.0, 1.0]))
+
+
+def test_slow_query_is_hedged_on_the_next_alpha():
+    endpoints = FakeEndpoints({ENDPOINTS[0]: ['slow']})
+    client, sleeps = connect(endpoints, hedge_after=0.05)
+    try:
+        start = time.perf_counter()
+        answer = client.query('{}')
+        seconds = time.perf_counter() - start
+    finally:
+        endpoints.release.set()
+        client.close()
+
+    assert answer == ('{"address": "' + ENDPOINTS[1] + '"}').encode()
+    assert endpoints.calls == ENDPOINTS[:2]
+    assert seconds < 5
+
+
+def test_fast_query_is_not_hedged():
+    endpoints = FakeEndpoints()
+    client, _ = connect(endpoints, hedge_after=5)
+    try:
+        assert client.query('{}') == ('{"address": "' + ENDPOINTS[0] + '"}').encode()
+    finally:
+        client.close()
+
+    assert endpoints.calls == ENDPOINTS[:1]
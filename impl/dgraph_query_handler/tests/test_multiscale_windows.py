@@ -0,0 +1,31 @@
+import pandas as pd
+import responses
+import multiscale_windows
+
+
+def connections_frame(rows):
+    start = pd.Timestamp('2017-07-04T12:00:00Z').value
+    ts = responses.format_ts([start + seconds * responses.NANOSECONDS_IN_SECOND for _, _, seconds, _ in rows])
+    df = pd.DataFrame([{'connection.uid': 'C' + str(i), 'originated_ip': originated_ip, 'responded_ip': responded_ip,
+                        'connection.ts': str(ts[i]),
+                        'connection.orig_p': 50000, 'connection.resp_p': 80, 'connection.proto': 'tcp',
+                        'connection.service': service, 'connection.conn_state': 'SF'}
+                       for i, (originated_ip, responded_ip, seconds, service) in enumerate(rows)])
+    for column in multiscale_windows.MULTISCALE_INPUT_COLS:
+        if column not in df:
+            df[column] = 1.0
+    return df
+
+
+def test_unset_service_shares_the_empty_neighbourhood_mode():
+    # '-' is the unset value of Zeek logs:
+    df = connections_frame([('10.0.0.1', '10.0.0.2', 0, '-'),
+                            ('10.0.0.2', '10.0.0.3', 1, 'http'),
+                            ('10.0.0.1', '10.0.0.2', 1000, 'http')])
+
+    features = multiscale_windows.MultiScaleWindows(df).compute_features([10])
+
+    assert features['orig_orig_connection.service_mode_10s'].tolist() == ['-', 'http', 'http']
+    # C0, C2 - nothing responded by the originator in the window, C1 - the originator responded C0:
+    assert features['orig_resp_connection.service_mode_10s'].tolist() == ['-', '-', '-']
+    assert list(features['orig_resp_connection.service_mode_10s'].cat.categories) == ['-', 'http']
@@ -0,0 +1,153 @@
+import glob
+import types
+import random
+import pandas as pd
+import orjson as json
+import pytest
+import responses
+import streaming
+import query_handler
+
+
+WINDOW_SECONDS = (query_handler.TIME_WINDOW_HOURS * 60 + query_handler.TIME_WINDOW_MINUTES) * 60 + \
+    query_handler.TIME_WINDOW_SECONDS
+HOSTS = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4']
+
+# connections of one template are similar to each other and not similar to connections of the other template:
+TEMPLATES = [
+    {'connection.proto': 'tcp', 'connection.service': 'http', 'connection.conn_state': 'SF',
+     'connection.duration': 0.3, 'connection.orig_pkts': 3, 'connection.resp_pkts': 3, 'connection.orig_bytes': 100,
+     'connection.resp_bytes': 2000, 'connection.orig_ip_bytes': 300, 'connection.resp_ip_bytes': 2500,
+     'connection.orig_p': 50000, 'connection.resp_p': 80},
+    {'connection.proto': 'udp', 'connection.service': 'dns', 'connection.conn_state': 'S0',
+     'connection.duration': 0.0, 'connection.orig_pkts': 1, 'connection.resp_pkts': 0, 'connection.orig_bytes': 0,
+     'connection.resp_bytes': 0, 'connection.orig_ip_bytes': 28, 'connection.resp_ip_bytes': 0,
+     'connection.orig_p': 40000, 'connection.resp_p': 53},
+]
+
+
+def generate_connections(count=120, seed=1):
+    rng = random.Random(seed)
+    start = pd.Timestamp('2017-07-04T12:00:00Z').value
+    connections = []
+    for i in range(count):
+        originated_ip, responded_ip = rng.sample(HOSTS, 2)
+        ts_ns = start + rng.randrange(40 * 60) * responses.NANOSECONDS_IN_SECOND
+        connection = dict(TEMPLATES[rng.randrange(len(TEMPLATES))])
+        connection.update({'uid': hex(i + 1), 'connection.uid': 'C' + str(i),
+                           'connection.ts': str(responses.format_ts([ts_ns])[0]),
+                           '~host.originated': [{'originated_ip': originated_ip}],
+                           '~host.responded': [{'responded_ip': responded_ip}]})
+        connections.append((ts_ns, connection))
+    return [connection for _, connection in sorted(connections, key=lambda item: item[0])]
+
+
+class FakeDgraphClient:
+    """
+    Serves the polling query from a list of connections ordered by time, connections are loaded gradually.
+    """
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.ts_ns = responses.convert_ts_to_epoch_ns([c['connection.ts'] for c in connections])
+        self.loaded = 0
+        self.queries = []
+
+    def query(self, query, variables=None):
+        self.queries.append(query.split('(')[0])
+        assert 'queryConnectionsSince' in query
+        ts_start = responses.convert_ts_to_epoch_ns([variables['$ts_start']])[0]
+        offset, first = int(variables['$offset']), int(variables['$first'])
+        newer = [c for c, ts_ns in zip(self.connections[:self.loaded], self.ts_ns) if ts_ns > ts_start]
+        return json.dumps({'queryConnectionsSince': newer[offset:offset + first]})
+
+
+def run_polls(client, tmp_path, monkeypatch, polls, step=15):
+    monkeypatch.setattr(query_handler, 'args', types.SimpleNamespace(projection_profile='core', app_families=None,
+                                                                     fetch_workers=2), raising=False)
+    monkeypatch.setattr(query_handler, 'dgraph_client', client, raising=False)
+    monkeypatch.setattr(query_handler, 'output_path', str(tmp_path / 'output'), raising=False)
+    watermark_file = str(tmp_path / 'watermark.json')
+
+    state = streaming.StreamingState(streaming.load_watermark(watermark_file, '2017-07-04T00:00:00Z'),
+                                     WINDOW_SECONDS * responses.NANOSECONDS_IN_SECOND,
+                                     30 * responses.NANOSECONDS_IN_SECOND)
+
+    def load_more(_):
+        client.loaded = min(client.loaded + step, len(client.connections))
+
+    streaming.run_streaming(state, query_handler.get_connections_since_page, query_handler.emit_stream_neighbourhoods,
+                            watermark_file, 7, 0, polls, sleep_func=load_more)
+    return state
+
+
+def read_output(tmp_path):
+    files = glob.glob(str(tmp_path / 'output-*.csv'))
+    return pd.concat([pd.read_csv(file) for file in files]).set_index('uid').sort_index()
+
+
+def expected_window(connections, host_ip, direction, ts_ns):
+    key = '~host.' + direction
+    ip_name = 'originated_ip' if direction == 'originated' else 'responded_ip'
+    window_ns = WINDOW_SECONDS * responses.NANOSECONDS_IN_SECOND
+    return [c for c in connections if c[key][0][ip_name] == host_ip and
+            ts_ns - window_ns <= responses.convert_ts_to_epoch_ns([c['connection.ts']])[0] <= ts_ns + window_ns]
+
+
+def test_features_are_computed_from_memory(tmp_path, monkeypatch):
+    connections = generate_connections()
+    client = FakeDgraphClient(connections)
+    state = run_polls(client, tmp_path, monkeypatch, polls=12)
+
+    # neighbourhoods are not queried:
+    assert set(client.queries) == {'query queryConnectionsSince'}
+
+    output = read_output(tmp_path)
+    watermark_ns = state.watermark_ns
+    emitted = [c for c in connections if responses.convert_ts_to_epoch_ns([c['connection.ts']])[0] <= watermark_ns]
+    assert 0 < len(emitted) < len(connections)
+    assert sorted(output.index) == sorted(c['uid'] for c in emitted)
+
+    blocks = {'orig_orig': ('originated', 'originated'), 'orig_resp': ('originated', 'responded'),
+              'resp_orig': ('responded', 'originated'), 'resp_resp': ('responded', 'responded')}
+    for connection in emitted:
+        row = output.loc[connection['uid']]
+        ts_ns = responses.convert_ts_to_epoch_ns([connection['connection.ts']])[0]
+        for block, (host_direction, direction) in blocks.items():
+            host_ip = connection['~host.' + host_direction][0][host_direction + '_ip']
+            window = expected_window(connections, host_ip, direction, ts_ns)
+            assert row[block + '_total'] == len(window)
+            if window:
+                assert row[block + '_connection.duration_mean'] == pytest.approx(
+                    sum(c['connection.duration'] for c in window) / len(window))
+            assert row[block + '_proto_tcp_count'] == sum(c['connection.proto'] == 'tcp' for c in window)
+            assert row[block + '_similar_count'] == sum(c['connection.proto'] == connection['connection.proto']
+                                                        for c in window)
+
+
+def test_restart_continues_from_watermark(tmp_path, monkeypatch):
+    connections = generate_connections(seed=2)
+    uninterrupted = tmp_path / 'uninterrupted'
+    restarted = tmp_path / 'restarted'
+    uninterrupted.mkdir()
+    restarted.mkdir()
+
+    run_polls(FakeDgraphClient(connections), uninterrupted, monkeypatch, polls=12)
+
+    client = FakeDgraphClient(connections)
+    run_polls(client, restarted, monkeypatch, polls=5)
+    # the history before the watermark is fetched again by the first poll of the restarted run:
+    run_polls(client, restarted, monkeypatch, polls=7)
+
+    expected = read_output(uninterrupted)
+    pd.testing.assert_frame_equal(expected, read_output(restarted)[expected.columns])
+
+
+def test_similar_filters_are_evaluated_as_by_dgraph():
+    filters = streaming.parse_filters(['AND ge(connection.orig_bytes, 50) AND le(connection.orig_bytes, 150)',
+                                       'AND (eq(connection.conn_state, "SH") OR eq(connection.conn_state, "SHR"))'])
+    assert all(f({'connection.orig_bytes': 100, 'connection.conn_state': 'SHR'}) for f in filters)
+    assert not all(f({'connection.orig_bytes': 151, 'connection.conn_state': 'SH'}) for f in filters)
+    assert not all(f({'connection.orig_bytes': 100, 'connection.conn_state': 'SF'}) for f in filters)
+    # a missing predicate does not match (as in Dgraph):
+    assert not all(f({'connection.conn_state': 'SH'}) for f in filters)
@@ -0,0 +1,101 @@
+import time
+import pytest
+import work_queue
+
+
+TASK_COSTS = {('10.0.0.1', 0, 2, None, '2017-07-04T12:00:00Z'): (20, 0),
+              ('10.0.0.1', 1, 2, '2017-07-04T12:00:00Z', None): (20, 0),
+              ('10.0.0.2', 0, 1, None, None): (5, 1)}
+SCHEDULE = list(TASK_COSTS)
+KEY = work_queue.plan_key(['10.0.0.1', '10.0.0.2'], 32, None)
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / 'queue.sqlite')
+
+
+def open_queue(queue_path, worker_id, lease_seconds=0.3):
+    return work_queue.WorkQueue(queue_path, lease_seconds, worker_id=worker_id)
+
+
+def test_planning_is_taken_over_when_the_planner_dies(queue_path):
+    planner, waiter = open_queue(queue_path, 'node1:1'), open_queue(queue_path, 'node2:1')
+    assert planner.claim_planning(KEY)
+    assert not waiter.claim_planning(KEY)
+
+    # the planner dies without enqueueing, the waiter takes over once the lease expires:
+    start = time.time()
+    assert not waiter.wait_until_planned(KEY, timeout=10, poll_seconds=0.05)
+    assert 0.2 < time.time() - start < 5
+    assert waiter.enqueue(SCHEDULE, TASK_COSTS)
+    assert not planner.enqueue(SCHEDULE, TASK_COSTS)
+    assert planner.wait_until_planned(KEY, timeout=1, poll_seconds=0.05)
+    assert waiter.state_counts() == {work_queue.PENDING: 3}
+
+
+def test_heartbeat_keeps_the_planning_and_waiting_times_out(queue_path):
+    planner, waiter = open_queue(queue_path, 'node1:1'), open_queue(queue_path, 'node2:1')
+    assert planner.claim_planning(KEY)
+    with work_queue.LeaseHeartbeat(planner) as heartbeat:
+        with pytest.raises(TimeoutError):
+            waiter.wait_until_planned(KEY, timeout=0.6, poll_seconds=0.05)
+        assert planner.enqueue(SCHEDULE, TASK_COSTS)
+    assert not heartbeat.lost
+    assert waiter.wait_until_planned(KEY, timeout=1, poll_seconds=0.05)
+
+
+def test_rerun_resumes_the_same_plan_and_replans_other_input(queue_path):
+    queue = open_queue(queue_path, 'node1:1')
+    assert queue.claim_planning(KEY)
+    assert queue.enqueue(SCHEDULE, TASK_COSTS)
+    task = queue.claim()
+    assert queue.complete(task, 1.0) is False
+
+    # the same input resumes the queue:
+    rerun = open_queue(queue_path, 'node1:2')
+    assert not rerun.claim_planning(KEY)
+    assert rerun.is_planned(KEY)
+    assert rerun.state_counts() == {work_queue.DONE: 1, work_queue.PENDING: 2}
+
+    # other input is not planned while tasks of the previous plan are leased:
+    other_key = work_queue.plan_key(['10.0.0.3'], 32, None)
+    leased = rerun.claim()
+    with pytest.raises(RuntimeError):
+        rerun.claim_planning(other_key)
+    rerun.release(leased)
+
+    assert rerun.claim_planning(other_key)
+    assert rerun.state_counts() == {}
+    assert not rerun.is_planned(KEY)
+
+
+def test_failed_shard_is_retried_after_a_delay_and_by_a_resumed_run(queue_path):
+    queue = work_queue.WorkQueue(queue_path, 10, worker_id='node1:1', retry_seconds=0.1)
+    assert queue.claim_planning(KEY)
+    assert queue.enqueue(SCHEDULE, TASK_COSTS)
+    claims, merged = [], []
+
+    def process(task):
+        claims.append((task, time.time()))
+        if task[1] == 1:
+            raise RuntimeError('Dgraph is unavailable')
+        return task, 0.1
+
+    assert work_queue.run_worker(queue, process, lambda host_ip, shard_count: merged.append(host_ip),
+                                 poll_seconds=0.02) == 2
+    retries = [claimed for task, claimed in claims if task[1] == 1]
+    # attempts wait 0.1 s and 0.2 s after the failures:
+    assert len(retries) == 3 and retries[1] - retries[0] >= 0.1 and retries[2] - retries[1] >= 0.2
+    assert queue.state_counts() == {work_queue.DONE: 2, work_queue.FAILED: 1}
+    assert queue.incomplete_hosts() == {'10.0.0.1': (1, 2)}
+    assert merged == []
+
+    # the resumed run retries the failed shard and merges the host:
+    rerun = work_queue.WorkQueue(queue_path, 10, worker_id='node1:2', retry_seconds=0.1)
+    assert not rerun.claim_planning(KEY)
+    assert work_queue.run_worker(rerun, lambda task: (task, 0.1), lambda host_ip, shard_count: merged.append(host_ip),
+                                 poll_seconds=0.02) == 1
+    assert rerun.state_counts() == {work_queue.DONE: 3}
+    assert rerun.incomplete_hosts() == {}
+    assert merged == ['10.0.0.1']
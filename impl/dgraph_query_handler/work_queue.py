@@ -0,0 +1,451 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Lease-based work queue of 'NEIGHBOURHOOD mode' tasks shared by processes on several nodes (no coordinator).
+
+Tasks of the scheduler (host IP, shard index, shard count, shard start time, shard end time) are rows of an SQLite
+database in a directory shared by the nodes. Every worker process claims the next pending task in the order of the
+schedule (largest first) in an exclusive transaction, so a task is leased to one worker at a time. A lease expires
+after lease_seconds unless the worker extends it (a heartbeat thread does it while the task is processed), expired
+leases are requeued by the next claim - tasks of a crashed process or node are picked up by the others. Adding a node
+(another query_handler.py process pointed to the same queue) adds workers without splitting the input hosts.
+
+The first process claims the planning (connection counts, time shards) and fills the queue, the others wait until the
+queue is planned. The planning is leased like a task (a heartbeat extends it while the plan is computed), so if the
+planner dies, a waiting process takes the planning over once the lease expires. The plan is identified by a key of
+its input (hosts and planning arguments): a run with the same key resumes the planned queue, a run with another key
+plans it again once no task of the previous run is leased. Shards of a host are merged by the worker which completes
+the last of them (shard files of a host with a failed shard stay until a rerun completes it).
+
+A failed task is returned to the queue with a delay (retry_seconds, doubled for every further attempt), so that a
+short outage of Dgraph does not use all attempts at once. A task failed max_attempts times is not claimed again in
+the run (state 'failed'), a run resuming the plan (or --requeue_failed) gives failed tasks new attempts.
+
+Notes: the shared file system has to support file locks used by SQLite (e.g. NFS with lockd), the rollback journal is
+used because WAL does not work over network file systems. Leases are compared to the wall clock of the nodes, clock
+skew between nodes has to be much smaller than lease_seconds.
+
+Usage: $ python3 work_queue.py -q <output_directory>/neighbourhood-queue.sqlite [--requeue_leased |
+         --requeue_failed | --reset]
+"""
+
+import os
+import time
+import socket
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    host_ip TEXT NOT NULL,
+    shard_index INTEGER NOT NULL,
+    shard_count INTEGER NOT NULL,
+    ts_start TEXT,
+    ts_end TEXT,
+    priority INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL,
+    duration REAL,
+    PRIMARY KEY (host_ip, shard_index)
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, priority);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def plan_key(*plan_inputs):
+    """
+    :param plan_inputs: everything the plan depends on (host IPs, number of processes, shard threshold, ...)
+    :return: key identifying the plan of the inputs
+    """
+    return hashlib.sha1(repr(plan_inputs).encode()).hexdigest()
+
+
+class WorkQueue:
+    """
+    :ivar path: SQLite database file of the queue
+    :ivar lease_seconds: lease timeout of a claimed task
+    :ivar worker_id: owner of leases of this process (host name and process id)
+    :ivar max_attempts: number of claims of a task before it is failed
+    :ivar retry_seconds: delay before a released task can be claimed again (doubled for every further attempt)
+    """
+
+    def __init__(self, path, lease_seconds=300, worker_id=None, max_attempts=3, retry_seconds=30):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or default_worker_id()
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        # autocommit mode, transactions are explicit (BEGIN IMMEDIATE takes the write lock at once):
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self.connection.executescript(SCHEMA)
+        # queues created before retry delays were added:
+        if 'not_before' not in [column[1] for column in self.connection.execute('PRAGMA table_info(tasks)')]:
+            self.connection.execute('ALTER TABLE tasks ADD COLUMN not_before REAL')
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.connection.close()
+
+    def _transaction(self, statements_func):
+        """
+        Run statements_func(cursor) in an exclusive transaction.
+        """
+        with self._lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements_func(cursor)
+                cursor.execute('COMMIT')
+                return result
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+
+    @staticmethod
+    def _meta(cursor):
+        return dict(cursor.execute('SELECT key, value FROM meta').fetchall())
+
+    def claim_planning(self, key=None):
+        """
+        Lease the planning of the queue. The planning of another key replaces a finished plan (tasks of the previous
+        plan are removed).
+
+        :param key: plan key of the input of this process (see plan_key)
+        :return: True if this process plans the queue (the first caller or the planner's lease expired), False if
+                 the queue is planned for the key or another process holds the planning lease
+        :raises: RuntimeError if the queue is planned for another key and its tasks are still leased
+        """
+        def claim(cursor):
+            now = time.time()
+            meta = self._meta(cursor)
+            if 'planned' in meta:
+                if meta.get('plan_key') == key:
+                    # a resumed run retries the tasks failed by the previous one:
+                    self._requeue_failed(cursor)
+                    return False
+                if cursor.execute('SELECT 1 FROM tasks WHERE state = ? AND lease_until >= ? LIMIT 1',
+                                  (LEASED, now)).fetchone() is not None:
+                    raise RuntimeError('Work queue {} is planned for other input and its tasks are being processed.'
+                                       .format(self.path))
+                cursor.execute('DELETE FROM tasks')
+                cursor.execute('DELETE FROM meta')
+            elif 'planner' in meta and meta['planner'] != self.worker_id and float(meta['planner_lease_until']) >= now:
+                return False
+            cursor.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                               [('planner', self.worker_id), ('planner_lease_until', str(now + self.lease_seconds)),
+                                ('plan_key', key)])
+            return True
+        return self._transaction(claim)
+
+    def heartbeat_planning(self):
+        """
+        Extend the planning lease.
+
+        :return: False if the lease was lost (expired and claimed by another process)
+        """
+        def extend(cursor):
+            if self._meta(cursor).get('planner') != self.worker_id:
+                return False
+            cursor.execute("UPDATE meta SET value = ? WHERE key = 'planner_lease_until'",
+                           (str(time.time() + self.lease_seconds),))
+            return True
+        return self._transaction(extend)
+
+    def is_planned(self, key=None):
+        meta = dict(self.connection.execute('SELECT key, value FROM meta').fetchall())
+        return 'planned' in meta and meta.get('plan_key') == key
+
+    def wait_until_planned(self, key=None, timeout=None, poll_seconds=5):
+        """
+        Wait until the queue is planned by another process, take the planning over if its lease expires.
+
+        :param key: plan key of the input of this process (see plan_key)
+        :param timeout: maximum waiting time in seconds (None = wait while the planner holds its lease)
+        :return: True if the queue is planned, False if this process took the planning over (it plans the queue)
+        :raises: TimeoutError if the queue is not planned in time
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            if self.is_planned(key):
+                return True
+            if self.claim_planning(key):
+                return False
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError('Work queue {} was not planned in {} s.'.format(self.path, timeout))
+            time.sleep(poll_seconds)
+
+    def enqueue(self, schedule, task_costs):
+        """
+        Fill the queue planned by this process.
+
+        :param schedule: tasks in the order in which they are handed out (scheduler.longest_first)
+        :param task_costs: { task -> (cost, tie breaker) } (scheduler.generate_shard_tasks)
+        :return: False if the planning lease was lost (the queue is planned by the process which took it over)
+        """
+        def insert(cursor):
+            meta = self._meta(cursor)
+            if 'planned' in meta or meta.get('planner') != self.worker_id:
+                return False
+            cursor.executemany('INSERT OR IGNORE INTO tasks (host_ip, shard_index, shard_count, ts_start, ts_end, '
+                               'priority, cost, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               [task + (priority, float(task_costs[task][0]), PENDING)
+                                for priority, task in enumerate(schedule)])
+            cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('planned', ?)", (str(time.time()),))
+            return True
+        return self._transaction(insert)
+
+    def claim(self):
+        """
+        Requeue expired leases and lease the next pending task (tasks released after a failure are claimable after
+        their retry delay).
+
+        :return: task or None if no task is claimable
+        """
+        def claim(cursor):
+            now = time.time()
+            cursor.execute('UPDATE tasks SET state = ?, owner = NULL, lease_until = NULL WHERE state = ? AND '
+                           'lease_until < ?', (PENDING, LEASED, now))
+            cursor.execute('UPDATE tasks SET state = ? WHERE state = ? AND attempts >= ?',
+                           (FAILED, PENDING, self.max_attempts))
+            row = cursor.execute('SELECT host_ip, shard_index, shard_count, ts_start, ts_end FROM tasks WHERE '
+                                 'state = ? AND (not_before IS NULL OR not_before <= ?) ORDER BY priority LIMIT 1',
+                                 (PENDING, now)).fetchone()
+            if row is None:
+                return None
+            cursor.execute('UPDATE tasks SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1 WHERE '
+                           'host_ip = ? AND shard_index = ?', (LEASED, self.worker_id, now + self.lease_seconds,
+                                                               row[0], row[1]))
+            return tuple(row)
+        return self._transaction(claim)
+
+    def heartbeat(self, task):
+        """
+        Extend the lease of the task.
+
+        :return: False if the lease was lost (expired and claimed by another worker)
+        """
+        def extend(cursor):
+            cursor.execute('UPDATE tasks SET lease_until = ? WHERE host_ip = ? AND shard_index = ? AND state = ? AND '
+                           'owner = ?', (time.time() + self.lease_seconds, task[0], task[1], LEASED, self.worker_id))
+            return cursor.rowcount == 1
+        return self._transaction(extend)
+
+    def complete(self, task, duration):
+        """
+        :return: True if all shards of the host of the task are done (by this call - the caller merges them)
+        """
+        def complete(cursor):
+            # the owner of a done task is the worker which completed it:
+            cursor.execute('UPDATE tasks SET state = ?, owner = ?, lease_until = NULL, duration = ? WHERE '
+                           'host_ip = ? AND shard_index = ? AND state != ?', (DONE, self.worker_id, duration, task[0],
+                                                                              task[1], DONE))
+            if cursor.rowcount != 1:
+                return False
+            undone = cursor.execute('SELECT COUNT(*) FROM tasks WHERE host_ip = ? AND state != ?',
+                                    (task[0], DONE)).fetchone()[0]
+            return undone == 0
+        return self._transaction(complete)
+
+    def release(self, task):
+        """
+        Return a failed task to the queue, claimable after retry_seconds * 2 ** (attempts - 1) (it is failed after
+        max_attempts claims).
+        """
+        def release(cursor):
+            row = cursor.execute('SELECT attempts FROM tasks WHERE host_ip = ? AND shard_index = ? AND owner = ?',
+                                 (task[0], task[1], self.worker_id)).fetchone()
+            if row is None:
+                return
+            attempts = row[0]
+            cursor.execute('UPDATE tasks SET state = ?, owner = NULL, lease_until = NULL, not_before = ? WHERE '
+                           'host_ip = ? AND shard_index = ?',
+                           (FAILED if attempts >= self.max_attempts else PENDING,
+                            time.time() + self.retry_seconds * 2 ** (attempts - 1), task[0], task[1]))
+        self._transaction(release)
+
+    def _requeue_failed(self, cursor):
+        return cursor.execute('UPDATE tasks SET state = ?, attempts = 0, not_before = NULL WHERE state = ?',
+                              (PENDING, FAILED)).rowcount
+
+    def requeue_failed(self):
+        """
+        Give failed tasks new max_attempts attempts.
+
+        :return: number of requeued tasks
+        """
+        return self._transaction(self._requeue_failed)
+
+    def requeue_leased(self):
+        """
+        Requeue all leased tasks without waiting for their leases to expire (e.g. after a crash of all workers).
+
+        :return: number of requeued tasks
+        """
+        return self._transaction(lambda cursor: cursor.execute(
+            'UPDATE tasks SET state = ?, owner = NULL, lease_until = NULL WHERE state = ?', (PENDING, LEASED)).rowcount)
+
+    def reset(self):
+        """
+        Remove all tasks and the plan, so that the next run plans the queue again.
+        """
+        def reset(cursor):
+            cursor.execute('DELETE FROM tasks')
+            cursor.execute('DELETE FROM meta')
+        self._transaction(reset)
+
+    def has_leased(self):
+        return self.connection.execute('SELECT 1 FROM tasks WHERE state = ? LIMIT 1', (LEASED,)).fetchone() is not None
+
+    def has_unfinished(self):
+        """
+        :return: True if a task is leased or pending (e.g. waiting for its retry delay)
+        """
+        return self.connection.execute('SELECT 1 FROM tasks WHERE state IN (?, ?) LIMIT 1',
+                                       (LEASED, PENDING)).fetchone() is not None
+
+    def incomplete_hosts(self):
+        """
+        :return: { host IP -> (done shards, shard count) } of hosts with a failed task (their output is not written,
+                 files of done shards are kept until a rerun completes the host)
+        """
+        return {host_ip: (done, shard_count) for host_ip, done, shard_count in self.connection.execute(
+            'SELECT host_ip, SUM(state = ?), MAX(shard_count) FROM tasks GROUP BY host_ip HAVING SUM(state = ?) > 0 '
+            'ORDER BY host_ip', (DONE, FAILED)).fetchall()}
+
+    def state_counts(self):
+        """
+        :return: { state -> number of tasks }
+        """
+        return dict(self.connection.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall())
+
+    def print_summary(self):
+        counts = self.state_counts()
+        print('Work queue {}: {}.'.format(self.path, ', '.join('{} {}'.format(counts.get(state, 0), state)
+                                                              for state in [PENDING, LEASED, DONE, FAILED])))
+        for node, tasks, seconds in self.connection.execute(
+                "SELECT substr(owner, 1, instr(owner, ':') - 1), COUNT(*), SUM(duration) FROM tasks WHERE state = ? "
+                "GROUP BY 1 ORDER BY 1", (DONE,)).fetchall():
+            print('  {:30} {:6} tasks done, {:10.2f} s'.format(node, tasks, seconds or 0.0))
+        incomplete = self.incomplete_hosts()
+        if incomplete:
+            print('Output of {} hosts with failed tasks is not written (rerun to retry them):'.format(len(incomplete)))
+            for host_ip, (done, shard_count) in incomplete.items():
+                print('  {:30} {} of {} shards done'.format(host_ip, done, shard_count))
+
+
+class LeaseHeartbeat:
+    """
+    Context manager extending the lease of a task (or the planning lease if no task is given) every lease_seconds / 3
+    seconds while the task is processed.
+
+    :ivar lost: True if an extension found the lease lost
+    """
+
+    def __init__(self, work_queue, task=None):
+        self.work_queue = work_queue
+        self.task = task
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.work_queue.lease_seconds / 3):
+            extended = self.work_queue.heartbeat(self.task) if self.task is not None else \
+                self.work_queue.heartbeat_planning()
+            if not extended:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(work_queue, process_func, merge_func, poll_seconds=10):
+    """
+    Claim and process tasks until no task is pending or leased.
+
+    :param process_func: function (task) -> (task, duration in seconds)
+    :param merge_func: function (host IP, shard count) called when all shards of a sharded host are done
+    :return: number of tasks processed by this worker
+    """
+    processed = 0
+    while True:
+        task = work_queue.claim()
+        if task is None:
+            # leases of other workers may still expire and be requeued, released tasks wait for their retry delay:
+            if not work_queue.has_unfinished():
+                return processed
+            time.sleep(poll_seconds)
+            continue
+
+        try:
+            with LeaseHeartbeat(work_queue, task) as heartbeat:
+                _, duration = process_func(task)
+        except Exception as error:
+            print('Task {} failed: {!r}'.format(task, error))
+            work_queue.release(task)
+            continue
+
+        if heartbeat.lost:
+            print('Lease of task {} was lost, the result may be written again by another worker.'.format(task))
+        if work_queue.complete(task, duration) and task[2] > 1:
+            merge_func(task[0], task[2])
+        processed += 1
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-q', '--queue', help='SQLite file of the work queue', type=str, required=True)
+    parser.add_argument('--requeue_leased', help='Requeue all leased tasks (no worker is running)',
+                        action='store_true')
+    parser.add_argument('--requeue_failed', help='Give failed tasks new attempts', action='store_true')
+    parser.add_argument('--reset', help='Remove all tasks and the plan (the next run plans the queue again)',
+                        action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    queue = WorkQueue(args.queue)
+    if args.requeue_leased:
+        print('Requeued {} tasks.'.format(queue.requeue_leased()))
+    if args.requeue_failed:
+        print('Requeued {} failed tasks.'.format(queue.requeue_failed()))
+    if args.reset:
+        queue.reset()
+        print('Removed all tasks and the plan.')
+    queue.print_summary()
+    queue.close()
@@ -0,0 +1,383 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""
+Runner of the analysis workflow of the notebooks (preprocessing -> exploration -> data preparation -> model) over
+datasets of CONNECTIONS mode output (zip archives in data/, directories with originated/ and responded/ files or
+partitioned datasets).
+
+Every stage is a function of its declared inputs (the dataset or artifacts of previous stages) and of its declared
+parameters. Its artifact is a directory of the cache:
+
+  <cache directory>/<stage>/<key>/      files of the stage and artifact.json (parameters, inputs, time, result)
+
+The key is a SHA-256 hash of the stage name, the source code of the stage (workflow.py, the modules of the stage and
+all modules of this directory they import), the values of its parameters and the keys of its inputs - the key of a
+dataset is the hash of its content. A stage is computed only
+if its artifact is not in the cache, so e.g. changing the number of clusters refits only the model, and changing
+the window sizes recomputes everything after the neighbourhoods. Artifacts are written to a temporary directory and
+renamed when complete (an interrupted run leaves no partial artifact).
+
+  neighbourhood   connections + neighbourhood features of all window sizes (multiscale_windows.py)
+  exploration     summary of numerical columns and the most frequent values of categorical columns
+  preparation     fitted preprocessing.Preprocessor and transformed rows (numerical matrix, category codes)
+  model           mini-batch k-prototypes (k-means on PCA components), cluster_model.ClusterModel and the cluster
+                  and anomaly score of every connection
+
+Datasets are independent and are processed in parallel processes, time of every stage is reported (and written to
+a CSV file with -t).
+
+Usage: $ python3 workflow.py -i ../../data/cicids2017/*.zip -c workflow_cache [-w 10 60 300 1800 -pc 20 -k 9
+         -u model -j 4 -t timings.csv]
+"""
+
+import os
+import io
+import ast
+import glob
+import json
+import time
+import shutil
+import zipfile
+import hashlib
+import inspect
+import argparse
+import tempfile
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import feature_columns
+import partitioned_output
+import preprocessing
+import minibatch_kprototypes
+import multiscale_windows
+import host_graph
+import cluster_model
+from multiscale_windows import MultiScaleWindows, MULTISCALE_INPUT_COLS
+from preprocessing import Preprocessor
+from cluster_model import ClusterModel
+
+
+ARTIFACT_FILE = 'artifact.json'
+NEIGHBOURHOOD_FILE = 'neighbourhood.csv'
+PREPROCESSOR_FILE = 'preprocessor.npz'
+NUMERIC_FILE = 'numeric.npy'
+CATEGORICAL_FILE = 'categorical.npy'
+MODEL_FILE = 'model.npz'
+SCORES_FILE = 'scores.csv'
+
+# identifiers and raw attributes of connections in the neighbourhood file which are not model features:
+NON_FEATURE_COLS = feature_columns.CONN_IDS_COLS + ['connection.ts', 'connection.orig_p', 'connection.resp_p']
+CATEGORICAL_INPUT_COLS = list(multiscale_windows.WINDOW_MODE_COLS)
+NEIGHBOURHOOD_INPUT_COLS = MULTISCALE_INPUT_COLS
+HASH_BLOCK_SIZE = 1 << 20
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# modules used by the helpers of the workflow (read_dataset, feature_columns_of) - part of the key of every stage:
+WORKFLOW_MODULES = [feature_columns, partitioned_output, multiscale_windows]
+
+
+def local_module_files(modules):
+    """
+    :return: sorted source files of the modules and of all modules of this directory they import (directly or not)
+    """
+    pending = [os.path.abspath(inspect.getsourcefile(module)) for module in modules]
+    files = set()
+    while pending:
+        file_name = pending.pop()
+        if file_name in files:
+            continue
+        files.add(file_name)
+        with open(file_name, 'r') as file:
+            tree = ast.parse(file.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            pending.extend(candidate for candidate in (os.path.join(MODULE_DIRECTORY, name.split('.')[0] + '.py')
+                                                       for name in names) if os.path.isfile(candidate))
+    return sorted(files)
+
+
+class Stage:
+    """
+    :ivar name: name of the stage (directory of its artifacts in the cache)
+    :ivar func: function (inputs { input -> path }, parameters, output directory) -> result (JSON serializable)
+    :ivar inputs: 'dataset' or names of previous stages
+    :ivar params: names of parameters of the stage (only these are part of its key)
+    :ivar modules: modules whose source code is part of the key (with workflow.py, WORKFLOW_MODULES and all modules
+                   of this directory they import)
+    """
+
+    def __init__(self, name, func, inputs, params, modules):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.params = params
+        self.modules = modules
+
+    def code_hash(self):
+        digest = hashlib.sha256(inspect.getsource(self.func).encode())
+        # modules imported by workflow.py itself are not followed, they are part of keys of the stages using them:
+        for file_name in [os.path.abspath(__file__)] + local_module_files(self.modules + WORKFLOW_MODULES):
+            digest.update(os.path.basename(file_name).encode())
+            with open(file_name, 'rb') as file:
+                digest.update(file.read())
+        return digest.hexdigest()
+
+
+def dataset_name(path):
+    name = os.path.basename(os.path.normpath(path))
+    return name[:-len('.zip')] if name.endswith('.zip') else name
+
+
+def content_hash(path):
+    """
+    :return: SHA-256 hash of the file or of relative paths and contents of all files of the directory
+    """
+    digest = hashlib.sha256()
+    files = [path] if os.path.isfile(path) else \
+        sorted(file for file in glob.glob(os.path.join(path, '**', '*'), recursive=True) if os.path.isfile(file))
+    for file_name in files:
+        digest.update(os.path.relpath(file_name, path).encode())
+        with open(file_name, 'rb') as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def is_originated_file(file_name):
+    match = partitioned_output.HOST_FILE_PATTERN.search(os.path.basename(file_name))
+    return match is not None and match.group(1) == 'o'
+
+
+def read_dataset(path, columns):
+    """
+    Read originated connections of the dataset (a connection present in several files is used once).
+
+    :param path: zip archive or directory of CONNECTIONS mode output files, partitioned dataset or CSV file
+    """
+    read_csv_kwargs = {'usecols': lambda column: column in columns, 'low_memory': False}
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            frames = [pd.read_csv(io.BytesIO(archive.read(member)), **read_csv_kwargs)
+                      for member in sorted(archive.namelist()) if is_originated_file(member)]
+    elif os.path.isdir(path) and not os.path.exists(partitioned_output.index_file(path)):
+        frames = [pd.read_csv(file_name, **read_csv_kwargs) for file_name in
+                  sorted(glob.glob(os.path.join(path, '**', '*.csv'), recursive=True)) if is_originated_file(file_name)]
+    else:
+        frames = [partitioned_output.read_connections(path, **read_csv_kwargs)]
+    return pd.concat(frames, ignore_index=True).drop_duplicates('connection.uid').reset_index(drop=True)
+
+
+def neighbourhood_stage(inputs, params, output_directory):
+    connections = read_dataset(inputs['dataset'], NEIGHBOURHOOD_INPUT_COLS)
+    features = MultiScaleWindows(connections).compute_features(params['windows'])
+    neighbourhood = pd.concat([connections, features], axis=1)
+    neighbourhood.to_csv(os.path.join(output_directory, NEIGHBOURHOOD_FILE), index=False, header=True)
+    return {'rows': len(neighbourhood), 'columns': neighbourhood.shape[1]}
+
+
+def feature_columns_of(columns):
+    """
+    :return: (numerical columns, categorical columns) of the model among columns of the neighbourhood file
+    """
+    categorical = [column for column in columns if column in CATEGORICAL_INPUT_COLS or '_mode_' in column]
+    numeric = [column for column in columns if column not in NON_FEATURE_COLS and column not in categorical]
+    return numeric, categorical
+
+
+def exploration_stage(inputs, params, output_directory):
+    df = pd.read_csv(os.path.join(inputs['neighbourhood'], NEIGHBOURHOOD_FILE), low_memory=False)
+    numeric, categorical = feature_columns_of(df.columns)
+    summary = df[numeric].describe().T
+    summary['missing'] = df[numeric].isna().sum()
+    summary['unique'] = df[numeric].nunique()
+    summary.to_csv(os.path.join(output_directory, 'numeric_summary.csv'), index_label='column')
+
+    values = [df[column].fillna('none').value_counts().head(params['top_values']).rename_axis('value')
+              .reset_index(name='count').assign(column=column) for column in categorical]
+    pd.concat(values, ignore_index=True)[['column', 'value', 'count']].to_csv(
+        os.path.join(output_directory, 'categorical_summary.csv'), index=False)
+    return {'rows': len(df), 'constant_columns': int((summary['unique'] <= 1).sum())}
+
+
+def preparation_stage(inputs, params, output_directory):
+    neighbourhood_csv = os.path.join(inputs['neighbourhood'], NEIGHBOURHOOD_FILE)
+    numeric, categorical = feature_columns_of(pd.read_csv(neighbourhood_csv, nrows=0).columns)
+
+    def read_chunks():
+        return pd.read_csv(neighbourhood_csv, chunksize=params['chunk_size'], low_memory=False,
+                           usecols=lambda column: column in numeric or column in categorical)
+
+    preprocessor = Preprocessor(numeric, categorical, n_components=params['pca_components']).fit(read_chunks)
+    preprocessor.save(os.path.join(output_directory, PREPROCESSOR_FILE))
+    transformed = [preprocessor.transform(chunk) for chunk in read_chunks()]
+    np.save(os.path.join(output_directory, NUMERIC_FILE), np.vstack([X_num for X_num, _ in transformed]))
+    np.save(os.path.join(output_directory, CATEGORICAL_FILE), np.vstack([X_cat for _, X_cat in transformed]))
+    result = {'rows': preprocessor.n_rows, 'numeric_columns': len(numeric), 'categorical_columns': len(categorical)}
+    if preprocessor.explained_variance_ratio is not None:
+        result['explained_variance'] = float(preprocessor.explained_variance_ratio.sum())
+    return result
+
+
+def model_stage(inputs, params, output_directory):
+    preprocessor = Preprocessor.load(os.path.join(inputs['preparation'], PREPROCESSOR_FILE))
+    X_num = np.load(os.path.join(inputs['preparation'], NUMERIC_FILE), mmap_mode='r')
+    X_cat = np.load(os.path.join(inputs['preparation'], CATEGORICAL_FILE), mmap_mode='r')
+
+    kprototypes = minibatch_kprototypes.MiniBatchKPrototypes(
+        n_clusters=params['n_clusters'], batch_size=params['batch_size'], max_iter=params['max_iter'],
+        random_state=params['seed'], compute_labels=False).fit(X_num, X_cat)
+    model = ClusterModel.from_preprocessed(kprototypes, preprocessor)
+    if params['quantile'] is not None:
+        model.fit_thresholds(X_num, X_cat, params['quantile'])
+    model.save(os.path.join(output_directory, MODEL_FILE))
+
+    labels, scores = model.score(X_num, X_cat)
+    ids = pd.read_csv(os.path.join(inputs['neighbourhood'], NEIGHBOURHOOD_FILE), low_memory=False,
+                      usecols=lambda column: column in feature_columns.CONN_IDS_COLS)
+    ids.assign(cluster=labels, anomaly_score=scores).to_csv(os.path.join(output_directory, SCORES_FILE),
+                                                           index=False, header=True)
+    return {'clusters': model.n_clusters, 'cost': float(scores.sum()),
+            'cluster_sizes': np.bincount(labels, minlength=model.n_clusters).tolist()}
+
+
+STAGES = [
+    Stage('neighbourhood', neighbourhood_stage, ['dataset'], ['windows'], [multiscale_windows, host_graph]),
+    Stage('exploration', exploration_stage, ['neighbourhood'], ['top_values'], []),
+    Stage('preparation', preparation_stage, ['neighbourhood'], ['pca_components', 'chunk_size'], [preprocessing]),
+    Stage('model', model_stage, ['neighbourhood', 'preparation'],
+          ['n_clusters', 'batch_size', 'max_iter', 'seed', 'quantile'], [minibatch_kprototypes, cluster_model]),
+]
+STAGE_NAMES = [stage.name for stage in STAGES]
+
+
+def artifact_key(stage, params, input_keys):
+    description = {'stage': stage.name, 'code': stage.code_hash(),
+                   'params': {param: params[param] for param in stage.params},
+                   'inputs': [input_keys[name] for name in stage.inputs]}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def run_stage(stage, params, input_keys, input_paths, cache_directory):
+    """
+    Compute the artifact of the stage unless it is in the cache.
+
+    :return: (key, artifact directory, True if the artifact was cached, seconds)
+    """
+    start = time.time()
+    key = artifact_key(stage, params, input_keys)
+    directory = os.path.join(cache_directory, stage.name, key)
+    if os.path.exists(os.path.join(directory, ARTIFACT_FILE)):
+        return key, directory, True, time.time() - start
+
+    os.makedirs(os.path.join(cache_directory, stage.name), exist_ok=True)
+    temporary = tempfile.mkdtemp(prefix='.' + key[:12] + '-', dir=os.path.join(cache_directory, stage.name))
+    try:
+        result = stage.func({name: input_paths[name] for name in stage.inputs}, params, temporary)
+        seconds = time.time() - start
+        with open(os.path.join(temporary, ARTIFACT_FILE), 'w') as file:
+            json.dump({'stage': stage.name, 'params': {param: params[param] for param in stage.params},
+                       'inputs': {name: input_keys[name] for name in stage.inputs}, 'seconds': seconds,
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'result': result}, file, indent=2)
+        try:
+            os.rename(temporary, directory)
+        except OSError:
+            # the same artifact was completed by another process (e.g. two copies of a dataset)
+            shutil.rmtree(temporary, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+    return key, directory, False, seconds
+
+
+def run_dataset(dataset, params, cache_directory, until='model'):
+    """
+    Run stages of the workflow up to the stage until over the dataset.
+
+    :return: list of timings { dataset, stage, key, cached, seconds, directory }
+    """
+    name = dataset_name(dataset)
+    input_keys = {'dataset': content_hash(dataset)}
+    input_paths = {'dataset': dataset}
+    timings = []
+    for stage in STAGES[:STAGE_NAMES.index(until) + 1]:
+        key, directory, cached, seconds = run_stage(stage, params, input_keys, input_paths, cache_directory)
+        input_keys[stage.name], input_paths[stage.name] = key, directory
+        timings.append({'dataset': name, 'stage': stage.name, 'key': key, 'cached': cached, 'seconds': seconds,
+                        'directory': directory})
+        print('{}: stage {} {} in {:.2f} s.'.format(name, stage.name, 'cached' if cached else 'computed', seconds))
+    return timings
+
+
+def run_datasets(datasets, params, cache_directory, until='model', jobs=None):
+    """
+    Run the workflow over datasets in parallel processes (one process per dataset).
+
+    :return: DataFrame of timings of all datasets and stages
+    """
+    jobs = jobs or min(len(datasets), os.cpu_count() or 1)
+    timings = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_dataset, dataset, params, cache_directory, until): dataset
+                   for dataset in datasets}
+        for future in concurrent.futures.as_completed(futures):
+            timings.extend(future.result())
+    return pd.DataFrame(timings).sort_values(['dataset'], kind='stable').reset_index(drop=True)
+
+
+def print_timings(timings):
+    for row in timings.itertuples(index=False):
+        print('{:30} {:14} {:8} {:10.2f} s  {}'.format(row.dataset, row.stage, 'cached' if row.cached else
+                                                        'computed', row.seconds, row.directory))
+    for stage, rows in timings.groupby('stage', sort=False):
+        print('Stage {:14}: {} computed, {} cached, {:.2f} s'.format(stage, int((~rows['cached']).sum()),
+                                                                     int(rows['cached'].sum()), rows['seconds'].sum()))
+
+
+def define_arguments():
+    """
+        Add arguments to ArgumentParser (argparse) module instance.
+
+        :return: Parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--datasets', help='Datasets - zip archives or directories of CONNECTIONS mode output '
+                        'files, partitioned datasets (globs are expanded)', nargs='+', required=True)
+    parser.add_argument('-c', '--cache_directory', help='Directory of cached artifacts', type=str,
+                        default='workflow_cache')
+    parser.add_argument('-u', '--until', help='Last stage to run', choices=STAGE_NAMES, default=STAGE_NAMES[-1])
+    parser.add_argument('-j', '--jobs', help='Number of datasets processed in parallel (default: number of CPUs)',
+                        type=int, default=None)
+    parser.add_argument('-t', '--timings_csv', help='Write timings of stages to this CSV file', type=str,
+                        default=None)
+    parser.add_argument('-w', '--windows', help='Half-widths of time windows in seconds', nargs='+', type=int,
+                        default=[10, 60, 300, 1800])
+    parser.add_argument('-tv', '--top_values', help='Number of most frequent values of categorical columns in the '
+                        'exploration summary', type=int, default=10)
+    parser.add_argument('-pc', '--pca_components', help='Number of PCA components (k-means on the projection)',
+                        type=int, default=None)
+    parser.add_argument('-cs', '--chunk_size', help='Number of rows read from CSV at once', type=int, default=200000)
+    parser.add_argument('-k', '--n_clusters', help='Number of clusters', type=int, default=9)
+    parser.add_argument('-b', '--batch_size', help='Mini-batch size', type=int, default=10000)
+    parser.add_argument('-it', '--max_iter', help='Maximum number of iterations (passes over data)', type=int,
+                        default=10)
+    parser.add_argument('-s', '--seed', help='Random seed', type=int, default=0)
+    parser.add_argument('-q', '--quantile', help='Quantile of training scores used as anomaly threshold', type=float,
+                        default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = define_arguments()
+    datasets = [path for pattern in args.datasets for path in (sorted(glob.glob(pattern)) or [pattern])]
+    params = {param: getattr(args, param) for stage in STAGES for param in stage.params}
+    timings = run_datasets(datasets, params, args.cache_directory, args.until, args.jobs)
+    print_timings(timings)
+    if args.timings_csv:
+        timings.to_csv(args.timings_csv, index=False, header=True)
+        print('Successfully wrote timings to file ' + args.timings_csv + '.')